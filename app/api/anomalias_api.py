@@ -1,12 +1,12 @@
-from fastapi import APIRouter, Depends, Query
+from fastapi import APIRouter, Body, Depends, Query
 from sqlalchemy.orm import Session
 from app.db.session import get_db
-from app.services.modelo import detectar_anomalias_por_nic, alerta_anomalia_actual
+from app.services.modelo import detectar_anomalias_por_nic, alerta_anomalia_actual, alertas_anomalias_batch
 from app.models.user_model import User
 from app.models.factura_model import Factura
 from app.models.historico_model import HistoricoConsumo
 from app.services.auth import get_current_user
-from typing import Optional
+from typing import List, Optional
 from sqlalchemy import desc
 
 router = APIRouter()
@@ -176,6 +176,50 @@ def alerta_anomalia(
             "estado": "error"
         }
 
+@router.post("/batch")
+def alertas_anomalias_varios_nics(
+    nics: List[str] = Body(default=[], embed=True, description="NICs a consultar (vacío: todos los del usuario)"),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    🔐 ENDPOINT CON JWT - ALERTAS DE VARIOS NICS
+    Alerta de anomalía más reciente de muchos NICs en una sola petición
+    
+    Args:
+        nics: Lista de NICs ({"nics": [...]}); si viene vacía se usan todos los
+            NICs con facturas del usuario
+    
+    Returns:
+        Alerta de cada NIC con el formato de /alerta/{nic}
+    """
+    try:
+        if not nics:
+            nics = [nic for (nic,) in db.query(Factura.nic).filter(
+                Factura.user_id == current_user.id,
+                Factura.nic.isnot(None)
+            ).distinct().all()]
+        nics = list(dict.fromkeys(nics))
+        
+        alertas = alertas_anomalias_batch(db, [(current_user.id, nic) for nic in nics])
+        alertas_por_nic = {nic: alertas[(current_user.id, nic)] for nic in nics}
+        
+        return {
+            "usuario": current_user.email,
+            "alertas": alertas_por_nic,
+            "total_nics": len(nics),
+            "nics_con_anomalia": [nic for nic, alerta in alertas_por_nic.items() if alerta.get("anomalia") == True]
+        }
+        
+    except Exception as e:
+        return {
+            "usuario": current_user.email if current_user else "Error",
+            "alertas": {},
+            "total_nics": 0,
+            "nics_con_anomalia": [],
+            "error": f"Error obteniendo alertas: {str(e)}"
+        }
+
 @router.get("/consultar_consumo/{nic}")
 def consultar_consumo_completo(
     nic: str,
@@ -8,6 +8,7 @@ from app.db.session import get_db
 from app.models.user_model import User
 from app.schemas.user_schemas import UserResponse, TokenResponse
 from app.crud.user_crud import get_or_create_user, get_user_by_email
+from app.services.tokens_gmail import gestor_tokens
 
 router = APIRouter()
 
@@ -89,6 +90,8 @@ def autenticar_android(
             gmail_token=gmail_access_token,
             gmail_refresh_token=gmail_refresh_token  # ¡AHORA SÍ SE INCLUYE!
         )
+        # Descartar credenciales cacheadas con los tokens anteriores
+        gestor_tokens.invalidar(user.id)
         
         if not user.is_active:
             raise HTTPException(
@@ -203,6 +206,7 @@ def actualizar_gmail_token(
     try:
         current_user.gmail_token = gmail_token
         db.commit()
+        gestor_tokens.invalidar(current_user.id)
         
         logger.info(f"🔐 Token de Gmail actualizado para: {current_user.email}")
         
@@ -394,6 +398,7 @@ def preparar_reautenticacion_completa(
         user.gmail_token = None
         user.gmail_refresh_token = None
         db.commit()
+        gestor_tokens.invalidar(user.id)
         db.refresh(user)
         
         logger.info("🧹 Tokens limpiados de la base de datos")
@@ -1,8 +1,15 @@
-from fastapi import APIRouter, Depends, Query
+import json
+import time
+import queue
+import asyncio
+from fastapi import APIRouter, Depends, Query, HTTPException
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
-from app.db.session import get_db
+from app.db.session import get_db, SessionLocal
 from app.crud.factura_crud import get_facturas
-from app.services.extractor import sincronizar_facturas_con_limite
+from app.services.trabajos_sync import cola_trabajos, obtener_trabajo, job_a_dict
+from app.services.eventos_sync import bus_eventos
 from app.services.database import init_db_if_not_exists
 from app.models.factura_model import Factura
 from app.services.auth import get_current_user
@@ -72,14 +79,13 @@ def sync_facturas_sin_jwt(
         gmail_token = user.gmail_token
         
         if gmail_token:
-            # Usar el token de Gmail del usuario con límite
-            result = sincronizar_facturas_con_limite(
-                user_id=user_id, 
-                gmail_token=gmail_token,
-                max_emails=max_emails
-            )
+            # Encolar la sincronización; el progreso se consulta en /facturas/jobs/{id}
+            job, unido = cola_trabajos.encolar(user_id, "sync", {"max_emails": max_emails})
             return {
-                **result,
+                "job_id": job.id,
+                "estado": job.estado,
+                "unido_a_trabajo_en_curso": unido,
+                "url_progreso": f"/facturas/jobs_sin_jwt/{job.id}?user_id={user_id}",
                 "configuracion": {
                     "max_emails_solicitados": max_emails,
                     "tiempo_estimado": tiempo_estimado,
@@ -162,14 +168,13 @@ def sync_facturas_con_jwt(
         gmail_token = current_user.gmail_token
         
         if gmail_token:
-            # Usar el token de Gmail del usuario con límite
-            result = sincronizar_facturas_con_limite(
-                user_id=current_user.id, 
-                gmail_token=gmail_token,
-                max_emails=max_emails
-            )
+            # Encolar la sincronización; el progreso se consulta en /facturas/jobs/{id}
+            job, unido = cola_trabajos.encolar(current_user.id, "sync_con_jwt", {"max_emails": max_emails})
             return {
-                **result,
+                "job_id": job.id,
+                "estado": job.estado,
+                "unido_a_trabajo_en_curso": unido,
+                "url_progreso": f"/facturas/jobs/{job.id}",
                 "configuracion": {
                     "max_emails_solicitados": max_emails,
                     "tiempo_estimado": tiempo_estimado,
@@ -514,7 +519,7 @@ def sync_inteligente_con_jwt(
         forzar_sync: Si es True, procesa todos los emails aunque ya existan facturas
     
     Returns:
-        Resultado de la sincronización con detalles de procesamiento
+        Id del trabajo encolado; el resultado se consulta en /facturas/jobs/{id}
     """
     try:
         # Validaciones
@@ -525,21 +530,6 @@ def sync_inteligente_con_jwt(
                 "usuario": current_user.email
             }
         
-        # Verificar si el usuario ya tiene facturas
-        facturas_existentes = db.query(Factura).filter(Factura.user_id == current_user.id).count()
-        
-        es_primera_vez = facturas_existentes == 0
-        
-        if es_primera_vez:
-            modo_sync = "primera_vez"
-            limite_recomendado = min(max_emails, 10)  # Límite más conservador para primera vez
-        elif forzar_sync:
-            modo_sync = "forzada_completa"
-            limite_recomendado = max_emails
-        else:
-            modo_sync = "incremental"
-            limite_recomendado = min(max_emails, 5)  # Pocas facturas para incremental
-        
         # Verificar que el usuario tenga gmail_token
         if not current_user.gmail_token:
             return {
@@ -549,36 +539,149 @@ def sync_inteligente_con_jwt(
                 "sync_realizado": False
             }
         
-        # Ejecutar sincronización
-        resultado_sync = sincronizar_facturas_con_limite(
-            user_id=current_user.id,
-            gmail_token=current_user.gmail_token,
-            max_emails=limite_recomendado
+        # El modo (primera vez / incremental / forzada) se decide al ejecutar el trabajo
+        job, unido = cola_trabajos.encolar(
+            current_user.id,
+            "sync_inteligente",
+            {"max_emails": max_emails, "forzar_sync": forzar_sync}
         )
-        
-        # Contar facturas después de la sincronización
-        facturas_despues = db.query(Factura).filter(Factura.user_id == current_user.id).count()
-        facturas_nuevas = facturas_despues - facturas_existentes
-        
-        # Información de resultado
         return {
-            "sync_completado": True,
-            "modo_sincronizacion": modo_sync,
-            "es_primera_vez": es_primera_vez,
+            "job_id": job.id,
+            "estado": job.estado,
+            "unido_a_trabajo_en_curso": unido,
+            "url_progreso": f"/facturas/jobs/{job.id}",
             "usuario": current_user.email,
-            "emails_procesados": limite_recomendado,
-            "facturas_antes": facturas_existentes,
-            "facturas_despues": facturas_despues,
-            "facturas_nuevas": facturas_nuevas,
-            "resultado_extractor": resultado_sync,
-            "recomendacion": "Sincronización completa" if facturas_nuevas > 0 else "No se encontraron facturas nuevas"
+            "forzar_sync": forzar_sync
         }
         
     except Exception as e:
         return {
             "error": f"Error en sincronización inteligente: {str(e)}",
             "usuario": current_user.email,
-            "sync_completado": False,
-            "modo_sincronizacion": modo_sync if 'modo_sync' in locals() else "desconocido"
+            "sync_completado": False
         }
-    
\ No newline at end of file
+
+@router.get("/jobs/{job_id}")
+def estado_trabajo_sync(
+    job_id: int,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    📈 PROGRESO DE UN TRABAJO DE SINCRONIZACIÓN
+    Estado, etapa actual, contadores (emails listados, PDFs descargados,
+    gráficos analizados) y, al terminar, el resultado de la sincronización
+    """
+    job = obtener_trabajo(db, job_id)
+    if not job or job.user_id != current_user.id:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return job_a_dict(job)
+
+# ENDPOINT TEMPORAL SIN JWT - PROGRESO DE UN TRABAJO
+@router.get("/jobs_sin_jwt/{job_id}")
+def estado_trabajo_sync_sin_jwt(
+    job_id: int,
+    user_id: Optional[int] = Query(default=2, description="ID del usuario (temporal)"),
+    db: Session = Depends(get_db)
+):
+    """
+    ENDPOINT TEMPORAL SIN JWT - Solo para pruebas
+    Progreso de un trabajo encolado con /facturas/sync
+    """
+    job = obtener_trabajo(db, job_id)
+    if not job or job.user_id != user_id:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return job_a_dict(job)
+
+# === Streaming de progreso (NDJSON: un evento JSON por línea) ===
+def _linea(evento: dict) -> str:
+    return json.dumps(evento, default=str, ensure_ascii=False) + "\n"
+
+def _estado_trabajo(job_id: int) -> dict:
+    db = SessionLocal()
+    try:
+        job = obtener_trabajo(db, job_id)
+        return job_a_dict(job) if job else None
+    finally:
+        db.close()
+
+async def _stream_eventos(job_id: int, primer_evento: dict = None):
+    """
+    Reenviar los eventos del trabajo a medida que llegan, terminando con el
+    evento "fin". Si el trabajo corre en otro proceso (sin eventos en este
+    bus) se informa el progreso y el final leyendo la tabla sync_jobs.
+    """
+    cola = bus_eventos.suscribir(job_id)
+    try:
+        if primer_evento:
+            yield _linea(primer_evento)
+        ultima_consulta = ultimo_envio = time.monotonic()
+        while True:
+            try:
+                evento = cola.get_nowait()
+            except queue.Empty:
+                ahora = time.monotonic()
+                if ahora - ultima_consulta >= 2:
+                    ultima_consulta = ahora
+                    estado = await run_in_threadpool(_estado_trabajo, job_id)
+                    if estado is None or estado["estado"] in ("completado", "error"):
+                        yield _linea({
+                            "evento": "fin",
+                            "job_id": job_id,
+                            "estado": estado["estado"] if estado else "desconocido",
+                            "error": estado["error"] if estado else "Trabajo no encontrado",
+                            "resultado": estado["resultado"] if estado else None
+                        })
+                        return
+                    if ahora - ultimo_envio >= 15:
+                        # Latido con el progreso acumulado (mantiene viva la conexión)
+                        ultimo_envio = ahora
+                        yield _linea({"evento": "progreso", "job_id": job_id, **estado["progreso"]})
+                await asyncio.sleep(0.2)
+                continue
+            ultimo_envio = time.monotonic()
+            yield _linea(evento)
+            if evento["evento"] == "fin":
+                return
+    finally:
+        bus_eventos.desuscribir(job_id, cola)
+
+@router.get("/jobs/{job_id}/eventos")
+def eventos_trabajo_sync(
+    job_id: int,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    📡 EVENTOS DE UN TRABAJO DE SINCRONIZACIÓN (NDJSON)
+    Un evento por etapa y por factura: email_obtenido, pdf_descargado,
+    pdf_procesado, grafico_extraido, historico_guardado... y "fin" con el resultado
+    """
+    job = obtener_trabajo(db, job_id)
+    if not job or job.user_id != current_user.id:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return StreamingResponse(_stream_eventos(job_id), media_type="application/x-ndjson")
+
+@router.post("/sync_stream_con_jwt")
+def sync_stream_con_jwt(
+    max_emails: Optional[int] = Query(default=10, description="Número máximo de emails a procesar (1-50)"),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    📡 SINCRONIZACIÓN CON PROGRESO EN STREAMING (NDJSON)
+    Encola la sincronización (o se une a la que ya está en curso) y devuelve
+    los eventos a medida que se procesan las facturas
+    """
+    if max_emails < 1 or max_emails > 50:
+        raise HTTPException(status_code=400, detail="max_emails debe estar entre 1 y 50")
+    if not current_user.gmail_token:
+        raise HTTPException(status_code=400, detail="No tienes token de Gmail guardado")
+
+    job, unido = cola_trabajos.encolar(current_user.id, "sync_con_jwt", {"max_emails": max_emails})
+    primer_evento = {
+        "evento": "encolado",
+        "job_id": job.id,
+        "unido_a_trabajo_en_curso": unido,
+        "max_emails": max_emails
+    }
+    return StreamingResponse(_stream_eventos(job.id, primer_evento), media_type="application/x-ndjson")
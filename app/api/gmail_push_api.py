@@ -0,0 +1,95 @@
+import hmac
+import logging
+from fastapi import APIRouter, Body, Depends, Query, HTTPException
+from sqlalchemy.orm import Session
+from app.db.session import get_db
+from app.services.auth import get_current_user
+from app.models.user_model import User
+from app.services.gmail_push import AvisoInvalido, decodificar_aviso, procesar_aviso, registrar_watch, obtener_watch
+from app.config.notifications_config import GMAIL_PUSH_CONFIG
+from typing import Any, Dict
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+def _verificar_push_habilitado():
+    if not GMAIL_PUSH_CONFIG["habilitado"]:
+        raise HTTPException(status_code=404, detail="El modo push de Gmail no está habilitado")
+
+@router.post("/push")
+def recibir_aviso_gmail(
+    cuerpo: Dict[str, Any] = Body(...),
+    token: str = Query(default="", description="Secreto configurado en la suscripción push")
+):
+    """
+    Webhook de la suscripción push de Pub/Sub con los avisos de users.watch
+
+    Responde 2xx para confirmar el aviso; ante un error inesperado responde
+    500 y Pub/Sub lo vuelve a entregar. Sin GMAIL_PUSH_TOKEN configurado no
+    acepta ningún aviso: cualquiera podría encolar trabajo para cualquier email.
+    """
+    _verificar_push_habilitado()
+    esperado = GMAIL_PUSH_CONFIG["token_webhook"]
+    if not esperado:
+        logger.error("Aviso de Gmail rechazado: GMAIL_PUSH_TOKEN no está configurado")
+        raise HTTPException(status_code=503, detail="Webhook de Gmail sin token configurado")
+    if not hmac.compare_digest(token, esperado):
+        raise HTTPException(status_code=403, detail="Token de webhook inválido")
+
+    try:
+        email, history_id = decodificar_aviso(cuerpo)
+    except AvisoInvalido as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        return procesar_aviso(email, history_id)
+    except Exception as e:
+        logger.error(f"Error procesando aviso de Gmail para {email}: {e}")
+        raise HTTPException(status_code=500, detail=f"Error procesando aviso: {str(e)}")
+
+@router.post("/watch_con_jwt")
+def registrar_watch_con_jwt(
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    Registrar (o renovar) el watch de Gmail del usuario actual
+    """
+    _verificar_push_habilitado()
+    if not current_user.gmail_refresh_token:
+        return {
+            "error": "No tienes refresh token de Gmail guardado",
+            "solucion": "Primero debes autorizar el acceso a Gmail",
+            "user_email": current_user.email
+        }
+    try:
+        watch = registrar_watch(current_user, db)
+        return {
+            "user_email": current_user.email,
+            "history_id": watch.history_id,
+            "expiracion": watch.expiracion.isoformat()
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error registrando watch de Gmail: {str(e)}")
+
+@router.get("/watch_con_jwt")
+def estado_watch_con_jwt(
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    Estado del watch de Gmail del usuario actual
+    """
+    watch = obtener_watch(db, current_user.id)
+    if watch is None:
+        return {"user_email": current_user.email, "registrado": False}
+    return {
+        "user_email": current_user.email,
+        "registrado": True,
+        "history_id": watch.history_id,
+        "expiracion": watch.expiracion.isoformat() if watch.expiracion else None,
+        "ultima_notificacion": watch.ultima_notificacion.isoformat() if watch.ultima_notificacion else None,
+        "notificaciones": watch.notificaciones or 0,
+        "encolados": watch.encolados or 0
+    }
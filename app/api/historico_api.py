@@ -5,6 +5,7 @@ from app.models.historico_model import HistoricoConsumo
 from app.models.factura_model import Factura
 from app.services.auth import get_current_user
 from app.models.user_model import User
+from app.services.modelo import actualizar_anomalias
 from typing import Optional
 
 router = APIRouter()
@@ -888,6 +889,16 @@ def historico_periodo_personalizado(
             "fechas_parametro": fechas
         }
 
+def _recalcular_anomalias(db: Session, user_id: int, nic: str, registro_id: int) -> bool:
+    """Actualizar los resultados de anomalías del NIC tras cambiar un registro"""
+    try:
+        actualizar_anomalias(db, user_id, nic, [registro_id])
+        return True
+    except Exception as e:
+        db.rollback()
+        print(f"[!] Error actualizando anomalías del NIC {nic}: {e}")
+        return False
+
 # ENDPOINT PARA AGREGAR HISTÓRICO MANUALMENTE CON VALIDACIÓN
 @router.post("/agregar_registro")
 def agregar_registro_historico(
@@ -1007,6 +1018,9 @@ def agregar_registro_historico(
         db.commit()
         db.refresh(nuevo_registro)
         
+        # Los resultados de anomalías guardados del NIC dependen del histórico
+        anomalias_recalculadas = _recalcular_anomalias(db, current_user.id, nic, nuevo_registro.id)
+        
         return {
             "mensaje": f"Registro agregado exitosamente para {clave_nueva}",
             "registro": {
@@ -1020,7 +1034,8 @@ def agregar_registro_historico(
             "usuario": current_user.email,
             "registro_creado": True,
             "validacion": f"No se encontraron duplicados para {clave_nueva}",
-            "formato_usado": "corto_consistente_con_extractor"
+            "formato_usado": "corto_consistente_con_extractor",
+            "anomalias_recalculadas": anomalias_recalculadas
         }
         
     except Exception as e:
@@ -1066,6 +1081,10 @@ def actualizar_registro_historico(
         db.commit()
         db.refresh(registro)
         
+        # Un registro editado cambia la huella del histórico: se recalcula el NIC entero
+        factura = db.query(Factura).filter(Factura.id == registro.factura_id).first()
+        anomalias_recalculadas = _recalcular_anomalias(db, current_user.id, factura.nic, registro.id)
+        
         return {
             "mensaje": "Registro actualizado exitosamente",
             "registro": {
@@ -1076,7 +1095,8 @@ def actualizar_registro_historico(
                 "diferencia": float(registro.consumo_kwh) - consumo_anterior
             },
             "usuario": current_user.email,
-            "registro_actualizado": True
+            "registro_actualizado": True,
+            "anomalias_recalculadas": anomalias_recalculadas
         }
         
     except Exception as e:
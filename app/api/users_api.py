@@ -83,6 +83,11 @@ def eliminar_usuario(
         # Importar modelos necesarios
         from app.models.factura_model import Factura
         from app.models.historico_model import HistoricoConsumo
+        from app.models.anomalia_model import AnomaliaResultado, AnomaliaVersion
+        
+        # Eliminar resultados de anomalías calculados sobre ese histórico
+        db.query(AnomaliaResultado).filter(AnomaliaResultado.user_id == user_id).delete()
+        db.query(AnomaliaVersion).filter(AnomaliaVersion.user_id == user_id).delete()
         
         # Eliminar histórico de consumo relacionado con las facturas del usuario
         facturas_usuario = db.query(Factura).filter(Factura.user_id == user_id).all()
@@ -126,6 +131,11 @@ def eliminar_mi_cuenta(
     try:
         from app.models.factura_model import Factura
         from app.models.historico_model import HistoricoConsumo
+        from app.models.anomalia_model import AnomaliaResultado, AnomaliaVersion
+        
+        # Eliminar resultados de anomalías
+        db.query(AnomaliaResultado).filter(AnomaliaResultado.user_id == current_user.id).delete()
+        db.query(AnomaliaVersion).filter(AnomaliaVersion.user_id == current_user.id).delete()
         
         # Eliminar histórico de consumo
         facturas_usuario = db.query(Factura).filter(Factura.user_id == current_user.id).all()
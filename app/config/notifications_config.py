@@ -26,6 +26,13 @@ GMAIL_CONFIG = {
     "rate_limit_delay": int(os.getenv("RATE_LIMIT_DELAY", 1))  # Del .env
 }
 
+# Configuración del gestor de access tokens de Gmail
+TOKENS_GMAIL_CONFIG = {
+    "margen_renovacion_segundos": int(os.getenv("GMAIL_TOKEN_MARGEN_SEGUNDOS", 300)),  # Renovar antes de vencer
+    "max_servicios_cacheados": int(os.getenv("GMAIL_MAX_SERVICIOS_CACHEADOS", 256)),  # Clientes de Gmail ya construidos
+    "guardado_segundos": float(os.getenv("GMAIL_TOKEN_GUARDADO_SEGUNDOS", 5))  # Espera para guardar tokens juntos
+}
+
 # Configuración de detección de anomalías
 ANOMALY_CONFIG = {
     "min_score_threshold": float(os.getenv("ANOMALY_CONTAMINATION_RATE", -0.5)),  # Compatible con .env
@@ -36,6 +43,9 @@ ANOMALY_CONFIG = {
     "iqr_multiplier": int(os.getenv("IQR_MULTIPLIER", 3)),  # Del .env
     "std_deviation_threshold": int(os.getenv("STD_DEVIATION_THRESHOLD", 4)),  # Del .env
     "min_historical_data": 3,  # Mínimo de datos históricos para comparar
+    "usar_isolation_forest": os.getenv("ANOMALY_USAR_ISOLATION_FOREST", "true").lower() == "true",  # Regla del modelo
+    "memoria_cache_modelos_mb": float(os.getenv("ANOMALY_CACHE_MODELOS_MB", 64)),  # Forests entrenados en memoria (LRU)
+    "directorio_cache_modelos": os.getenv("ANOMALY_CACHE_MODELOS_DIR", ""),  # Persistir con joblib (vacío: solo memoria)
     "alert_cooldown_hours": 24  # Horas entre alertas para el mismo NIC
 }
 
@@ -48,6 +58,80 @@ MONITORING_CONFIG = {
     "timeout_per_user_seconds": int(os.getenv("TIMEOUT_PER_USER_SECONDS", 300))  # Del .env
 }
 
+# Configuración de sincronización de facturas
+SYNC_CONFIG = {
+    "max_descargas_concurrentes": int(os.getenv("MAX_DESCARGAS_CONCURRENTES", 4)),  # Descargas simultáneas por sync
+    "max_descargas_por_host": int(os.getenv("MAX_DESCARGAS_POR_HOST", 2)),  # Descargas simultáneas contra EDEMSA en todo el proceso
+    "timeout_descarga_segundos": int(os.getenv("TIMEOUT_DESCARGA_SEGUNDOS", 120))  # Timeout por factura
+}
+
+# Configuración del programador periódico del servicio de notificaciones
+PROGRAMADOR_CONFIG = {
+    "habilitado": os.getenv("PROGRAMADOR_HABILITADO", "false").lower() == "true",  # Arrancar con la API
+    "intervalo_minutos": float(os.getenv("MONITORING_FREQUENCY_MINUTES", 30)),  # Rondas alineadas al reloj
+    "jitter_segundos": float(os.getenv("PROGRAMADOR_JITTER_SEGUNDOS", 60)),  # Demora aleatoria de cada ronda
+    "lease_segundos": float(os.getenv("PROGRAMADOR_LEASE_SEGUNDOS", 120)),  # Se renueva mientras la ronda corre
+    "fraccion_escalonado": 0.8  # Parte del intervalo en la que se reparten los usuarios
+}
+
+# Configuración del modo push de Gmail (users.watch + suscripción push de Pub/Sub)
+GMAIL_PUSH_CONFIG = {
+    "habilitado": os.getenv("GMAIL_PUSH_HABILITADO", "false").lower() == "true",
+    "topic": os.getenv("GMAIL_PUSH_TOPIC", ""),  # projects/<proyecto>/topics/<topic>
+    "token_webhook": os.getenv("GMAIL_PUSH_TOKEN", ""),  # Secreto que la suscripción envía en ?token=
+    "label_ids": ["INBOX"],
+    "renovar_antes_horas": float(os.getenv("GMAIL_PUSH_RENOVAR_ANTES_HORAS", 24)),  # Los watch vencen a los 7 días
+    "verificar_historial": os.getenv("GMAIL_PUSH_VERIFICAR_HISTORIAL", "true").lower() == "true"  # false: encolar sin consultar Gmail (stub local)
+}
+
+# Configuración de la cola de trabajos de sincronización
+TRABAJOS_CONFIG = {
+    "workers": int(os.getenv("SYNC_JOB_WORKERS", 2)),  # Sincronizaciones ejecutándose a la vez
+    "intentos_maximos": int(os.getenv("SYNC_JOB_INTENTOS", 3)),  # Reintentos de un trabajo interrumpido
+    "poll_segundos": float(os.getenv("SYNC_JOB_POLL_SEGUNDOS", 5)),  # Espera entre consultas a la cola
+    "latido_segundos": float(os.getenv("SYNC_JOB_LATIDO_SEGUNDOS", 15)),  # Cada cuánto se marcan vivos los trabajos en curso
+    "latido_vencido_segundos": float(os.getenv("SYNC_JOB_LATIDO_VENCIDO_SEGUNDOS", 120))  # Sin latido por este tiempo: proceso muerto
+}
+
+# Configuración del pool de navegadores (Playwright)
+NAVEGADOR_CONFIG = {
+    "tamano_pool": int(os.getenv("NAVEGADOR_POOL_SIZE", 2)),  # Procesos de Chromium calientes
+    "usos_maximos": int(os.getenv("NAVEGADOR_USOS_MAXIMOS", 50)),  # Reciclar cada navegador tras K usos
+    "headless": os.getenv("NAVEGADOR_HEADLESS", "true").lower() == "true",
+    "timeout_tarea_segundos": int(os.getenv("NAVEGADOR_TIMEOUT_TAREA", 120))
+}
+
+# Configuración de descargas HTTP desde EDEMSA
+EDEMSA_CONFIG = {
+    "ttl_cookies_segundos": int(os.getenv("EDEMSA_COOKIES_TTL_SEGUNDOS", 900)),  # Vigencia de cookies cacheadas
+    "pool_conexiones": int(os.getenv("EDEMSA_POOL_CONEXIONES", 10)),
+    "timeout_http_segundos": int(os.getenv("EDEMSA_TIMEOUT_HTTP", 60))
+}
+
+# Configuración del almacén de PDFs e imágenes (direccionado por sha256)
+BLOB_CONFIG = {
+    "directorio": os.getenv("BLOB_STORE_DIR", "blobs")
+}
+
+# Configuración del recorte del gráfico histórico
+GRAFICO_CONFIG = {
+    "ancho_px": int(os.getenv("GRAFICO_ANCHO_PX", 1024)),  # Ancho de la imagen enviada al modelo de visión
+    "margen_puntos": float(os.getenv("GRAFICO_MARGEN_PUNTOS", 20)),  # Margen donde se buscan ejes y etiquetas
+    "min_barras": 3  # Mínimo de barras con la misma base para reconocer el gráfico
+}
+
+# Configuración del análisis de gráficos con Gemini
+GEMINI_CONFIG = {
+    "ttl_cache_dias": int(os.getenv("GEMINI_CACHE_TTL_DIAS", 180)),  # Vigencia de los resultados cacheados
+    "max_concurrentes": int(os.getenv("GEMINI_MAX_CONCURRENTES", 4)),  # Llamadas simultáneas al modelo
+    "solicitudes_por_minuto": float(os.getenv("GEMINI_SOLICITUDES_POR_MINUTO", 60)),  # Token bucket
+    "reintentos": int(os.getenv("GEMINI_REINTENTOS", 4)),  # Reintentos ante errores transitorios
+    "backoff_base_segundos": float(os.getenv("GEMINI_BACKOFF_BASE", 1)),
+    "backoff_max_segundos": float(os.getenv("GEMINI_BACKOFF_MAX", 30)),
+    "timeout_segundos": float(os.getenv("GEMINI_TIMEOUT", 60)),  # Timeout por llamada
+    "api_endpoint": os.getenv("GEMINI_API_ENDPOINT")  # Ej. http://localhost:8089 para el servidor falso
+}
+
 # Configuración de logging
 LOGGING_CONFIG = {
     "level": "INFO",
@@ -85,8 +169,18 @@ def get_config() -> Dict[str, Any]:
     return {
         "google_oauth": GOOGLE_OAUTH_CONFIG,
         "gmail": GMAIL_CONFIG,
+        "tokens_gmail": TOKENS_GMAIL_CONFIG,
         "anomaly": ANOMALY_CONFIG,
         "monitoring": MONITORING_CONFIG,
+        "sync": SYNC_CONFIG,
+        "navegador": NAVEGADOR_CONFIG,
+        "edemsa": EDEMSA_CONFIG,
+        "blobs": BLOB_CONFIG,
+        "grafico": GRAFICO_CONFIG,
+        "gemini": GEMINI_CONFIG,
+        "trabajos": TRABAJOS_CONFIG,
+        "programador": PROGRAMADOR_CONFIG,
+        "gmail_push": GMAIL_PUSH_CONFIG,
         "logging": LOGGING_CONFIG,
         "email_templates": EMAIL_TEMPLATES,
         "api_limits": API_LIMITS
@@ -120,6 +214,13 @@ def validate_config() -> Dict[str, Any]:
     if MONITORING_CONFIG["default_interval_hours"] < 1:
         warnings.append("Intervalo de monitoreo muy frecuente, puede agotar límites de API")
     
+    # Verificar modo push de Gmail
+    if GMAIL_PUSH_CONFIG["habilitado"] and not GMAIL_PUSH_CONFIG["topic"]:
+        issues.append("GMAIL_PUSH_HABILITADO activo sin GMAIL_PUSH_TOPIC configurado")
+    
+    if GMAIL_PUSH_CONFIG["habilitado"] and not GMAIL_PUSH_CONFIG["token_webhook"]:
+        issues.append("GMAIL_PUSH_HABILITADO activo sin GMAIL_PUSH_TOKEN: el webhook rechaza todos los avisos")
+    
     return {
         "valid": len(issues) == 0,
         "issues": issues,
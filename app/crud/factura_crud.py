@@ -1,5 +1,35 @@
+import hashlib
+from typing import Iterable, Optional, Set
 from sqlalchemy.orm import Session
 from app.models.factura_model import Factura
 
 def get_facturas(db: Session):
-    return db.query(Factura).all()
\ No newline at end of file
+    return db.query(Factura).all()
+
+def hash_link(link: str) -> str:
+    """Hash estable del link de EDEMSA usado para deduplicar antes de descargar"""
+    return hashlib.sha256(link.encode("utf-8")).hexdigest()
+
+def get_factura_por_link(db: Session, user_id: int, link: str) -> Optional[Factura]:
+    return db.query(Factura).filter(
+        Factura.user_id == user_id,
+        Factura.link_hash == hash_link(link)
+    ).first()
+
+def get_factura_por_lectura(db: Session, user_id: int, nic: str, fecha_lectura: str) -> Optional[Factura]:
+    return db.query(Factura).filter(
+        Factura.user_id == user_id,
+        Factura.nic == nic,
+        Factura.fecha_lectura == fecha_lectura
+    ).first()
+
+def links_ya_descargados(db: Session, user_id: int, links: Iterable[str]) -> Set[str]:
+    """Devolver los links que ya tienen factura para el usuario (una sola consulta)"""
+    por_hash = {hash_link(link): link for link in links}
+    if not por_hash:
+        return set()
+    filas = db.query(Factura.link_hash).filter(
+        Factura.user_id == user_id,
+        Factura.link_hash.in_(list(por_hash))
+    ).all()
+    return {por_hash[h] for (h,) in filas}
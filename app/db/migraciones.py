@@ -0,0 +1,152 @@
+"""
+Migraciones idempotentes del esquema de SQLite
+
+create_all crea las tablas que faltan pero no agrega columnas ni índices a
+las que ya existen. Estas migraciones completan el esquema de una base ya
+desplegada; se corren al iniciar (init_db_if_not_exists) y desde
+migrate_db.py. Cada una revisa antes qué falta, así que correrlas de nuevo
+no cambia nada.
+"""
+import json
+import hashlib
+
+from app.models.sync_job_model import clave_trabajo
+
+
+def migrar_deduplicacion(cursor):
+    """
+    Agregar link_hash/pdf_sha256 a facturas y los índices únicos de deduplicación
+    """
+    cursor.execute("PRAGMA table_info(facturas)")
+    factura_columns = [column[1] for column in cursor.fetchall()]
+    
+    if 'link_hash' not in factura_columns:
+        print("🔄 Agregando columna link_hash a facturas...")
+        cursor.execute('ALTER TABLE facturas ADD COLUMN link_hash VARCHAR')
+    
+    if 'pdf_sha256' not in factura_columns:
+        print("🔄 Agregando columna pdf_sha256 a facturas...")
+        cursor.execute('ALTER TABLE facturas ADD COLUMN pdf_sha256 VARCHAR')
+    
+    # Completar hashes faltantes
+    cursor.execute("SELECT id, link FROM facturas WHERE link_hash IS NULL AND link IS NOT NULL")
+    filas = cursor.fetchall()
+    for factura_id, link in filas:
+        cursor.execute(
+            'UPDATE facturas SET link_hash = ? WHERE id = ?',
+            (hashlib.sha256(link.encode("utf-8")).hexdigest(), factura_id)
+        )
+    if filas:
+        print(f"✅ link_hash calculado para {len(filas)} facturas")
+    
+    # Las lecturas vacías pasan a NULL para no chocar con el índice único
+    cursor.execute("UPDATE facturas SET fecha_lectura = NULL WHERE fecha_lectura = ''")
+    cursor.execute("UPDATE facturas SET nic = NULL WHERE nic = ''")
+    
+    indices = [
+        ("ix_facturas_user_nic_fecha", "user_id, nic, fecha_lectura"),
+        ("ix_facturas_user_link_hash", "user_id, link_hash"),
+    ]
+    for nombre, columnas in indices:
+        cursor.execute(f"""
+            SELECT COUNT(*) FROM (
+                SELECT 1 FROM facturas
+                WHERE {' AND '.join(f'{c.strip()} IS NOT NULL' for c in columnas.split(','))}
+                GROUP BY {columnas} HAVING COUNT(*) > 1
+            )
+        """)
+        duplicados = cursor.fetchone()[0]
+        if duplicados:
+            print(f"⚠️ No se creó {nombre}: hay {duplicados} grupos de facturas duplicadas ({columnas})")
+            continue
+        cursor.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS {nombre} ON facturas ({columnas})')
+        print(f"✅ Índice único {nombre} disponible")
+
+def migrar_trabajos_activos(cursor):
+    """
+    Columna clave de sync_jobs e índice único parcial: un solo trabajo activo
+    por usuario y clave (reemplaza al índice de uno por usuario)
+    """
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='sync_jobs'")
+    if not cursor.fetchone():
+        return  # La tabla se crea completa con create_all
+    
+    cursor.execute("PRAGMA table_info(sync_jobs)")
+    columnas = [column[1] for column in cursor.fetchall()]
+    if 'clave' not in columnas:
+        print("🔄 Agregando columna clave a sync_jobs...")
+        cursor.execute('ALTER TABLE sync_jobs ADD COLUMN clave VARCHAR')
+    
+    # Completar la clave de los trabajos activos (las terminadas no participan del índice)
+    cursor.execute("SELECT id, tipo, parametros FROM sync_jobs WHERE clave IS NULL AND estado IN ('pendiente', 'en_curso')")
+    for job_id, tipo, parametros in cursor.fetchall():
+        clave = clave_trabajo(tipo, json.loads(parametros) if parametros else {})
+        cursor.execute('UPDATE sync_jobs SET clave = ? WHERE id = ?', (clave, job_id))
+    
+    # Dejar activo solo el trabajo más reciente de cada usuario y clave
+    cursor.execute("""
+        UPDATE sync_jobs SET estado = 'error', error = 'Trabajo duplicado descartado en la migración'
+        WHERE estado IN ('pendiente', 'en_curso')
+        AND id NOT IN (
+            SELECT MAX(id) FROM sync_jobs
+            WHERE estado IN ('pendiente', 'en_curso')
+            GROUP BY user_id, clave
+        )
+    """)
+    if cursor.rowcount:
+        print(f"⚠️ {cursor.rowcount} trabajos de sincronización duplicados marcados como error")
+    cursor.execute("DROP INDEX IF EXISTS ix_sync_jobs_usuario_activo")
+    cursor.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS ix_sync_jobs_clave_activa
+        ON sync_jobs (user_id, clave) WHERE estado IN ('pendiente', 'en_curso')
+    """)
+    print("✅ Índice único ix_sync_jobs_clave_activa disponible")
+
+def migrar_latido_trabajos(cursor):
+    """
+    Columnas worker_id/heartbeat_at de sync_jobs: solo se recuperan los
+    trabajos en curso cuyo proceso dejó de latir
+    """
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='sync_jobs'")
+    if not cursor.fetchone():
+        return  # La tabla se crea completa con create_all
+    
+    cursor.execute("PRAGMA table_info(sync_jobs)")
+    columnas = [column[1] for column in cursor.fetchall()]
+    if 'worker_id' not in columnas:
+        print("🔄 Agregando columna worker_id a sync_jobs...")
+        cursor.execute('ALTER TABLE sync_jobs ADD COLUMN worker_id VARCHAR')
+    if 'heartbeat_at' not in columnas:
+        print("🔄 Agregando columna heartbeat_at a sync_jobs...")
+        cursor.execute('ALTER TABLE sync_jobs ADD COLUMN heartbeat_at DATETIME')
+    print("✅ Latido de sync_jobs disponible")
+
+def migrar_huella_anomalias(cursor):
+    """
+    Columna huella de anomalia_version: los NICs sin huella se recalculan
+    enteros en la próxima actualización
+    """
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='anomalia_version'")
+    if not cursor.fetchone():
+        return  # La tabla se crea completa con create_all
+    
+    cursor.execute("PRAGMA table_info(anomalia_version)")
+    columnas = [column[1] for column in cursor.fetchall()]
+    if 'huella' not in columnas:
+        print("🔄 Agregando columna huella a anomalia_version...")
+        cursor.execute('ALTER TABLE anomalia_version ADD COLUMN huella VARCHAR')
+    print("✅ Columna huella de anomalia_version disponible")
+
+
+MIGRACIONES = [
+    migrar_deduplicacion,
+    migrar_trabajos_activos,
+    migrar_latido_trabajos,
+    migrar_huella_anomalias,
+]
+
+
+def migrar_esquema(cursor):
+    """Correr todas las migraciones con un cursor de sqlite3"""
+    for migracion in MIGRACIONES:
+        migracion(cursor)
@@ -5,7 +5,7 @@ import os
 load_dotenv()
 
 from fastapi import FastAPI
-from app.api import factura_api, auth_api, historico_api, anomalias_api, users_api
+from app.api import factura_api, auth_api, historico_api, anomalias_api, users_api, gmail_push_api
 
 app = FastAPI(title="E-Consumo API")
 
@@ -15,4 +15,33 @@ app.include_router(auth_api.router, prefix="/auth", tags=["Autenticacion"])
 app.include_router(historico_api.router, prefix="/historico", tags=["Historico"])
 app.include_router(anomalias_api.router, prefix="/anomalias", tags=["Anomalias"])
 app.include_router(users_api.router, prefix="/users", tags=["Usuarios"])
+app.include_router(gmail_push_api.router, prefix="/gmail", tags=["Gmail"])
 
+from app.services.database import init_db_if_not_exists
+from app.services.navegador import pool_navegadores
+from app.services.trabajos_sync import cola_trabajos
+from app.services.programador import programador_notificaciones
+from app.services.tokens_gmail import gestor_tokens
+from app.config.notifications_config import PROGRAMADOR_CONFIG
+
+@app.on_event("startup")
+def inicializar_base_de_datos():
+    # Crear la base y las tablas nuevas que falten, y migrar columnas e índices de las existentes.
+    # Sin el esquema al día cualquier consulta a facturas falla: mejor no arrancar
+    if not init_db_if_not_exists():
+        raise RuntimeError("No se pudo inicializar o migrar la base de datos (ver el error anterior)")
+    # Retomar los trabajos de sincronización pendientes
+    cola_trabajos.iniciar()
+    # Barrido periódico de notificaciones (el lease evita duplicados entre instancias)
+    if PROGRAMADOR_CONFIG["habilitado"]:
+        programador_notificaciones.iniciar()
+
+@app.on_event("shutdown")
+def cerrar_pool_navegadores():
+    # Los trabajos en curso quedan en la base y se retoman al reiniciar
+    cola_trabajos.cerrar()
+    programador_notificaciones.detener()
+    # Guardar los access tokens renovados que falten escribir
+    gestor_tokens.cerrar()
+    # Cerrar los procesos de Chromium del pool al apagar la API
+    pool_navegadores.cerrar()
@@ -0,0 +1,44 @@
+from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Index, UniqueConstraint
+from datetime import datetime
+from app.db.base import Base
+
+class AnomaliaResultado(Base):
+    """Resultado de la detección de anomalías para un registro del histórico"""
+    __tablename__ = "anomalia_resultado"
+    __table_args__ = (
+        Index("ix_anomalia_resultado_user_nic", "user_id", "nic", "trimestre"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    nic = Column(String, nullable=False)
+    historico_id = Column(Integer, ForeignKey("historico_consumo.id"), unique=True, nullable=False)
+    factura_id = Column(Integer, ForeignKey("facturas.id"))
+    fecha = Column(DateTime)
+    consumo_kwh = Column(Float)
+    trimestre = Column(String)  # "2024Q1"
+    anio = Column(Integer)
+    anomalia = Column(Integer)  # -1 anomalía, 1 normal
+    score = Column(Float)
+    comparado_trimestre = Column(Float)
+    promedio_historico = Column(Float)
+    std_historico = Column(Float)
+    variacion_abs = Column(Float)
+    version = Column(Integer)  # Versión de los datos del NIC con la que se calculó
+    calculado_at = Column(DateTime, default=datetime.utcnow)
+
+class AnomaliaVersion(Base):
+    """Versión de los datos de un NIC: marca que sus resultados ya están calculados"""
+    __tablename__ = "anomalia_version"
+    __table_args__ = (
+        UniqueConstraint("user_id", "nic", name="uq_anomalia_version_user_nic"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    nic = Column(String, nullable=False)
+    version = Column(Integer, default=0)  # Se incrementa con cada recálculo
+    registros = Column(Integer, default=0)  # Registros de histórico con los que se calculó
+    huella = Column(String)  # Hash del contenido del histórico con el que se calculó
+    ultimo_historico_id = Column(Integer)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
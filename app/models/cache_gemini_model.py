@@ -0,0 +1,16 @@
+from sqlalchemy import Column, Integer, String, Text, DateTime, Index
+from datetime import datetime
+from app.db.base import Base
+
+class CacheGemini(Base):
+    """Resultados de Gemini por imagen de gráfico y versión del prompt"""
+    __tablename__ = "cache_gemini"
+    __table_args__ = (
+        Index("ix_cache_gemini_imagen_version", "imagen_sha256", "version_prompt", unique=True),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    imagen_sha256 = Column(String, nullable=False)
+    version_prompt = Column(String, nullable=False, index=True)
+    resultado = Column(Text, nullable=False)  # JSON con las filas fecha/consumo_wh
+    created_at = Column(DateTime, default=datetime.utcnow)
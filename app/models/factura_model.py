@@ -1,9 +1,14 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, Index
 from sqlalchemy.orm import relationship
 from app.db.base import Base
 
 class Factura(Base):
     __tablename__ = "facturas"
+    __table_args__ = (
+        # Deduplicación: una factura por lectura y un link por usuario
+        Index("ix_facturas_user_nic_fecha", "user_id", "nic", "fecha_lectura", unique=True),
+        Index("ix_facturas_user_link_hash", "user_id", "link_hash", unique=True),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     nic = Column(String, index=True)
@@ -11,8 +16,10 @@ class Factura(Base):
     fecha_lectura = Column(String)
     consumo_kwh = Column(Float)
     link = Column(String)
-    imagen = Column(String)
+    link_hash = Column(String)  # sha256 del link de EDEMSA
+    pdf_sha256 = Column(String)  # PDF en el almacén de blobs
+    imagen = Column(String)  # sha256 del PNG del gráfico en el almacén de blobs
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     
     # Relación con usuario
-    user = relationship("User", back_populates="facturas")
\ No newline at end of file
+    user = relationship("User", back_populates="facturas")
@@ -0,0 +1,18 @@
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey
+from datetime import datetime
+from app.db.base import Base
+
+class GmailWatch(Base):
+    """Suscripción push (users.watch) de la casilla de Gmail de un usuario"""
+    __tablename__ = "gmail_watch"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), unique=True, index=True, nullable=False)
+    email = Column(String, index=True)  # emailAddress que llega en los avisos
+    history_id = Column(String)  # Último historyId de Gmail ya revisado
+    expiracion = Column(DateTime)  # Vencimiento del watch (Gmail lo da de baja a los 7 días)
+    ultima_notificacion = Column(DateTime)
+    notificaciones = Column(Integer, default=0)  # Avisos recibidos
+    encolados = Column(Integer, default=0)  # Avisos que terminaron en un procesamiento
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
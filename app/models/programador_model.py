@@ -0,0 +1,16 @@
+from sqlalchemy import Column, Integer, String, Text, DateTime
+from app.db.base import Base
+
+class EstadoProgramador(Base):
+    """Lease y última ejecución de una tarea periódica (una fila por tarea)"""
+    __tablename__ = "programador_estado"
+
+    id = Column(Integer, primary_key=True, index=True)
+    nombre = Column(String, unique=True, nullable=False)  # Ej. "notificaciones"
+    duenio = Column(String)  # Instancia que tiene el lease (host:pid:id)
+    lease_hasta = Column(DateTime)
+    ultima_ejecucion_inicio = Column(DateTime)
+    ultima_ejecucion_fin = Column(DateTime)
+    ultimo_resultado = Column(Text)  # JSON con el resumen del último barrido
+    proxima_ejecucion = Column(DateTime)
+    ejecuciones = Column(Integer, default=0)
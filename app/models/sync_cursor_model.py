@@ -0,0 +1,14 @@
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey
+from datetime import datetime
+from app.db.base import Base
+
+class SyncCursor(Base):
+    """Marca de agua de la última sincronización de Gmail por usuario"""
+    __tablename__ = "sync_cursor"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), unique=True, index=True, nullable=False)
+    history_id = Column(String)  # historyId de Gmail del último mensaje procesado
+    ultimo_mensaje_id = Column(String)
+    ultima_fecha_interna = Column(Integer)  # internalDate de Gmail (ms desde epoch)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
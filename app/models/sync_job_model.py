@@ -0,0 +1,50 @@
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Index, text
+import json
+from datetime import datetime
+from typing import Any, Dict
+from app.db.base import Base
+
+# Parámetros que no cambian lo que hace el trabajo (no separan pedidos)
+PARAMETROS_INFORMATIVOS = {"notificaciones": {"origen", "history_id"}}
+
+def clave_trabajo(tipo: str, parametros: Dict[str, Any]) -> str:
+    """Clave de deduplicación: dos pedidos del mismo usuario se unen solo si coincide"""
+    ignorados = PARAMETROS_INFORMATIVOS.get(tipo, set())
+    relevantes = {k: v for k, v in parametros.items() if k not in ignorados}
+    return f"{tipo}:{json.dumps(relevantes, sort_keys=True, default=str)}"
+
+class SyncJob(Base):
+    """Trabajo de sincronización de facturas ejecutado en segundo plano"""
+    __tablename__ = "sync_jobs"
+    __table_args__ = (
+        # Single-flight: a lo sumo un trabajo activo por usuario y clave (tipo + parámetros)
+        Index(
+            "ix_sync_jobs_clave_activa", "user_id", "clave", unique=True,
+            sqlite_where=text("estado IN ('pendiente', 'en_curso')"),
+            postgresql_where=text("estado IN ('pendiente', 'en_curso')")
+        ),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    tipo = Column(String, nullable=False)  # sync, sync_con_jwt, sync_inteligente, notificaciones
+    clave = Column(String)  # Tipo + parámetros que cambian el resultado: solo se unen pedidos con la misma
+    parametros = Column(Text)  # JSON con los argumentos del endpoint
+    estado = Column(String, default="pendiente", index=True)  # pendiente, en_curso, completado, error
+    etapa = Column(String)  # Etapa actual (emails, descargas, graficos)
+    intentos = Column(Integer, default=0)
+    worker_id = Column(String)  # Proceso que lo está ejecutando (host:pid:id)
+    heartbeat_at = Column(DateTime)  # Último latido de ese proceso mientras está en curso
+
+    # Progreso
+    emails_listados = Column(Integer, default=0)
+    facturas_encontradas = Column(Integer, default=0)
+    pdfs_descargados = Column(Integer, default=0)
+    graficos_analizados = Column(Integer, default=0)
+
+    resultado = Column(Text)  # JSON con la respuesta final
+    error = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -0,0 +1,63 @@
+"""
+Almacén de archivos direccionado por contenido
+
+Cada archivo se guarda con el sha256 de su contenido como nombre, en
+subdirectorios de dos niveles (ab/cd/abcd...) para no llenar un solo
+directorio. La escritura es atómica: se escribe a un temporal en el mismo
+directorio y se renombra, así dos sincronizaciones concurrentes nunca ven
+un archivo a medio escribir ni se pisan entre sí.
+"""
+import os
+import hashlib
+import tempfile
+
+from app.config.notifications_config import BLOB_CONFIG
+
+
+class AlmacenBlobs:
+    """Almacén de bytes con API get/put/exists por sha256"""
+
+    def __init__(self, raiz: str = None):
+        self.raiz = raiz or BLOB_CONFIG["directorio"]
+
+    @staticmethod
+    def calcular_hash(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def ruta(self, sha256: str) -> str:
+        """Ruta en disco del blob (exista o no)"""
+        return os.path.join(self.raiz, sha256[:2], sha256[2:4], sha256)
+
+    def exists(self, sha256: str) -> bool:
+        return bool(sha256) and os.path.exists(self.ruta(sha256))
+
+    def get(self, sha256: str) -> bytes:
+        """Leer un blob, lanza FileNotFoundError si no existe"""
+        with open(self.ruta(sha256), "rb") as f:
+            return f.read()
+
+    def put(self, data: bytes) -> str:
+        """Guardar bytes y devolver su sha256 (idempotente)"""
+        sha256 = self.calcular_hash(data)
+        destino = self.ruta(sha256)
+        if os.path.exists(destino):
+            return sha256
+
+        directorio = os.path.dirname(destino)
+        os.makedirs(directorio, exist_ok=True)
+        fd, temporal = tempfile.mkstemp(dir=directorio, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporal, destino)
+        except BaseException:
+            if os.path.exists(temporal):
+                os.remove(temporal)
+            raise
+        return sha256
+
+
+# Instancia global del almacén
+almacen_blobs = AlmacenBlobs()
@@ -0,0 +1,122 @@
+"""
+Caché persistente de los análisis de gráficos hechos con Gemini
+
+La clave es el sha256 de la imagen más la versión del prompt, así que al
+cambiar el prompt alcanza con subir PROMPT_VERSION para que los resultados
+viejos dejen de usarse (y pueden borrarse en bloque con invalidar_version).
+"""
+import json
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+import pandas as pd
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app.config.notifications_config import GEMINI_CONFIG
+from app.models.cache_gemini_model import CacheGemini
+from app.services.almacen_blobs import AlmacenBlobs
+from app.services.grafico import PROMPT_VERSION, analizar_con_gemini, cliente_gemini
+
+
+def obtener(db: Session, imagen_sha256: str, version: str = PROMPT_VERSION) -> Optional[pd.DataFrame]:
+    """Devolver el resultado cacheado vigente o None"""
+    limite = datetime.utcnow() - timedelta(days=GEMINI_CONFIG["ttl_cache_dias"])
+    entrada = db.query(CacheGemini).filter(
+        CacheGemini.imagen_sha256 == imagen_sha256,
+        CacheGemini.version_prompt == version,
+        CacheGemini.created_at >= limite
+    ).first()
+    if entrada is None:
+        return None
+    return pd.DataFrame(json.loads(entrada.resultado))
+
+def guardar(db: Session, imagen_sha256: str, df: pd.DataFrame, version: str = PROMPT_VERSION):
+    """Guardar (o reemplazar) el resultado de un análisis"""
+    db.query(CacheGemini).filter(
+        CacheGemini.imagen_sha256 == imagen_sha256,
+        CacheGemini.version_prompt == version
+    ).delete()
+    db.add(CacheGemini(
+        imagen_sha256=imagen_sha256,
+        version_prompt=version,
+        resultado=json.dumps(df.to_dict(orient="records"))
+    ))
+    try:
+        db.commit()
+    except IntegrityError:
+        # Otra sincronización guardó el mismo análisis al mismo tiempo
+        db.rollback()
+
+def invalidar_version(db: Session, version: str = None) -> int:
+    """
+    Borrar en bloque los resultados de una versión del prompt
+
+    Sin versión se borran todas las versiones distintas de la actual.
+    """
+    query = db.query(CacheGemini)
+    if version is None:
+        query = query.filter(CacheGemini.version_prompt != PROMPT_VERSION)
+    else:
+        query = query.filter(CacheGemini.version_prompt == version)
+    borrados = query.delete(synchronize_session=False)
+    db.commit()
+    return borrados
+
+def purgar_expirados(db: Session) -> int:
+    """Borrar los resultados que superaron el TTL"""
+    limite = datetime.utcnow() - timedelta(days=GEMINI_CONFIG["ttl_cache_dias"])
+    borrados = db.query(CacheGemini).filter(CacheGemini.created_at < limite).delete(synchronize_session=False)
+    db.commit()
+    return borrados
+
+def analizar_con_cache(db: Session, png_bytes: bytes) -> Tuple[pd.DataFrame, str]:
+    """
+    Analizar el gráfico consultando primero la caché
+
+    Returns:
+        (DataFrame, origen) donde origen es "cache" o "gemini"
+
+    Raises:
+        ErrorAnalisisGemini: si Gemini falla; los errores nunca se cachean
+    """
+    imagen_sha256 = AlmacenBlobs.calcular_hash(png_bytes)
+    df = obtener(db, imagen_sha256)
+    if df is not None:
+        return df, "cache"
+
+    df = analizar_con_gemini(png_bytes)
+    guardar(db, imagen_sha256, df)
+    return df, "gemini"
+
+def analizar_lote_con_cache(db: Session, imagenes: List[bytes]) -> List[Tuple[Optional[pd.DataFrame], str]]:
+    """
+    Analizar varios gráficos: los cacheados se resuelven sin llamar al modelo y
+    el resto se envía a Gemini en paralelo (imágenes repetidas se analizan una vez)
+
+    Returns:
+        Lista en el mismo orden que `imagenes` con (DataFrame, origen). Si el
+        análisis falló el DataFrame es None y el origen "error".
+    """
+    resultados: List[Tuple[Optional[pd.DataFrame], str]] = [None] * len(imagenes)
+    faltantes = {}  # sha256 -> posiciones
+    for i, png_bytes in enumerate(imagenes):
+        imagen_sha256 = AlmacenBlobs.calcular_hash(png_bytes)
+        df = obtener(db, imagen_sha256)
+        if df is not None:
+            resultados[i] = (df, "cache")
+        else:
+            faltantes.setdefault(imagen_sha256, []).append(i)
+
+    hashes = list(faltantes)
+    respuestas = cliente_gemini.analizar_lote_sync([imagenes[faltantes[h][0]] for h in hashes])
+    for imagen_sha256, respuesta in zip(hashes, respuestas):
+        if isinstance(respuesta, Exception):
+            print(f"[!] Gráfico {imagen_sha256[:12]} sin analizar: {respuesta}")
+            resultado = (None, "error")
+        else:
+            guardar(db, imagen_sha256, respuesta)
+            resultado = (respuesta, "gemini")
+        for i in faltantes[imagen_sha256]:
+            resultados[i] = resultado
+    return resultados
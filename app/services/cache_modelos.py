@@ -0,0 +1,136 @@
+"""
+Caché de modelos ya entrenados (Isolation Forest de la detección de anomalías)
+
+Con semilla fija, el mismo vector de entrenamiento y los mismos parámetros
+dan siempre el mismo modelo, así que se puede reutilizar en vez de volver a
+hacer fit. La clave es el sha256 del vector (float64) más los parámetros y
+la versión de scikit-learn.
+
+- En memoria: LRU con un presupuesto en bytes; el tamaño de cada modelo se
+  estima por su pickle.
+- En disco (opcional, ANOMALY_CACHE_MODELOS_DIR): cada modelo se guarda con
+  joblib, así un reinicio o el escaneo offline no vuelven a entrenar.
+"""
+import os
+import json
+import pickle
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import joblib
+import numpy as np
+import sklearn
+
+from app.config.notifications_config import ANOMALY_CONFIG
+
+logger = logging.getLogger(__name__)
+
+
+def clave_modelo(entrenamiento: np.ndarray, parametros: Dict[str, Any]) -> str:
+    """sha256 del vector de entrenamiento y los parámetros del modelo"""
+    h = hashlib.sha256()
+    h.update(np.ascontiguousarray(entrenamiento, dtype=np.float64).tobytes())
+    h.update(json.dumps(parametros, sort_keys=True).encode("utf-8"))
+    h.update(sklearn.__version__.encode("utf-8"))
+    return h.hexdigest()
+
+
+class CacheModelos:
+    """LRU de modelos entrenados con presupuesto de memoria y persistencia opcional"""
+
+    def __init__(self, memoria_mb: float = None, directorio: Optional[str] = None):
+        memoria_mb = ANOMALY_CONFIG["memoria_cache_modelos_mb"] if memoria_mb is None else memoria_mb
+        self.presupuesto_bytes = int(memoria_mb * 1024 * 1024)
+        self.directorio = ANOMALY_CONFIG["directorio_cache_modelos"] if directorio is None else directorio
+        self._modelos: "OrderedDict[str, Tuple[Any, int]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._metricas = {"aciertos_memoria": 0, "aciertos_disco": 0, "entrenamientos": 0, "desalojos": 0}
+
+    def _contar(self, clave: str):
+        with self._lock:
+            self._metricas[clave] += 1
+
+    def metricas(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self._metricas, "modelos": len(self._modelos),
+                    "memoria_mb": round(self._bytes / 1024 / 1024, 2)}
+
+    # === Disco ===
+    def _ruta(self, clave: str) -> str:
+        return os.path.join(self.directorio, clave[:2], f"{clave}.joblib")
+
+    def _leer_disco(self, clave: str) -> Optional[Any]:
+        if not self.directorio:
+            return None
+        ruta = self._ruta(clave)
+        if not os.path.exists(ruta):
+            return None
+        try:
+            return joblib.load(ruta)
+        except Exception as e:
+            logger.warning(f"Modelo cacheado ilegible, se vuelve a entrenar ({ruta}): {e}")
+            return None
+
+    def _guardar_disco(self, clave: str, modelo: Any):
+        if not self.directorio:
+            return
+        ruta = self._ruta(clave)
+        try:
+            os.makedirs(os.path.dirname(ruta), exist_ok=True)
+            temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+            joblib.dump(modelo, temporal)
+            os.replace(temporal, ruta)
+        except Exception as e:
+            logger.warning(f"No se pudo guardar el modelo en disco ({ruta}): {e}")
+
+    # === Memoria ===
+    def _agregar(self, clave: str, modelo: Any):
+        tamano = len(pickle.dumps(modelo, protocol=pickle.HIGHEST_PROTOCOL))
+        if tamano > self.presupuesto_bytes:
+            return  # No entra ni solo: se usa sin cachear en memoria
+        with self._lock:
+            if clave in self._modelos:
+                return
+            self._modelos[clave] = (modelo, tamano)
+            self._bytes += tamano
+            while self._bytes > self.presupuesto_bytes:
+                _, (_, liberado) = self._modelos.popitem(last=False)
+                self._bytes -= liberado
+                self._metricas["desalojos"] += 1
+
+    def obtener(self, entrenamiento: np.ndarray, parametros: Dict[str, Any], entrenar: Callable[[], Any]) -> Any:
+        """
+        Modelo entrenado para (entrenamiento, parametros): de memoria, de disco
+        o llamando a entrenar() si no estaba
+        """
+        clave = clave_modelo(entrenamiento, parametros)
+        with self._lock:
+            entrada = self._modelos.get(clave)
+            if entrada is not None:
+                self._modelos.move_to_end(clave)
+                self._metricas["aciertos_memoria"] += 1
+                return entrada[0]
+
+        modelo = self._leer_disco(clave)
+        if modelo is not None:
+            self._contar("aciertos_disco")
+        else:
+            modelo = entrenar()
+            self._contar("entrenamientos")
+            self._guardar_disco(clave, modelo)
+        self._agregar(clave, modelo)
+        return modelo
+
+    def limpiar(self):
+        """Vaciar la caché en memoria (los archivos en disco se conservan)"""
+        with self._lock:
+            self._modelos.clear()
+            self._bytes = 0
+
+
+# Instancia global de la caché
+cache_modelos = CacheModelos()
@@ -2,9 +2,39 @@
 Servicio para manejo de base de datos
 """
 import os
+import threading
 from app.db.session import engine, DATABASE_URL
 from app.db.base import Base
-from app.models import factura_model, historico_model, user_model
+from app.db.migraciones import migrar_esquema
+from app.models import factura_model, historico_model, user_model, sync_cursor_model, cache_gemini_model, sync_job_model, programador_model, gmail_watch_model, anomalia_model
+
+_esquema_al_dia = False
+_lock_esquema = threading.Lock()
+
+def actualizar_esquema():
+    """
+    Aplicar las migraciones idempotentes (columnas e índices nuevos de tablas
+    existentes) una vez por proceso
+
+    Corren dentro de una transacción BEGIN IMMEDIATE: si varios procesos
+    arrancan juntos, uno migra y los demás solo verifican.
+    """
+    global _esquema_al_dia
+    with _lock_esquema:
+        if _esquema_al_dia:
+            return
+        conexion = engine.raw_connection()
+        try:
+            cursor = conexion.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            migrar_esquema(cursor)
+            conexion.commit()
+        except Exception:
+            conexion.rollback()
+            raise
+        finally:
+            conexion.close()
+        _esquema_al_dia = True
 
 def init_db_if_not_exists():
     """
@@ -20,11 +50,23 @@ def init_db_if_not_exists():
             # Crear todas las tablas
             Base.metadata.create_all(bind=engine)
             print("✅ Base de datos inicializada correctamente")
-            print("✅ Tablas creadas: users, facturas, historico_consumo")
-            return True
+            print("✅ Tablas creadas: users, facturas, historico_consumo, sync_cursor, cache_gemini, sync_jobs, programador_estado, gmail_watch, anomalia_resultado, anomalia_version")
         except Exception as e:
             print(f"❌ Error al inicializar la base de datos: {e}")
             return False
     else:
         print("✅ Base de datos ya existe")
-        return True
\ No newline at end of file
+        # Crear tablas nuevas que falten (create_all no toca las existentes)
+        try:
+            Base.metadata.create_all(bind=engine)
+        except Exception as e:
+            print(f"❌ Error creando tablas nuevas: {e}")
+            return False
+    # Columnas e índices nuevos de las tablas existentes
+    try:
+        actualizar_esquema()
+    except Exception as e:
+        print(f"❌ El esquema de la base está desactualizado y no se pudo migrar: {e}. "
+              f"Correr migrate_db.py y revisar el error")
+        return False
+    return True
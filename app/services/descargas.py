@@ -0,0 +1,161 @@
+"""
+Etapa de descarga concurrente de facturas
+
+Ejecuta la descarga de varios links de EDEMSA en paralelo con:
+- un límite de descargas simultáneas por llamada
+- un límite de descargas simultáneas por host, compartido por todo el
+  proceso (trabajos de sync, API y barrido de notificaciones suman juntos)
+- un timeout por factura
+- resultados devueltos en el mismo orden que los links
+- cancelación cooperativa de las descargas que superan el timeout
+
+Un hilo no puede matarse desde afuera, así que al vencer el timeout se marca
+la descarga como cancelada y la función de descarga lo comprueba con
+verificar_cancelacion() antes de cada paso con efectos (abrir el navegador,
+insertar la factura). Así una descarga colgada no sigue escribiendo en la
+base después de haber sido abandonada.
+
+Quien llama puede asociar su propia señal de cancelación al hilo con
+con_cancelacion(); descargar_en_paralelo la hereda y, si se activa, corta
+todas sus descargas (así el barrido de notificaciones frena a un usuario
+que abandonó por timeout).
+"""
+import time
+import threading
+import concurrent.futures
+from contextlib import contextmanager
+from urllib.parse import urlparse
+from typing import Any, Callable, List, Optional
+
+from app.config.notifications_config import SYNC_CONFIG
+
+
+class DescargaCancelada(Exception):
+    """La descarga superó su timeout y fue abandonada"""
+
+
+_contexto = threading.local()
+
+
+def verificar_cancelacion():
+    """Lanzar DescargaCancelada si la descarga del hilo actual fue cancelada"""
+    cancelacion = getattr(_contexto, "cancelacion", None)
+    if cancelacion is not None and cancelacion.is_set():
+        raise DescargaCancelada()
+
+
+@contextmanager
+def con_cancelacion(cancelacion: threading.Event):
+    """Asociar una señal de cancelación al hilo actual mientras dura el bloque"""
+    anterior = getattr(_contexto, "cancelacion", None)
+    _contexto.cancelacion = cancelacion
+    try:
+        yield
+    finally:
+        _contexto.cancelacion = anterior
+
+
+class _LimitePorHost:
+    """Semáforos por host para no saturar un mismo servidor"""
+
+    def __init__(self, max_por_host: int):
+        self.max_por_host = max(1, max_por_host)
+        self._semaforos = {}
+        self._lock = threading.Lock()
+
+    def semaforo(self, url: str) -> threading.BoundedSemaphore:
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._semaforos:
+                self._semaforos[host] = threading.BoundedSemaphore(self.max_por_host)
+            return self._semaforos[host]
+
+
+# Instancia global: el límite por host vale para todas las descargas del proceso
+limite_por_host = _LimitePorHost(SYNC_CONFIG["max_descargas_por_host"])
+
+
+def descargar_en_paralelo(
+    links: List[str],
+    funcion: Callable[[str, int], Any],
+    max_concurrentes: Optional[int] = None,
+    timeout_por_item: Optional[float] = None,
+) -> List[Any]:
+    """
+    Ejecutar funcion(link, index) para cada link con concurrencia acotada
+
+    Args:
+        links: Links a descargar
+        funcion: Función que descarga un link, recibe (link, index)
+        max_concurrentes: Máximo de descargas simultáneas de esta llamada; el
+            máximo por host (max_descargas_por_host) es común a todo el proceso
+        timeout_por_item: Segundos máximos por factura, contados desde que empieza
+
+    Returns:
+        Lista con el resultado de cada link en el mismo orden que `links`.
+        Las descargas con error o timeout devuelven None.
+    """
+    if not links:
+        return []
+
+    max_concurrentes = max_concurrentes or SYNC_CONFIG["max_descargas_concurrentes"]
+    timeout_por_item = timeout_por_item or SYNC_CONFIG["timeout_descarga_segundos"]
+
+    padre = getattr(_contexto, "cancelacion", None)  # Cancelación de quien llama, si tiene
+    resultados: List[Any] = [None] * len(links)
+    inicios = {}  # index -> momento en que la descarga empezó realmente
+    cancelaciones = [threading.Event() for _ in links]
+
+    def tarea(link: str, index: int):
+        with limite_por_host.semaforo(link):
+            if cancelaciones[index].is_set() or (padre is not None and padre.is_set()):
+                return None
+            inicios[index] = time.monotonic()
+            _contexto.cancelacion = cancelaciones[index]
+            try:
+                return funcion(link, index)
+            finally:
+                _contexto.cancelacion = None
+
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, min(max_concurrentes, len(links))),
+        thread_name_prefix="descarga-factura"
+    )
+    try:
+        pendientes = {
+            executor.submit(tarea, link, i): i
+            for i, link in enumerate(links)
+        }
+
+        while pendientes:
+            terminados, _ = concurrent.futures.wait(
+                pendientes, timeout=1, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+
+            for future in terminados:
+                index = pendientes.pop(future)
+                try:
+                    resultados[index] = future.result()
+                except Exception as e:
+                    print(f"[!] Error descargando factura {index + 1}: {e}")
+
+            if padre is not None and padre.is_set():
+                print(f"⏹️ Descargas canceladas: {len(pendientes)} facturas sin terminar")
+                break
+
+            # Abandonar las descargas que superaron su timeout
+            ahora = time.monotonic()
+            for future, index in list(pendientes.items()):
+                inicio = inicios.get(index)
+                if inicio is not None and ahora - inicio > timeout_por_item:
+                    print(f"⏱️ Timeout descargando factura {index + 1} ({timeout_por_item}s)")
+                    cancelaciones[index].set()
+                    future.cancel()
+                    pendientes.pop(future)
+    finally:
+        # Lo que no llegó a empezar ya no empieza y lo que sigue corriendo se corta en su próximo control
+        for cancelacion in cancelaciones:
+            cancelacion.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return resultados
@@ -0,0 +1,235 @@
+"""
+Escaneo offline de anomalías de todos los (user_id, nic) de la base
+
+Pensado para correr de noche fuera de la API (escaneo_anomalias.py):
+
+1. Lee historico_consumo unido a facturas por bloques de filas, ordenado
+   por (user_id, nic, id), y arma una partición por NIC. La partición que
+   queda cortada al final de un bloque se completa con el siguiente.
+2. Cada partición se puntúa con calcular_anomalias en un pool de procesos
+   (con un máximo de particiones en vuelo para no cargar todo en memoria).
+3. Los resultados se escriben en lote: por cada grupo de NICs un solo
+   DELETE, un bulk_insert_mappings en anomalia_resultado y la versión de
+   cada NIC en anomalia_version.
+
+Los bloques se leen con paginación por clave y no con un cursor abierto
+(read_sql con chunksize): en SQLite un SELECT en curso impide hacer commit
+de las escrituras en lote.
+"""
+import os
+import time
+import logging
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import pandas as pd
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app.db.session import SessionLocal
+from app.models.factura_model import Factura
+from app.models.historico_model import HistoricoConsumo
+from app.models.anomalia_model import AnomaliaResultado, AnomaliaVersion
+from app.services.modelo import calcular_anomalias, filas_resultado, huella_historico
+
+logger = logging.getLogger(__name__)
+
+FILAS_POR_BLOQUE = 50000
+NICS_POR_ESCRITURA = 200
+PARTICIONES_EN_VUELO_POR_PROCESO = 4
+
+
+def leer_particiones(db: Session, filas_por_bloque: int = FILAS_POR_BLOQUE,
+                     user_id: Optional[int] = None) -> Iterator[Tuple[int, str, pd.DataFrame]]:
+    """
+    Histórico de cada (user_id, nic) leyendo la base por bloques
+
+    Yields:
+        (user_id, nic, df) con las mismas columnas y orden que cargar_historico
+    """
+    ultimo: Optional[Tuple[int, str, int]] = None
+    pendiente: Optional[pd.DataFrame] = None
+    while True:
+        query = db.query(HistoricoConsumo, Factura.user_id.label("_user_id"), Factura.nic.label("_nic"))\
+                  .join(Factura, HistoricoConsumo.factura_id == Factura.id)\
+                  .filter(Factura.user_id.isnot(None), Factura.nic.isnot(None))
+        if user_id is not None:
+            query = query.filter(Factura.user_id == user_id)
+        if ultimo is not None:
+            u, n, i = ultimo
+            query = query.filter(or_(
+                Factura.user_id > u,
+                and_(Factura.user_id == u, Factura.nic > n),
+                and_(Factura.user_id == u, Factura.nic == n, HistoricoConsumo.id > i)
+            ))
+        query = query.order_by(Factura.user_id, Factura.nic, HistoricoConsumo.id).limit(filas_por_bloque)
+
+        bloque = pd.read_sql(query.statement, db.bind)
+        completo = len(bloque) < filas_por_bloque  # Último bloque: no quedan particiones cortadas
+        if not bloque.empty:
+            fila = bloque.iloc[-1]
+            ultimo = (int(fila["_user_id"]), fila["_nic"], int(fila["id"]))
+        if pendiente is not None:
+            bloque = pd.concat([pendiente, bloque], ignore_index=True)
+            pendiente = None
+        if bloque.empty:
+            return
+
+        grupos = list(bloque.groupby(["_user_id", "_nic"], sort=False))
+        if not completo:
+            # El último NIC del bloque puede seguir en el próximo
+            pendiente = grupos.pop()[1]
+        for (u, nic), grupo in grupos:
+            yield int(u), nic, grupo.drop(columns=["_user_id", "_nic"]).reset_index(drop=True)
+        if completo:
+            return
+
+
+def puntuar_particion(user_id: int, nic: str, df: pd.DataFrame) -> Dict[str, Any]:
+    """Calcular las anomalías de un NIC (corre en un proceso del pool)"""
+    huella = huella_historico(df)  # Antes de calcular: preparar_historico modifica df
+    resultado = calcular_anomalias(df)
+    filas = filas_resultado(user_id, nic, resultado, None)
+    alerta = False
+    if filas:
+        mas_reciente = max(filas, key=lambda fila: fila["fecha"])
+        alerta = mas_reciente["anomalia"] == -1
+    return {
+        "user_id": user_id,
+        "nic": nic,
+        "filas": filas,
+        "registros": len(df),
+        "huella": huella,
+        "ultimo_historico_id": int(df["id"].max()),
+        "alerta": alerta,
+    }
+
+
+def guardar_lote(db: Session, lote: List[Dict[str, Any]]) -> int:
+    """
+    Reemplazar los resultados de un grupo de NICs con un solo DELETE y un
+    bulk insert, y subir la versión de cada uno
+
+    Si mientras tanto la API cambió el histórico de alguno, su huella ya no
+    coincide y el próximo actualizar_anomalias lo recalcula entero.
+
+    Returns:
+        Filas escritas en anomalia_resultado
+    """
+    nics_por_usuario = defaultdict(list)
+    for puntuado in lote:
+        nics_por_usuario[puntuado["user_id"]].append(puntuado["nic"])
+
+    def de_estos_nics(tabla):
+        return or_(*[and_(tabla.user_id == user_id, tabla.nic.in_(nics))
+                     for user_id, nics in nics_por_usuario.items()])
+
+    for intento in range(2):
+        try:
+            estados = {(estado.user_id, estado.nic): estado
+                       for estado in db.query(AnomaliaVersion).filter(de_estos_nics(AnomaliaVersion))}
+            db.query(AnomaliaResultado).filter(de_estos_nics(AnomaliaResultado)).delete(synchronize_session=False)
+
+            filas = []
+            for puntuado in lote:
+                estado = estados.get((puntuado["user_id"], puntuado["nic"]))
+                if estado is None:
+                    estado = AnomaliaVersion(user_id=puntuado["user_id"], nic=puntuado["nic"], version=0)
+                    db.add(estado)
+                estado.version = (estado.version or 0) + 1
+                estado.registros = puntuado["registros"]
+                estado.huella = puntuado["huella"]
+                estado.ultimo_historico_id = puntuado["ultimo_historico_id"]
+                for fila in puntuado["filas"]:
+                    filas.append({**fila, "version": estado.version})
+            db.bulk_insert_mappings(AnomaliaResultado, filas)
+            db.commit()
+            return len(filas)
+        except IntegrityError:
+            # La API calculó alguno de estos NICs al mismo tiempo: releer y reintentar
+            db.rollback()
+            if intento:
+                raise
+    return 0
+
+
+def escanear_anomalias(workers: Optional[int] = None, filas_por_bloque: int = FILAS_POR_BLOQUE,
+                       nics_por_escritura: int = NICS_POR_ESCRITURA, user_id: Optional[int] = None,
+                       guardar: bool = True,
+                       al_progresar: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+    """
+    Puntuar todos los NICs de la base (o de `user_id`) y guardar los resultados
+
+    Args:
+        workers: Procesos del pool (None: os.cpu_count())
+        filas_por_bloque: Filas de histórico por lectura
+        nics_por_escritura: NICs por escritura en lote
+        user_id: Limitar el escaneo a un usuario
+        guardar: False para solo medir, sin escribir
+        al_progresar: Se llama con las métricas después de cada escritura
+
+    Returns:
+        Métricas: nics, registros, filas_guardadas, nics_con_alerta, errores,
+        segundos y nics_por_segundo
+    """
+    workers = workers or os.cpu_count() or 1
+    metricas = {"nics": 0, "registros": 0, "filas_guardadas": 0, "nics_con_alerta": 0,
+                "errores": 0, "segundos": 0.0, "nics_por_segundo": 0.0}
+    inicio = time.perf_counter()
+    lote: List[Dict[str, Any]] = []
+    db = SessionLocal()
+
+    def actualizar_tiempos():
+        metricas["segundos"] = round(time.perf_counter() - inicio, 2)
+        metricas["nics_por_segundo"] = round(metricas["nics"] / max(time.perf_counter() - inicio, 1e-9), 1)
+
+    def escribir():
+        if not lote:
+            return
+        if guardar:
+            try:
+                metricas["filas_guardadas"] += guardar_lote(db, lote)
+            except Exception as e:
+                db.rollback()
+                metricas["errores"] += len(lote)
+                logger.error(f"❌ Error guardando {len(lote)} NICs: {e}")
+        lote.clear()
+        actualizar_tiempos()
+        if al_progresar:
+            al_progresar(dict(metricas))
+
+    def recoger(hechos, en_vuelo):
+        for futuro in hechos:
+            par = en_vuelo.pop(futuro)
+            try:
+                puntuado = futuro.result()
+            except Exception as e:
+                metricas["errores"] += 1
+                logger.error(f"❌ Error puntuando NIC {par[1]} del usuario {par[0]}: {e}")
+                continue
+            metricas["nics"] += 1
+            metricas["registros"] += puntuado["registros"]
+            metricas["nics_con_alerta"] += int(puntuado["alerta"])
+            lote.append(puntuado)
+            if len(lote) >= nics_por_escritura:
+                escribir()
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            en_vuelo = {}
+            for u, nic, df in leer_particiones(db, filas_por_bloque, user_id):
+                en_vuelo[pool.submit(puntuar_particion, u, nic, df)] = (u, nic)
+                if len(en_vuelo) >= workers * PARTICIONES_EN_VUELO_POR_PROCESO:
+                    hechos, _ = wait(en_vuelo, return_when=FIRST_COMPLETED)
+                    recoger(hechos, en_vuelo)
+            recoger(wait(en_vuelo)[0], en_vuelo)
+        escribir()
+    finally:
+        db.close()
+
+    actualizar_tiempos()
+    logger.info(f"📊 Escaneo de anomalías: {metricas['nics']} NICs en {metricas['segundos']}s "
+                f"({metricas['nics_por_segundo']} NICs/s), {metricas['errores']} errores")
+    return metricas
@@ -0,0 +1,63 @@
+"""
+Bus de eventos de progreso de las sincronizaciones
+
+Cada trabajo de sincronización publica un evento por etapa y por factura
+(email obtenido, PDF descargado, PDF procesado, gráfico extraído, histórico
+guardado). Los endpoints de streaming se suscriben por job_id y reenvían los
+eventos al cliente a medida que llegan.
+
+Se guarda un historial acotado por trabajo para que un cliente que se
+conecta tarde reciba primero lo que ya pasó.
+"""
+import time
+import queue
+import threading
+from collections import OrderedDict, deque
+from typing import Any, Dict, List
+
+# Trabajos recientes con historial en memoria y eventos guardados por trabajo
+MAX_TRABAJOS = 200
+MAX_EVENTOS_POR_TRABAJO = 1000
+
+
+class BusEventos:
+    """Publicación/suscripción de eventos por job_id, segura entre hilos"""
+
+    def __init__(self):
+        self._historial: "OrderedDict[int, deque]" = OrderedDict()
+        self._suscriptores: Dict[int, List[queue.Queue]] = {}
+        self._lock = threading.Lock()
+
+    def publicar(self, job_id: int, evento: str, **datos: Any):
+        mensaje = {"evento": evento, "job_id": job_id, "ts": round(time.time(), 3), **datos}
+        with self._lock:
+            historial = self._historial.get(job_id)
+            if historial is None:
+                historial = self._historial[job_id] = deque(maxlen=MAX_EVENTOS_POR_TRABAJO)
+                while len(self._historial) > MAX_TRABAJOS:
+                    self._historial.popitem(last=False)
+            historial.append(mensaje)
+            suscriptores = list(self._suscriptores.get(job_id, []))
+        for cola in suscriptores:
+            cola.put(mensaje)
+
+    def suscribir(self, job_id: int) -> queue.Queue:
+        """Cola con el historial del trabajo seguido de los eventos nuevos"""
+        cola: queue.Queue = queue.Queue()
+        with self._lock:
+            for mensaje in self._historial.get(job_id, []):
+                cola.put(mensaje)
+            self._suscriptores.setdefault(job_id, []).append(cola)
+        return cola
+
+    def desuscribir(self, job_id: int, cola: queue.Queue):
+        with self._lock:
+            colas = self._suscriptores.get(job_id, [])
+            if cola in colas:
+                colas.remove(cola)
+            if not colas:
+                self._suscriptores.pop(job_id, None)
+
+
+# Instancia global del bus
+bus_eventos = BusEventos()
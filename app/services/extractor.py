@@ -2,29 +2,51 @@ import os
 import re
 import base64
 import csv
-import requests
 import fitz  # PyMuPDF
 import pandas as pd
-from playwright.sync_api import sync_playwright
-from pdf2image import convert_from_path
 from app.db.session import SessionLocal
 from app.models.factura_model import Factura
+from app.models.sync_cursor_model import SyncCursor
+from app.crud.factura_crud import get_factura_por_link, get_factura_por_lectura, hash_link, links_ya_descargados
 from app.services.auth import SCOPES, TOKEN_PATH
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
-from app.services.grafico import extraer_grafico, analizar_con_gemini
+from app.services.grafico import abrir_pdf, extraer_grafico_png, extraer_historico_vectorial, cliente_gemini
+from app.services.gemini_cliente import ErrorAnalisisGemini
+from app.services.almacen_blobs import almacen_blobs
+from app.services.cache_gemini import analizar_con_cache, analizar_lote_con_cache
+from app.services.descargas import descargar_en_paralelo, verificar_cancelacion, DescargaCancelada
+from app.services.sesion_edemsa import descargar_pdf_edemsa
+from app.services.tokens_gmail import gestor_tokens
+from app.config.notifications_config import SYNC_CONFIG, GEMINI_CONFIG
 from app.models.historico_model import HistoricoConsumo
+from app.services.modelo import actualizar_anomalias
 from fastapi import HTTPException
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
 EMAIL_QUERY = 'subject:"Factura Digital"'
 
+# Gmail acepta hasta 100 requests por batch, pero recomienda no pasar de 50
+GMAIL_BATCH_SIZE = 50
+GMAIL_MAX_RESULTS_LIST = 500
+# Solo las partes del cuerpo, sin headers ni adjuntos
+GMAIL_CAMPOS_MENSAJE = (
+    "id,internalDate,historyId,"
+    "payload(mimeType,body/data,parts(mimeType,body/data,parts(mimeType,body/data,parts(mimeType,body/data))))"
+)
+
 # === GMAIL ===
-def get_service(gmail_token=None, refresh_token=None):
+def get_service(gmail_token=None, refresh_token=None, user_id=None):
     """
     Obtener servicio de Gmail usando token OAuth o archivo token.json
+
+    Con user_id se usa el gestor de tokens: credenciales cacheadas y
+    renovadas antes de vencer, y el cliente ya construido del usuario.
     """
     try:
+        if user_id is not None:
+            return gestor_tokens.servicio(user_id)
         if gmail_token:
             # Importar configuración OAuth
             from app.config.notifications_config import GOOGLE_OAUTH_CONFIG
@@ -55,46 +77,276 @@ def get_html_part(payload):
     if 'parts' in payload:
         for part in payload['parts']:
             if part.get('mimeType') == 'text/html':
-                return part['body'].get('data')
+                return part.get('body', {}).get('data')
             elif part.get('parts'):
                 return get_html_part(part)
     elif payload.get('mimeType') == 'text/html':
-        return payload['body'].get('data')
+        return payload.get('body', {}).get('data')
     return None
 
-def get_edemsa_links(service, max_emails=None):
+def listar_mensajes(service, query=EMAIL_QUERY, max_emails=None):
     """
-    Obtener links de EDEMSA con límite opcional de emails
+    Listar ids de mensajes que coinciden con la query, recorriendo todas las páginas
+    """
+    mensajes = []
+    page_token = None
+    while True:
+        restantes = max_emails - len(mensajes) if max_emails and max_emails > 0 else GMAIL_MAX_RESULTS_LIST
+        results = service.users().messages().list(
+            userId='me',
+            q=query,
+            pageToken=page_token,
+            maxResults=min(restantes, GMAIL_MAX_RESULTS_LIST),
+            fields='messages(id),nextPageToken'
+        ).execute()
+        mensajes.extend(results.get('messages', []))
+        page_token = results.get('nextPageToken')
+        if not page_token or (max_emails and max_emails > 0 and len(mensajes) >= max_emails):
+            break
+    if max_emails and max_emails > 0:
+        mensajes = mensajes[:max_emails]
+    return mensajes
+
+def obtener_mensajes(service, ids):
+    """
+    Obtener varios mensajes con requests batch de Gmail, pidiendo solo las partes del cuerpo
+
+    Returns:
+        Lista de mensajes en el mismo orden que `ids` (se omiten los que fallaron)
+    """
+    respuestas = {}
+    pendientes = list(ids)
+
+    for intento in range(2):
+        fallidos = []
+
+        def callback(request_id, response, exception):
+            if exception is not None:
+                fallidos.append(request_id)
+            else:
+                respuestas[request_id] = response
+
+        for inicio in range(0, len(pendientes), GMAIL_BATCH_SIZE):
+            batch = service.new_batch_http_request(callback=callback)
+            for msg_id in pendientes[inicio:inicio + GMAIL_BATCH_SIZE]:
+                batch.add(
+                    service.users().messages().get(
+                        userId='me', id=msg_id, format='full', fields=GMAIL_CAMPOS_MENSAJE
+                    ),
+                    request_id=msg_id
+                )
+            batch.execute()
+
+        if not fallidos:
+            break
+        print(f"[!] {len(fallidos)} mensajes fallaron en el batch, reintentando...")
+        pendientes = fallidos
+
+    return [respuestas[msg_id] for msg_id in ids if msg_id in respuestas]
+
+def extraer_links_mensaje(msg_data):
+    """Extraer los links de EDEMSA del HTML de un mensaje"""
+    html_data = get_html_part(msg_data.get('payload', {}))
+    if not html_data:
+        return []
+    html = base64.urlsafe_b64decode(html_data + '===').decode('utf-8', errors='ignore')
+    return re.findall(r'https://oficinavirtual\.edemsa\.com/facturad\.php\?conf=[^"]+', html)
+
+def _buscar_mensajes(service, query, max_emails=None):
     """
-    results = service.users().messages().list(userId='me', q=EMAIL_QUERY).execute()
-    messages = results.get('messages', [])
+    Listar y descargar en batch los mensajes de una query (más recientes primero)
+    """
+    messages = listar_mensajes(service, query, max_emails)
     
-    # Aplicar límite si se especifica
     if max_emails and max_emails > 0:
-        messages = messages[:max_emails]
         print(f"📧 Limitando búsqueda a {max_emails} emails más recientes")
     
+    print(f"📧 Descargando {len(messages)} emails en batch...")
+    return obtener_mensajes(service, [msg['id'] for msg in messages])
+
+def _posterior_al_cursor(msg_data, cursor):
+    if not cursor or not cursor.ultima_fecha_interna:
+        return True
+    fecha = int(msg_data.get('internalDate', 0))
+    return fecha > cursor.ultima_fecha_interna or (
+        fecha == cursor.ultima_fecha_interna and msg_data['id'] != cursor.ultimo_mensaje_id
+    )
+
+def _buscar_mensajes_pendientes(service, query, cursor, max_emails=None):
+    """
+    Descargar los `max_emails` mensajes más antiguos posteriores al cursor, en orden cronológico
+
+    Se procesan del más antiguo al más reciente para que el cursor pueda
+    avanzar hasta el último mensaje procesado sin saltear ninguno: los que
+    quedan fuera del límite se toman en la próxima sincronización.
+    """
+    # Gmail lista del más reciente al más antiguo y solo devuelve ids
+    ids = [msg['id'] for msg in reversed(listar_mensajes(service, query))]
+    if cursor:
+        ids = [msg_id for msg_id in ids if msg_id != cursor.ultimo_mensaje_id]
+    limite = max_emails if max_emails and max_emails > 0 else len(ids)
+    if limite < len(ids):
+        print(f"📧 {len(ids)} emails por revisar, se toman los {limite} más antiguos")
+
+    # after: trabaja en segundos: los mensajes ya procesados del mismo segundo se descartan por internalDate
+    pendientes = []
+    inicio = 0
+    while len(pendientes) < limite and inicio < len(ids):
+        tanda = ids[inicio:inicio + limite - len(pendientes)]
+        inicio += len(tanda)
+        print(f"📧 Descargando {len(tanda)} emails en batch...")
+        pendientes.extend(m for m in obtener_mensajes(service, tanda) if _posterior_al_cursor(m, cursor))
+    pendientes.sort(key=lambda m: int(m.get('internalDate', 0)))
+    return pendientes
+
+def _marca_mensaje(msg_data):
+    return {
+        "history_id": msg_data.get('historyId'),
+        "ultimo_mensaje_id": msg_data['id'],
+        "ultima_fecha_interna": int(msg_data.get('internalDate', 0)),
+    }
+
+def _links_unicos(mensajes):
     links = []
-    emails_procesados = 0
+    for mensaje in mensajes:
+        links.extend(mensaje["links"])
+    # Quitar duplicados conservando el orden
+    return list(dict.fromkeys(links))
 
-    for msg in messages:
-        emails_procesados += 1
-        print(f"📧 Procesando email {emails_procesados}/{len(messages)}...")
-        
-        msg_data = service.users().messages().get(userId='me', id=msg['id'], format='full').execute()
-        html_data = get_html_part(msg_data['payload'])
-        if not html_data:
-            continue
-        html = base64.urlsafe_b64decode(html_data + '===').decode('utf-8', errors='ignore')
-        encontrados = re.findall(r'https://oficinavirtual\.edemsa\.com/facturad\.php\?conf=[^"]+', html)
-        links.extend(encontrados)
+def _links_de_mensajes(mensajes):
+    links = _links_unicos([{"links": extraer_links_mensaje(msg_data)} for msg_data in mensajes])
+    print(f"✅ Procesados {len(mensajes)} emails, encontrados {len(links)} links únicos")
+    return links
+
+def _avisar(progreso, evento, **datos):
+    """Notificar un evento de progreso sin que un error del callback corte la sincronización"""
+    if progreso is None:
+        return
+    try:
+        progreso(evento, **datos)
+    except Exception as e:
+        print(f"[!] Error notificando progreso ({evento}): {e}")
+
+# === Cursor de sincronización incremental ===
+def obtener_cursor_sync(db: Session, user_id):
+    return db.query(SyncCursor).filter(SyncCursor.user_id == user_id).first()
+
+def buscar_links_nuevos(service, user_id, max_emails=None, query=EMAIL_QUERY, incremental=True, progreso=None):
+    """
+    Buscar links solo en los mensajes posteriores al cursor del usuario
+
+    Args:
+        service: Servicio de Gmail
+        user_id: ID del usuario dueño del cursor
+        max_emails: Límite de emails a procesar
+        query: Query de Gmail
+        incremental: Si es False se ignora el cursor y se buscan los más recientes
+        progreso: Callback opcional progreso(evento, **datos)
+
+    Returns:
+        (links, mensajes) donde mensajes es la lista de {"links", "marca"} en
+        el orden en que se procesan; con marca_procesada se obtiene hasta dónde
+        puede avanzar el cursor una vez guardadas las facturas. Sin incremental
+        las marcas son None: una búsqueda forzada no mueve el cursor.
+    """
+    cursor = None
+    if incremental:
+        db = SessionLocal()
+        try:
+            cursor = obtener_cursor_sync(db, user_id)
+        finally:
+            db.close()
+
+    if cursor and cursor.ultima_fecha_interna:
+        # after: trabaja en segundos, el filtro fino se hace con internalDate
+        query = f"{query} after:{cursor.ultima_fecha_interna // 1000 - 1}"
+        print(f"📌 Sincronización incremental desde mensaje {cursor.ultimo_mensaje_id}")
+
+    if incremental:
+        datos_mensajes = _buscar_mensajes_pendientes(service, query, cursor, max_emails)
+    else:
+        datos_mensajes = _buscar_mensajes(service, query, max_emails)
+
+    mensajes = []
+    for msg_data in datos_mensajes:
+        _avisar(progreso, "email_obtenido", mensaje_id=msg_data['id'],
+                fecha_interna=int(msg_data.get('internalDate', 0)))
+        mensajes.append({
+            "links": extraer_links_mensaje(msg_data),
+            "marca": _marca_mensaje(msg_data) if incremental else None,
+        })
+    links = _links_unicos(mensajes)
+    print(f"✅ Procesados {len(mensajes)} emails, encontrados {len(links)} links únicos")
+    _avisar(progreso, "emails_listados", cantidad=len(mensajes), links=len(links))
+    return links, mensajes
+
+def recortar_mensajes(mensajes, max_links):
+    """
+    Primeros mensajes cuyos links entran en `max_links` (al menos uno)
+
+    Se corta por mensaje y no por link para que el cursor no saltee links
+    que quedaron afuera.
+    """
+    recortados, links = [], set()
+    for mensaje in mensajes:
+        if recortados and len(links | set(mensaje["links"])) > max_links:
+            break
+        recortados.append(mensaje)
+        links.update(mensaje["links"])
+    return recortados
+
+def marca_procesada(mensajes, links_fallidos=()):
+    """
+    Marca del último mensaje hasta el que todas las facturas quedaron guardadas
 
-    print(f"✅ Procesados {emails_procesados} emails, encontrados {len(links)} links únicos")
-    return list(set(links))
+    Un link fallido frena el cursor en el mensaje anterior, así ese mensaje y
+    los siguientes se vuelven a leer en la próxima sincronización.
+    """
+    links_fallidos = set(links_fallidos)
+    marca = None
+    for mensaje in mensajes:
+        if links_fallidos.intersection(mensaje["links"]):
+            break
+        marca = mensaje["marca"]
+    return marca
+
+def guardar_cursor_sync(user_id, marca):
+    """Avanzar el cursor del usuario (nunca lo retrocede)"""
+    if not marca:
+        return
+    db = SessionLocal()
+    try:
+        cursor = obtener_cursor_sync(db, user_id)
+        if cursor is None:
+            cursor = SyncCursor(user_id=user_id)
+            db.add(cursor)
+        elif (cursor.ultima_fecha_interna or 0) > marca["ultima_fecha_interna"]:
+            return
+        cursor.history_id = marca["history_id"]
+        cursor.ultimo_mensaje_id = marca["ultimo_mensaje_id"]
+        cursor.ultima_fecha_interna = marca["ultima_fecha_interna"]
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print(f"[!] Error guardando cursor de sincronización: {e}")
+    finally:
+        db.close()
+
+def get_edemsa_links(service, max_emails=None):
+    """
+    Obtener links de EDEMSA con límite opcional de emails
+    """
+    return _links_de_mensajes(_buscar_mensajes(service, EMAIL_QUERY, max_emails))
 
 # === PDF ===
 def extraer_info_pdf(nombre_pdf):
-    doc = fitz.open(nombre_pdf)
+    """
+    Extraer NIC, dirección, fecha de lectura y consumo del texto del PDF
+
+    Args:
+        nombre_pdf: Ruta del PDF, sus bytes o un documento PyMuPDF ya abierto
+    """
+    doc = abrir_pdf(nombre_pdf)
     texto = ""
     for page in doc:
         texto += page.get_text("text")
@@ -149,103 +401,260 @@ def extraer_info_pdf(nombre_pdf):
     }
 
 # === Descarga PDF y guarda en DB ===
-def descargar_factura_pdf(url, index, user_id):
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=False)
-        context = browser.new_context()
-        page = context.new_page()
+class FacturaSimple:
+    """Objeto simple para retornar (no vinculado a sesión)"""
+    def __init__(self, data):
+        for key, value in data.items():
+            setattr(self, key, value)
+
+def _factura_a_dict(factura):
+    return {
+        "id": factura.id,
+        "nic": factura.nic,
+        "direccion": factura.direccion,
+        "fecha_lectura": factura.fecha_lectura,
+        "consumo_kwh": factura.consumo_kwh,
+        "link": factura.link,
+        "imagen": factura.imagen,
+        "pdf_sha256": factura.pdf_sha256,
+        "user_id": factura.user_id
+    }
+
+def _factura_duplicada(factura):
+    factura_data = _factura_a_dict(factura)
+    factura_data["duplicada"] = True
+    return FacturaSimple(factura_data)
+
+def _guardar_historico(db: Session, factura, df):
+    registros = []
+    for _, row in df.iterrows():
+        registro = HistoricoConsumo(
+            fecha=row['fecha'],
+            consumo_kwh=row['consumo_wh'],
+            factura_id=factura.id
+        )
+        db.add(registro)
+        registros.append(registro)
+    return registros
+
+def _actualizar_anomalias(db: Session, nuevos):
+    """
+    Recalcular los resultados de anomalías de los trimestres afectados
+
+    Args:
+        nuevos: Lista de (factura, registros de histórico recién guardados)
+    """
+    por_nic = {}
+    for factura, registros in nuevos:
+        if factura.nic and registros:
+            por_nic.setdefault((factura.user_id, factura.nic), []).extend(r.id for r in registros)
+    for (user_id, nic), historico_ids in por_nic.items():
         try:
-            print(f"Abriendo sesión para descarga directa...")
-            page.goto(url, timeout=90000, wait_until="load")
-            page.wait_for_timeout(5000)
-
-            cookies = context.cookies()
-            headers = {
-                "User-Agent": "Mozilla/5.0",
-                "Referer": url,
-            }
-            cookie_str = "; ".join([f"{c['name']}={c['value']}" for c in cookies])
-            headers["Cookie"] = cookie_str
-
-            pdf_url = url.replace("facturad.php", "facturad_mail.php")
-            nombre_archivo = f"factura_{index + 1}.pdf"
-            response = requests.get(pdf_url, headers=headers)
-
-            if response.status_code == 200 and response.headers['Content-Type'] == 'application/pdf':
-                with open(nombre_archivo, "wb") as f:
-                    f.write(response.content)
-
-                datos = extraer_info_pdf(nombre_archivo)
-                datos["link"] = url
-                datos["imagen"] = ""
-
-                # Guardar en DB con user_id
-                db = SessionLocal()
-                try:
-                    factura = Factura(
-                        nic=datos['nic'],
-                        direccion=datos['direccion'],
-                        fecha_lectura=datos['fecha_lectura'],
-                        consumo_kwh=datos['consumo_kwh'],
-                        link=datos['link'],
-                        imagen="",
-                        user_id=user_id
-                    )
-                    db.add(factura)
-                    db.commit()
-                    db.refresh(factura)
-
-                    # Guardar datos de la factura ANTES de procesar gráfico
-                    factura_data = {
-                        "id": factura.id,
-                        "nic": factura.nic,
-                        "direccion": factura.direccion,
-                        "fecha_lectura": factura.fecha_lectura,
-                        "consumo_kwh": factura.consumo_kwh,
-                        "link": factura.link,
-                        "imagen": factura.imagen,
-                        "user_id": factura.user_id
-                    }
-
-                    # Procesar gráfico
-                    imagen_nombre = f"{factura.nic}_grafico.png"
-                    if extraer_grafico(nombre_archivo, imagen_nombre):
-                        df = analizar_con_gemini(imagen_nombre)
-                        for _, row in df.iterrows():
-                            registro = HistoricoConsumo(
-                                fecha=row['fecha'],
-                                consumo_kwh=row['consumo_wh'],
-                                factura_id=factura.id
-                            )
-                            db.add(registro)
-                        factura.imagen = imagen_nombre
-                        factura_data["imagen"] = imagen_nombre
-                        db.commit()
-
-                    # Cerrar sesión DESPUÉS de completar todas las operaciones
-                    db.close()
-                    
-                    # Crear objeto simple para retornar (no vinculado a sesión)
-                    class FacturaSimple:
-                        def __init__(self, data):
-                            for key, value in data.items():
-                                setattr(self, key, value)
-                    
-                    return FacturaSimple(factura_data)
-                    
-                except Exception as db_error:
-                    db.rollback()
-                    db.close()
-                    print(f"[!] Error en base de datos: {db_error}")
-                    return None
+            actualizar_anomalias(db, user_id, nic, historico_ids)
+        except Exception as e:
+            db.rollback()
+            print(f"[!] Error actualizando anomalías del NIC {nic}: {e}")
+
+def procesar_grafico_factura(db: Session, factura, pdf=None, analizar_gemini=True, progreso=None):
+    """
+    Extraer el gráfico histórico del PDF, analizarlo y guardar los registros
+
+    Args:
+        pdf: Documento PyMuPDF abierto o bytes del PDF. Si no se indica se
+             reutilizan los bytes guardados en el almacén.
+        analizar_gemini: Si es False, los gráficos que necesitan Gemini (y no
+             están en caché) quedan pendientes para analizar_historicos_pendientes
+        progreso: Callback opcional progreso(evento, **datos)
+
+    Returns:
+        Origen del histórico ("vectorial", "cache" o "gemini"), "pendiente" si
+        el gráfico quedó guardado sin analizar, o None si no se pudo procesar
+    """
+    if pdf is None:
+        if not almacen_blobs.exists(factura.pdf_sha256):
+            print(f"[!] La factura {factura.id} no tiene PDF en el almacén")
+            return None
+        pdf = almacen_blobs.get(factura.pdf_sha256)
+
+    png_bytes = extraer_grafico_png(pdf)
+    if not png_bytes:
+        return None
+    # La imagen se guarda siempre: si el análisis falla se puede reintentar
+    factura.imagen = almacen_blobs.put(png_bytes)
+    _avisar(progreso, "grafico_extraido", factura_id=factura.id, imagen=factura.imagen)
+
+    # Lectura exacta desde los vectores del PDF; Gemini (con caché) solo si el layout no se reconoce
+    df = extraer_historico_vectorial(pdf)
+    origen = "vectorial"
+    if df.empty:
+        if analizar_gemini:
+            print(f"📊 Gráfico no reconocido como vectorial, analizando con Gemini...")
+            try:
+                df, origen = analizar_con_cache(db, png_bytes)
+            except ErrorAnalisisGemini as e:
+                print(f"[!] Histórico de la factura {factura.id} pendiente: {e}")
+                origen = "pendiente"
+        else:
+            origen = "pendiente"
+
+    if origen != "pendiente":
+        registros = _guardar_historico(db, factura, df)
+    db.commit()
+    if origen != "pendiente":
+        _actualizar_anomalias(db, [(factura, registros)])
+        _avisar(progreso, "historico_guardado", factura_id=factura.id, origen=origen, registros=len(df))
+    return origen
+
+def analizar_historicos_pendientes(user_id, progreso=None):
+    """
+    Etapa de análisis en lote: enviar a Gemini, en paralelo y con límite de
+    tasa, los gráficos de las facturas del usuario que todavía no tienen
+    histórico (los de esta sincronización y los que fallaron antes)
+
+    Returns:
+        Diccionario factura_id -> origen ("cache", "gemini" o "error")
+    """
+    db = SessionLocal()
+    try:
+        con_historico = db.query(HistoricoConsumo.factura_id).distinct()
+        pendientes = db.query(Factura).filter(
+            Factura.user_id == user_id,
+            Factura.imagen.isnot(None),
+            Factura.imagen != "",
+            ~Factura.id.in_(con_historico)
+        ).all()
+
+        facturas, imagenes = [], []
+        for factura in pendientes:
+            if not almacen_blobs.exists(factura.imagen):
+                continue
+            facturas.append(factura)
+            imagenes.append(almacen_blobs.get(factura.imagen))
+        if not facturas:
+            return {}
+
+        print(f"📊 Analizando {len(facturas)} gráficos con Gemini "
+              f"(máx {GEMINI_CONFIG['max_concurrentes']} simultáneos)")
+        origenes, registros, nuevos = {}, {}, []
+        for factura, (df, origen) in zip(facturas, analizar_lote_con_cache(db, imagenes)):
+            origenes[factura.id] = origen
+            if df is not None:
+                nuevos.append((factura, _guardar_historico(db, factura, df)))
+                registros[factura.id] = len(df)
+        db.commit()
+        _actualizar_anomalias(db, nuevos)
+        for factura_id, origen in origenes.items():
+            if origen == "error":
+                _avisar(progreso, "historico_fallido", factura_id=factura_id)
             else:
-                return None
+                _avisar(progreso, "historico_guardado", factura_id=factura_id, origen=origen,
+                        registros=registros[factura_id])
+        return origenes
+    finally:
+        db.close()
 
-        except Exception as e:
-            print(f"[!] Error durante la descarga del PDF: {e}")
+def descargar_factura_pdf(url, index, user_id, analizar_gemini=True, progreso=None):
+    """
+    Descargar una factura, guardarla en la DB y procesar su gráfico histórico
+
+    Las facturas ya existentes (mismo link o misma lectura) no se vuelven a
+    procesar: se devuelven con el atributo duplicada=True.
+
+    Con analizar_gemini=False los gráficos que requieren Gemini quedan
+    pendientes para la etapa de análisis en lote.
+    """
+    db = SessionLocal()
+    doc = None
+    try:
+        # Deduplicación antes de abrir navegador o descargar nada
+        existente = get_factura_por_link(db, user_id, url)
+        if existente:
+            print(f"⚠️ Link ya descargado, se omite: factura {existente.id}")
+            _avisar(progreso, "factura_duplicada", index=index, factura_id=existente.id)
+            return _factura_duplicada(existente)
+
+        verificar_cancelacion()
+        pdf_bytes = descargar_pdf_edemsa(url)
+        if not pdf_bytes:
             return None
-        finally:
-            browser.close()
+        _avisar(progreso, "pdf_descargado", index=index, link=url)
+
+        # Guardar el PDF en el almacén direccionado por contenido
+        pdf_sha256 = almacen_blobs.put(pdf_bytes)
+
+        # Abrir el PDF una sola vez en memoria para texto y gráfico
+        doc = abrir_pdf(pdf_bytes)
+        datos = extraer_info_pdf(doc)
+
+        # Deduplicación por lectura antes de procesar el gráfico
+        existente = None
+        if datos['nic'] and datos['fecha_lectura']:
+            existente = get_factura_por_lectura(db, user_id, datos['nic'], datos['fecha_lectura'])
+        if existente:
+            print(f"⚠️ Factura duplicada omitida: NIC {existente.nic}, fecha {existente.fecha_lectura}")
+            if not existente.link_hash:
+                existente.link_hash = hash_link(url)
+                db.commit()
+            _avisar(progreso, "factura_duplicada", index=index, factura_id=existente.id)
+            return _factura_duplicada(existente)
+
+        # Último control antes de escribir: una descarga abandonada no inserta nada
+        verificar_cancelacion()
+        try:
+            factura = Factura(
+                nic=datos['nic'] or None,
+                direccion=datos['direccion'],
+                # NULL en vez de "" para no chocar con el índice único de lectura
+                fecha_lectura=datos['fecha_lectura'] or None,
+                consumo_kwh=datos['consumo_kwh'],
+                link=url,
+                link_hash=hash_link(url),
+                pdf_sha256=pdf_sha256,
+                imagen="",
+                user_id=user_id
+            )
+            db.add(factura)
+            db.commit()
+            db.refresh(factura)
+        except IntegrityError:
+            # Otra sincronización insertó la misma factura mientras tanto
+            db.rollback()
+            existente = get_factura_por_link(db, user_id, url) or get_factura_por_lectura(
+                db, user_id, datos['nic'], datos['fecha_lectura']
+            )
+            return _factura_duplicada(existente) if existente else None
+
+        # Guardar datos de la factura ANTES de procesar gráfico
+        factura_data = _factura_a_dict(factura)
+        _avisar(progreso, "pdf_procesado", index=index, factura_id=factura.id, nic=factura.nic,
+                fecha_lectura=factura.fecha_lectura, consumo_kwh=factura.consumo_kwh)
+
+        try:
+            # Procesar gráfico
+            origen = procesar_grafico_factura(db, factura, doc, analizar_gemini, progreso)
+            factura_data["origen_historico"] = origen
+            factura_data["imagen"] = factura.imagen
+        except Exception as db_error:
+            db.rollback()
+            print(f"[!] Error en base de datos: {db_error}")
+            return None
+
+        factura_data["duplicada"] = False
+        return FacturaSimple(factura_data)
+
+    except DescargaCancelada:
+        db.rollback()
+        print(f"⏱️ Descarga de la factura {index + 1} cancelada por timeout")
+        return None
+    except Exception as e:
+        db.rollback()
+        print(f"[!] Error durante la descarga del PDF: {e}")
+        return None
+    finally:
+        # Cerrar sesión DESPUÉS de completar todas las operaciones
+        db.close()
+        if doc is not None:
+            doc.close()
 
 # === Función principal de sincronización ===
 def sincronizar_facturas(user_id, gmail_token=None):
@@ -253,13 +662,13 @@ def sincronizar_facturas(user_id, gmail_token=None):
     Función principal de sincronización con soporte para token OAuth
     """
     try:
-        service = get_service(gmail_token)
+        service = get_service(gmail_token, user_id=user_id if gmail_token else None)
         links = get_edemsa_links(service)
-        nuevas = []
-        for i, link in enumerate(links):
-            factura = descargar_factura_pdf(link, i, user_id)
-            if factura:
-                nuevas.append(factura)
+        facturas = descargar_en_paralelo(
+            links,
+            lambda link, i: descargar_factura_pdf(link, i, user_id)
+        )
+        nuevas = [factura for factura in facturas if factura and not factura.duplicada]
         return {"facturas_sincronizadas": len(nuevas), "facturas": nuevas}
     except Exception as e:
         raise HTTPException(
@@ -268,7 +677,7 @@ def sincronizar_facturas(user_id, gmail_token=None):
         )
 
 # === Función principal de sincronización con límite ===
-def sincronizar_facturas_con_limite(user_id, gmail_token=None, max_emails=10):
+def sincronizar_facturas_con_limite(user_id, gmail_token=None, max_emails=10, incremental=True, progreso=None):
     """
     Función de sincronización con límite de emails
     
@@ -276,6 +685,8 @@ def sincronizar_facturas_con_limite(user_id, gmail_token=None, max_emails=10):
         user_id: ID del usuario
         gmail_token: Token de Gmail OAuth
         max_emails: Número máximo de emails a procesar
+        incremental: Procesar solo emails posteriores al cursor del usuario
+        progreso: Callback opcional progreso(evento, **datos) con el avance por etapa
     """
     import time
     
@@ -284,14 +695,17 @@ def sincronizar_facturas_con_limite(user_id, gmail_token=None, max_emails=10):
     try:
         print(f"🔄 Iniciando sincronización para usuario {user_id}")
         print(f"📧 Límite de emails: {max_emails}")
-        print(f"⏱️ Tiempo estimado: {max_emails * 30} segundos")
+        tandas = -(-max_emails // SYNC_CONFIG["max_descargas_concurrentes"])
+        print(f"⏱️ Tiempo estimado: {tandas * 30} segundos")
         
-        service = get_service(gmail_token)
+        service = get_service(gmail_token, user_id=user_id if gmail_token else None)
         
         # Obtener links con límite
-        links = get_edemsa_links(service, max_emails)
+        links, mensajes = buscar_links_nuevos(service, user_id, max_emails, incremental=incremental, progreso=progreso)
         
         if not links:
+            # Emails sin facturas: el cursor pasa de largo
+            guardar_cursor_sync(user_id, marca_procesada(mensajes))
             return {
                 "emails_procesados": max_emails,
                 "facturas_encontradas": 0,
@@ -302,21 +716,59 @@ def sincronizar_facturas_con_limite(user_id, gmail_token=None, max_emails=10):
         
         # APLICAR LÍMITE A LAS FACTURAS TAMBIÉN
         # Limitar las facturas a procesar basado en max_emails
-        # Cada email debería tener aprox 1 factura, así que limitamos a max_emails facturas
-        facturas_a_procesar = min(len(links), max_emails)
-        links = links[:facturas_a_procesar]
+        # Cada email debería tener aprox 1 factura, así que limitamos a max_emails facturas,
+        # cortando por email para que el cursor no pase por encima de links sin procesar
+        encontradas = len(links)
+        mensajes = recortar_mensajes(mensajes, max_emails)
+        links = _links_unicos(mensajes)
+        facturas_a_procesar = len(links)
         
-        print(f"🔍 Encontradas {len(links)} facturas para descargar (limitado a {facturas_a_procesar})")
+        print(f"🔍 Encontradas {encontradas} facturas para descargar (limitado a {facturas_a_procesar})")
         
         nuevas = []
-        facturas_procesadas = 0
         
-        for i, link in enumerate(links):
-            facturas_procesadas += 1
-            print(f"📄 Descargando factura {facturas_procesadas}/{len(links)} (≈{facturas_procesadas * 30}s estimados)")
-            
-            factura = descargar_factura_pdf(link, i, user_id)
-            if factura:
+        # Descartar en una sola consulta los links que ya tienen factura
+        db = SessionLocal()
+        try:
+            ya_descargados = links_ya_descargados(db, user_id, links)
+        finally:
+            db.close()
+        links_pendientes = [link for link in links if link not in ya_descargados]
+        facturas_duplicadas = len(ya_descargados)
+        if ya_descargados:
+            print(f"⚠️ {len(ya_descargados)} facturas ya sincronizadas, no se descargan")
+        
+        print(f"📄 Descargando {len(links_pendientes)} facturas en paralelo "
+              f"(máx {SYNC_CONFIG['max_descargas_concurrentes']} simultáneas, "
+              f"{SYNC_CONFIG['max_descargas_por_host']} por host)")
+        
+        # Etapa 1: descargas; los gráficos que requieren Gemini quedan pendientes
+        _avisar(progreso, "descargas_iniciadas", cantidad=len(links_pendientes), duplicadas=facturas_duplicadas)
+        facturas = descargar_en_paralelo(
+            links_pendientes,
+            lambda link, i: descargar_factura_pdf(link, i, user_id, analizar_gemini=False, progreso=progreso)
+        )
+        
+        for i, factura in enumerate(facturas):
+            if factura is None:
+                _avisar(progreso, "factura_fallida", index=i, link=links_pendientes[i])
+        
+        # Etapa 2: análisis en lote de los gráficos pendientes (incluye fallos anteriores)
+        _avisar(progreso, "analisis_iniciado")
+        origenes_lote = analizar_historicos_pendientes(user_id, progreso=progreso)
+        for factura in facturas:
+            if factura and not factura.duplicada and factura.id in origenes_lote:
+                factura.origen_historico = origenes_lote[factura.id]
+        
+        # El cursor avanza hasta el último email con todas sus facturas guardadas,
+        # así una factura que falló se vuelve a intentar en el próximo sync
+        fallidos = [link for link, factura in zip(links_pendientes, facturas) if factura is None]
+        guardar_cursor_sync(user_id, marca_procesada(mensajes, fallidos))
+        
+        for factura in facturas:
+            if factura and factura.duplicada:
+                facturas_duplicadas += 1
+            elif factura:
                 nuevas.append({
                     "id": factura.id,
                     "nic": factura.nic,
@@ -327,19 +779,33 @@ def sincronizar_facturas_con_limite(user_id, gmail_token=None, max_emails=10):
         
         tiempo_total = time.time() - inicio_tiempo
         
+        # Aciertos de la caché de Gemini (los históricos vectoriales no consultan Gemini)
+        origenes = [getattr(f, "origen_historico", None) for f in facturas if f and not f.duplicada]
+        consultas_gemini = origenes.count("cache") + origenes.count("gemini")
+        
         resultado = {
             "emails_procesados": max_emails,
             "facturas_encontradas": facturas_a_procesar,  # Actualizado para reflejar el límite aplicado
             "facturas_sincronizadas": len(nuevas),
+            "facturas_duplicadas": facturas_duplicadas,
             "facturas": nuevas,
             "tiempo_transcurrido": f"{tiempo_total:.1f} segundos",
             "tiempo_promedio_por_factura": f"{tiempo_total/len(links):.1f} segundos" if links else "N/A",
             "rendimiento": "✅ Sincronización completada exitosamente",
-            "limite_aplicado": f"Se limitó a {facturas_a_procesar} facturas basado en {max_emails} emails"
+            "limite_aplicado": f"Se limitó a {facturas_a_procesar} facturas basado en {max_emails} emails",
+            "historicos_vectoriales": origenes.count("vectorial"),
+            # Gráficos que siguen sin histórico; se reintentan en el próximo sync
+            "historicos_pendientes": list(origenes_lote.values()).count("error"),
+            "gemini": cliente_gemini.metricas(),
+            "cache_gemini": {
+                "consultas": consultas_gemini,
+                "aciertos": origenes.count("cache"),
+                "tasa_aciertos": f"{origenes.count('cache') / consultas_gemini * 100:.1f}%" if consultas_gemini else "N/A"
+            }
         }
         
         print(f"🎉 Sincronización completada: {len(nuevas)} facturas en {tiempo_total:.1f}s")
-        print(f"📊 Límite respetado: {facturas_a_procesar} facturas procesadas de {len(links)} encontradas")
+        print(f"📊 Límite respetado: {facturas_a_procesar} facturas procesadas de {encontradas} encontradas")
         
         return resultado
         
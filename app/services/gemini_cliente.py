@@ -0,0 +1,192 @@
+"""
+Cliente asíncrono de Gemini para el análisis de gráficos
+
+- Concurrencia acotada (semáforo compartido entre hilos y event loops)
+- Limitador de tasa token bucket
+- Reintentos con backoff exponencial y jitter ante errores transitorios
+- Métricas de latencia (percentiles) y de reintentos
+
+Las llamadas al SDK son bloqueantes, así que se ejecutan en hilos con
+asyncio.to_thread. Esto permite usar el transporte REST y apuntar el SDK a
+un servidor falso local (GEMINI_API_ENDPOINT) para pruebas.
+"""
+import time
+import random
+import asyncio
+import logging
+import threading
+import statistics
+from collections import deque
+from typing import Any, Callable, Dict, List, Union
+
+import pandas as pd
+
+from app.config.notifications_config import GEMINI_CONFIG
+
+logger = logging.getLogger(__name__)
+
+
+class ErrorAnalisisGemini(Exception):
+    """El gráfico no pudo analizarse con Gemini después de los reintentos"""
+
+
+def _es_transitorio(error: Exception) -> bool:
+    """Errores que vale la pena reintentar (cuotas, timeouts, 5xx, red)"""
+    if isinstance(error, (ConnectionError, TimeoutError, asyncio.TimeoutError)):
+        return True
+    try:
+        from google.api_core import exceptions as gexc
+        transitorios = (
+            gexc.TooManyRequests,
+            gexc.ResourceExhausted,
+            gexc.ServiceUnavailable,
+            gexc.DeadlineExceeded,
+            gexc.InternalServerError,
+        )
+        if isinstance(error, transitorios):
+            return True
+    except ImportError:
+        pass
+    try:
+        import requests
+        if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+            return True
+    except ImportError:
+        pass
+    return False
+
+
+class LimitadorTokens:
+    """Token bucket seguro entre hilos, usable desde cualquier event loop"""
+
+    def __init__(self, por_minuto: float, capacidad: int = None):
+        self.tasa = por_minuto / 60.0
+        self.capacidad = capacidad or max(1, int(por_minuto // 6))
+        self._tokens = float(self.capacidad)
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reservar(self) -> float:
+        """Tomar un token y devolver cuántos segundos hay que esperar para usarlo"""
+        with self._lock:
+            ahora = time.monotonic()
+            self._tokens = min(self.capacidad, self._tokens + (ahora - self._ultimo) * self.tasa)
+            self._ultimo = ahora
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.tasa
+
+    async def adquirir(self):
+        espera = self._reservar()
+        if espera > 0:
+            await asyncio.sleep(espera)
+
+
+class ClienteGemini:
+    """Cliente de análisis de gráficos con límites, reintentos y métricas"""
+
+    def __init__(
+        self,
+        modelo: Any,
+        prompt: str,
+        parser: Callable[[str], pd.DataFrame],
+        max_concurrentes: int = None,
+        por_minuto: float = None,
+        reintentos: int = None,
+    ):
+        self.modelo = modelo
+        self.prompt = prompt
+        self.parser = parser
+        self.reintentos = GEMINI_CONFIG["reintentos"] if reintentos is None else reintentos
+        self._semaforo = threading.BoundedSemaphore(max_concurrentes or GEMINI_CONFIG["max_concurrentes"])
+        self._limitador = LimitadorTokens(por_minuto or GEMINI_CONFIG["solicitudes_por_minuto"])
+        self._latencias = deque(maxlen=1000)
+        self._contadores = {"llamadas": 0, "exitos": 0, "errores": 0, "reintentos": 0}
+        self._lock = threading.Lock()
+
+    def _contar(self, clave: str):
+        with self._lock:
+            self._contadores[clave] += 1
+
+    def _llamar(self, png_bytes: bytes) -> str:
+        with self._semaforo:
+            inicio = time.monotonic()
+            try:
+                response = self.modelo.generate_content(
+                    [self.prompt, {"mime_type": "image/png", "data": png_bytes}],
+                    request_options={"timeout": GEMINI_CONFIG["timeout_segundos"]}
+                )
+                return response.text.strip()
+            finally:
+                with self._lock:
+                    self._latencias.append(time.monotonic() - inicio)
+
+    async def analizar(self, png_bytes: bytes) -> pd.DataFrame:
+        """
+        Analizar un gráfico, reintentando los errores transitorios
+
+        Raises:
+            ErrorAnalisisGemini: si falla definitivamente o la respuesta no tiene filas
+        """
+        for intento in range(self.reintentos + 1):
+            await self._limitador.adquirir()
+            self._contar("llamadas")
+            try:
+                texto = await asyncio.to_thread(self._llamar, png_bytes)
+            except Exception as e:
+                if not _es_transitorio(e) or intento == self.reintentos:
+                    self._contar("errores")
+                    raise ErrorAnalisisGemini(f"Error con Gemini: {e}") from e
+                # Backoff exponencial con jitter completo
+                tope = min(
+                    GEMINI_CONFIG["backoff_max_segundos"],
+                    GEMINI_CONFIG["backoff_base_segundos"] * (2 ** intento)
+                )
+                espera = random.uniform(0, tope)
+                self._contar("reintentos")
+                logger.warning(f"Gemini falló ({e}), reintento {intento + 1}/{self.reintentos} en {espera:.1f}s")
+                await asyncio.sleep(espera)
+                continue
+
+            df = self.parser(texto)
+            if df.empty:
+                self._contar("errores")
+                raise ErrorAnalisisGemini("Gemini respondió sin filas reconocibles")
+            self._contar("exitos")
+            return df
+
+    async def analizar_lote(self, imagenes: List[bytes]) -> List[Union[pd.DataFrame, Exception]]:
+        """Analizar varios gráficos en paralelo; cada posición trae el DataFrame o la excepción"""
+        return await asyncio.gather(
+            *(self.analizar(png) for png in imagenes),
+            return_exceptions=True
+        )
+
+    def analizar_sync(self, png_bytes: bytes) -> pd.DataFrame:
+        return asyncio.run(self.analizar(png_bytes))
+
+    def analizar_lote_sync(self, imagenes: List[bytes]) -> List[Union[pd.DataFrame, Exception]]:
+        if not imagenes:
+            return []
+        return asyncio.run(self.analizar_lote(imagenes))
+
+    def metricas(self) -> Dict[str, Any]:
+        """Contadores y percentiles de latencia (ms) de las llamadas recientes"""
+        with self._lock:
+            latencias = sorted(self._latencias)
+            resultado = dict(self._contadores)
+
+        def percentil(p):
+            if not latencias:
+                return None
+            if len(latencias) == 1:
+                return round(latencias[0] * 1000, 1)
+            return round(statistics.quantiles(latencias, n=100, method="inclusive")[p - 1] * 1000, 1)
+
+        resultado.update({
+            "latencia_p50_ms": percentil(50),
+            "latencia_p90_ms": percentil(90),
+            "latencia_p99_ms": percentil(99),
+        })
+        return resultado
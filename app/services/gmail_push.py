@@ -0,0 +1,228 @@
+"""
+Modo push de Gmail
+
+En lugar de consultar la casilla de cada usuario en cada barrido, se registra
+un users.watch por usuario: Gmail publica en un topic de Pub/Sub un aviso
+{emailAddress, historyId} cada vez que cambia la casilla y la suscripción
+push lo reenvía a POST /gmail/push.
+
+Por cada aviso se recorre history.list desde el último historyId revisado y
+solo si entró un mensaje que coincide con la query de facturas se encola el
+procesamiento del usuario (trabajo "notificaciones" de la cola de
+sincronización, que ya deduplica por usuario). Los avisos repetidos o
+atrasados (Pub/Sub entrega al menos una vez) se descartan por historyId.
+
+El historyId revisado solo avanza cuando no hay nada que procesar o cuando
+el trabajo encolado termina bien: si falla (p. ej. una factura que no se
+pudo descargar), el próximo aviso vuelve a revisar desde el mismo punto.
+
+Los watch vencen a los 7 días: el programador los renueva en cada ronda y,
+con el modo push activo, el barrido periódico omite a los usuarios con un
+watch vigente salvo que su último procesamiento por push haya fallado.
+"""
+import json
+import base64
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional, Tuple
+
+from googleapiclient.errors import HttpError
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from app.config.notifications_config import GMAIL_CONFIG, GMAIL_PUSH_CONFIG
+from app.db.session import SessionLocal
+from app.models.gmail_watch_model import GmailWatch
+from app.models.user_model import User
+from app.services.extractor import get_service, listar_mensajes
+from app.services.notificaciones import notificacion_service
+from app.services.trabajos_sync import cola_trabajos
+
+logger = logging.getLogger(__name__)
+
+
+class AvisoInvalido(ValueError):
+    """El cuerpo recibido no es un aviso push de Gmail"""
+
+
+def decodificar_aviso(cuerpo: Dict[str, Any]) -> Tuple[str, int]:
+    """
+    Extraer (emailAddress, historyId) del sobre de Pub/Sub:
+    {"message": {"data": base64(json), "messageId": ...}, "subscription": ...}
+    """
+    try:
+        datos = json.loads(base64.b64decode(cuerpo["message"]["data"]).decode("utf-8"))
+        return datos["emailAddress"].lower(), int(datos["historyId"])
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        raise AvisoInvalido(f"Aviso de Gmail inválido: {e}")
+
+
+def obtener_watch(db: Session, user_id: int) -> Optional[GmailWatch]:
+    return db.query(GmailWatch).filter(GmailWatch.user_id == user_id).first()
+
+
+# === Registro de watch ===
+def registrar_watch(user: User, db: Session) -> GmailWatch:
+    """Registrar (o renovar) el users.watch del usuario sobre el topic configurado"""
+    service = get_service(user_id=user.id)
+    respuesta = service.users().watch(userId='me', body={
+        "topicName": GMAIL_PUSH_CONFIG["topic"],
+        "labelIds": GMAIL_PUSH_CONFIG["label_ids"],
+        "labelFilterBehavior": "include",
+    }).execute()
+
+    watch = obtener_watch(db, user.id)
+    if watch is None:
+        watch = GmailWatch(user_id=user.id, notificaciones=0, encolados=0)
+        db.add(watch)
+    watch.email = user.email.lower()
+    # Al renovar se conserva el historyId revisado para no perder lo que entró entretanto
+    if watch.history_id is None:
+        watch.history_id = str(respuesta["historyId"])
+    watch.expiracion = datetime.utcfromtimestamp(int(respuesta["expiration"]) / 1000)
+    db.commit()
+    logger.info(f"📬 Watch de Gmail registrado para {user.email} hasta {watch.expiracion}")
+    return watch
+
+
+def renovar_watches() -> Dict[str, int]:
+    """Registrar el watch de los usuarios que no tienen uno o lo tienen por vencer"""
+    resultado = {"registrados": 0, "vigentes": 0, "errores": 0}
+    if not GMAIL_PUSH_CONFIG["topic"]:
+        logger.warning("⚠️ GMAIL_PUSH_TOPIC no configurado, no se registran watch de Gmail")
+        return resultado
+
+    limite = datetime.utcnow() + timedelta(hours=GMAIL_PUSH_CONFIG["renovar_antes_horas"])
+    db = SessionLocal()
+    try:
+        watches = {w.user_id: w for w in db.query(GmailWatch).all()}
+        for user in notificacion_service.obtener_usuarios_con_refresh_token(db):
+            watch = watches.get(user.id)
+            if watch is not None and watch.expiracion and watch.expiracion > limite:
+                resultado["vigentes"] += 1
+                continue
+            try:
+                registrar_watch(user, db)
+                resultado["registrados"] += 1
+            except Exception as e:
+                db.rollback()
+                resultado["errores"] += 1
+                logger.error(f"Error registrando watch de Gmail para {user.email}: {e}")
+    finally:
+        db.close()
+
+    logger.info(f"📬 Watch de Gmail: {resultado['registrados']} registrados, "
+                f"{resultado['vigentes']} vigentes, {resultado['errores']} con error")
+    return resultado
+
+
+# === Avisos ===
+def hay_factura_nueva(service, desde_history_id: int) -> Tuple[bool, Optional[int]]:
+    """
+    Ver si desde `desde_history_id` entró algún mensaje que coincide con la query de facturas
+
+    Returns:
+        (hay_nueva, history_id_actual). Si Gmail ya no tiene el historial
+        pedido (404) se responde True para que el procesamiento revise la
+        casilla con el cursor de sincronización.
+    """
+    agregados = set()
+    history_id_actual = None
+    page_token = None
+    try:
+        while True:
+            respuesta = service.users().history().list(
+                userId='me',
+                startHistoryId=str(desde_history_id),
+                historyTypes=['messageAdded'],
+                pageToken=page_token,
+                fields='history(messagesAdded(message(id))),historyId,nextPageToken'
+            ).execute()
+            for cambio in respuesta.get('history', []):
+                for agregado in cambio.get('messagesAdded', []):
+                    agregados.add(agregado['message']['id'])
+            if 'historyId' in respuesta:
+                history_id_actual = int(respuesta['historyId'])
+            page_token = respuesta.get('nextPageToken')
+            if not page_token:
+                break
+    except HttpError as e:
+        if e.resp.status == 404:
+            return True, None
+        raise
+
+    if not agregados:
+        return False, history_id_actual
+
+    # Si entró una factura, está entre los len(agregados) mensajes más recientes que coinciden
+    recientes = listar_mensajes(service, GMAIL_CONFIG["email_query"], max_emails=len(agregados))
+    return any(m['id'] in agregados for m in recientes), history_id_actual
+
+
+def confirmar_historial(user_id: int, history_id: int):
+    """Avanzar el historyId revisado del usuario (nunca lo retrocede) tras procesarlo bien"""
+    db = SessionLocal()
+    try:
+        watch = obtener_watch(db, user_id)
+        if watch is None:
+            return
+        if not watch.history_id or int(watch.history_id) < history_id:
+            watch.history_id = str(history_id)
+            db.commit()
+    finally:
+        db.close()
+
+
+def procesar_aviso(email: str, history_id: int) -> Dict[str, Any]:
+    """
+    Procesar un aviso push: descartar repetidos, revisar el historial y
+    encolar el procesamiento del usuario si llegó una factura
+    """
+    db = SessionLocal()
+    try:
+        user = db.query(User).filter(func.lower(User.email) == email).first()
+        if user is None or not user.is_active or not user.gmail_refresh_token:
+            logger.info(f"📭 Aviso de Gmail para {email} ignorado: usuario desconocido o sin refresh token")
+            return {"accion": "ignorado", "email": email}
+
+        watch = obtener_watch(db, user.id)
+        if watch is None:
+            watch = GmailWatch(user_id=user.id, email=email, notificaciones=0, encolados=0)
+            db.add(watch)
+        watch.ultima_notificacion = datetime.utcnow()
+        watch.notificaciones = (watch.notificaciones or 0) + 1
+
+        anterior = int(watch.history_id) if watch.history_id else None
+        if anterior is not None and history_id <= anterior:
+            db.commit()
+            return {"accion": "repetido", "email": email, "history_id": history_id}
+
+        if anterior is None or not GMAIL_PUSH_CONFIG["verificar_historial"]:
+            # Sin punto de partida no se puede acotar el historial: revisar la casilla
+            hay_nueva, actual = True, None
+        else:
+            hay_nueva, actual = hay_factura_nueva(get_service(user_id=user.id), anterior)
+
+        hasta = max(history_id, actual or 0)
+        if not hay_nueva:
+            watch.history_id = str(hasta)
+            db.commit()
+            logger.info(f"📭 Aviso de Gmail para {email} sin facturas nuevas")
+            return {"accion": "sin_facturas", "email": email, "history_id": history_id}
+
+        # El historyId avanza cuando el trabajo termina bien (confirmar_historial)
+        job, unido = cola_trabajos.encolar(user.id, "notificaciones", {
+            "origen": "gmail_push", "history_id": hasta
+        })
+        watch.encolados = (watch.encolados or 0) + 1
+        db.commit()
+        logger.info(f"📨 Aviso de Gmail para {email}: procesamiento encolado (trabajo {job.id})")
+        return {
+            "accion": "encolado",
+            "email": email,
+            "history_id": history_id,
+            "job_id": job.id,
+            "unido_a_trabajo_en_curso": unido
+        }
+    finally:
+        db.close()
@@ -1,60 +1,241 @@
+import numpy as np
 import pandas as pd
 import re
 import os
 import google.generativeai as genai
-from pdf2image import convert_from_path
-from PIL import Image
+import fitz  # PyMuPDF
+from app.config.notifications_config import GRAFICO_CONFIG, GEMINI_CONFIG
+from app.services.gemini_cliente import ClienteGemini
 
 # Configurar Gemini usando variable de entorno
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 if not GEMINI_API_KEY:
     raise ValueError("La variable de entorno GEMINI_API_KEY no está configurada")
 
-genai.configure(api_key=GEMINI_API_KEY)
+if GEMINI_CONFIG["api_endpoint"]:
+    # Endpoint alternativo (servidor falso local para pruebas), solo con transporte REST
+    genai.configure(
+        api_key=GEMINI_API_KEY,
+        transport="rest",
+        client_options={"api_endpoint": GEMINI_CONFIG["api_endpoint"]}
+    )
+else:
+    genai.configure(api_key=GEMINI_API_KEY)
 modelo = genai.GenerativeModel("gemini-1.5-flash")
 
-def extraer_grafico(nombre_pdf, output_path, dpi=200):
+# Subir la versión cada vez que cambie el prompt para invalidar la caché de resultados
+PROMPT_VERSION = "v1"
+PROMPT_GRAFICO = (
+    "Observá este gráfico de barras titulado 'HISTÓRICO DE CONSUMO'. El eje X muestra fechas (mes/año) y el eje Y muestra consumo eléctrico en KWh,"
+    "Estimá visualmente el consumo de cada barra y devolvé una tabla con dos columnas: Fecha y Consumo (KWh). "
+    "Usá como guía los valores del eje Y. Escribí la tabla con una fila por barra, sin texto adicional. Formato:\n"
+    "Fecha | Consumo (KWh)\n"
+)
+
+def abrir_pdf(origen):
+    """
+    Abrir un PDF con PyMuPDF desde bytes, ruta o un documento ya abierto
+    """
+    if isinstance(origen, fitz.Document):
+        return origen
+    if isinstance(origen, (bytes, bytearray)):
+        return fitz.open(stream=bytes(origen), filetype="pdf")
+    return fitz.open(origen)
+
+def _region_fija(page):
+    """Región del gráfico por fracciones fijas de la página (layout histórico de EDEMSA)"""
+    rect = page.rect
+    return fitz.Rect(
+        rect.x0 + rect.width * 0.05,
+        rect.y0 + rect.height * 0.455,
+        rect.x0 + rect.width * 0.495,
+        rect.y0 + rect.height * 0.585
+    )
+
+def _unir(a, b):
+    """Unión de rectángulos que también considera líneas (rectángulos de ancho o alto cero)"""
+    return fitz.Rect(min(a.x0, b.x0), min(a.y0, b.y0), max(a.x1, b.x1), max(a.y1, b.y1))
+
+def detectar_barras(page):
+    """
+    Detectar las barras del gráfico: rectángulos rellenos que comparten la misma base
+
+    Returns:
+        Lista de fitz.Rect ordenada de izquierda a derecha (vacía si no hay gráfico)
+    """
+    por_base = {}
+    for dibujo in page.get_drawings():
+        if not dibujo.get("fill") or not dibujo["items"]:
+            continue
+        if any(item[0] != "re" for item in dibujo["items"]):
+            continue
+        rect = dibujo["rect"]
+        if rect.width <= 0 or rect.height <= 0:
+            continue
+        por_base.setdefault(round(rect.y1), []).append(rect)
+
+    if not por_base:
+        return []
+    barras = max(por_base.values(), key=len)
+    if len(barras) < GRAFICO_CONFIG["min_barras"]:
+        return []
+    return sorted(barras, key=lambda r: r.x0)
+
+def ubicar_grafico(page):
+    """
+    Ubicar el rectángulo del gráfico 'HISTÓRICO DE CONSUMO' a partir del layout
+
+    Parte de las barras vectoriales del gráfico, le suma los ejes y líneas de
+    guía que las tocan y las etiquetas de texto de alrededor. Si el PDF no
+    tiene el gráfico como vectores usa la región fija.
+    """
+    barras = detectar_barras(page)
+    if not barras:
+        return _region_fija(page)
+
+    zona = fitz.Rect(barras[0])
+    for barra in barras[1:]:
+        zona = _unir(zona, barra)
+
+    # Ejes y líneas de guía que cruzan la zona de las barras
+    margen = GRAFICO_CONFIG["margen_puntos"]
+    cercania = zona + (-margen, -margen, margen, margen)
+    for dibujo in page.get_drawings():
+        r = dibujo["rect"]
+        if not (r.x1 < cercania.x0 or r.x0 > cercania.x1 or r.y1 < cercania.y0 or r.y0 > cercania.y1):
+            zona = _unir(zona, r)
+
+    # Etiquetas de los ejes (meses, kWh) completamente dentro del margen
+    cercania = zona + (-margen, -margen, margen, margen)
+    for bloque in page.get_text("dict", clip=cercania)["blocks"]:
+        for linea in bloque.get("lines", []):
+            for span in linea["spans"]:
+                if span["text"].strip() and fitz.Rect(span["bbox"]) in cercania:
+                    zona = _unir(zona, fitz.Rect(span["bbox"]))
+
+    return (zona + (-2, -2, 2, 2)) & page.rect
+
+def extraer_grafico_png(origen, dpi=None, ancho_px=None):
+    """
+    Renderizar solo el recorte del gráfico histórico de la primera página como PNG
+
+    Args:
+        origen: Bytes del PDF, ruta o documento PyMuPDF abierto
+        dpi: Resolución fija del render (tiene prioridad sobre ancho_px)
+        ancho_px: Ancho en píxeles de la imagen de salida, pensado para el modelo de visión
+    """
     try:
-        pages = convert_from_path(nombre_pdf, dpi=dpi)
-        if not pages:
+        doc = abrir_pdf(origen)
+        if doc.page_count == 0:
             print("No se pudo renderizar el PDF.")
-            return False
-        page = pages[0]
-        width, height = page.size
-        top = int(height * 0.455)
-        bottom = int(height * 0.585)
-        left = int(width * 0.05)
-        right = int(width * 0.495)
-        grafico = page.crop((left, top, right, bottom))
-        grafico.save(output_path)
-        return True
+            return None
+        page = doc[0]
+        clip = ubicar_grafico(page)
+        if dpi:
+            pix = page.get_pixmap(dpi=dpi, clip=clip)
+        else:
+            zoom = (ancho_px or GRAFICO_CONFIG["ancho_px"]) / clip.width
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=clip)
+        return pix.tobytes("png")
     except Exception as e:
         print(f"[!] Error al extraer gráfico: {e}")
+        return None
+
+def extraer_grafico(nombre_pdf, output_path, dpi=None):
+    png_bytes = extraer_grafico_png(nombre_pdf, dpi)
+    if not png_bytes:
         return False
+    with open(output_path, "wb") as f:
+        f.write(png_bytes)
+    return True
 
-def analizar_con_gemini(nombre_imagen):
-    prompt = (
-        "Observá este gráfico de barras titulado 'HISTÓRICO DE CONSUMO'. El eje X muestra fechas (mes/año) y el eje Y muestra consumo eléctrico en KWh,"
-        "Estimá visualmente el consumo de cada barra y devolvé una tabla con dos columnas: Fecha y Consumo (KWh). "
-        "Usá como guía los valores del eje Y. Escribí la tabla con una fila por barra, sin texto adicional. Formato:\n"
-        "Fecha | Consumo (KWh)\n"
-    )
+def _spans(page, clip):
+    for bloque in page.get_text("dict", clip=clip)["blocks"]:
+        for linea in bloque.get("lines", []):
+            for span in linea["spans"]:
+                texto = span["text"].strip()
+                if texto:
+                    yield texto, fitz.Rect(span["bbox"])
+
+def extraer_historico_vectorial(origen):
+    """
+    Leer el histórico de consumo directamente de los vectores del gráfico
+
+    Usa las barras (rectángulos rellenos), las etiquetas de fecha debajo de
+    cada barra y las etiquetas numéricas del eje Y para calcular el consumo
+    de cada mes sin pasar por un modelo de visión.
+
+    Args:
+        origen: Bytes del PDF, ruta o documento PyMuPDF abierto
+
+    Returns:
+        DataFrame con columnas fecha (mm/aa) y consumo_wh, vacío si el
+        layout no se reconoce
+    """
     try:
-        with open(nombre_imagen, "rb") as f:
-            image_bytes = f.read()
-        response = modelo.generate_content([
-            prompt,
-            {
-                "mime_type": "image/png",
-                "data": image_bytes,
-            }
-        ])
-        texto = response.text.strip()
-        return parse_gemini_output(texto)
+        doc = abrir_pdf(origen)
+        if doc.page_count == 0:
+            return pd.DataFrame()
+        page = doc[0]
+        barras = detectar_barras(page)
+        if not barras:
+            return pd.DataFrame()
+
+        zona = ubicar_grafico(page)
+        base = max(barra.y1 for barra in barras)
+        inicio_barras = min(barra.x0 for barra in barras)
+
+        fechas = []  # (centro_x, texto) de las etiquetas del eje X
+        ys, valores = [], []  # centro_y y valor de las etiquetas del eje Y
+        for texto, rect in _spans(page, zona):
+            centro_y = (rect.y0 + rect.y1) / 2
+            if re.fullmatch(r"\d{2}/\d{2}", texto) and centro_y > base:
+                fechas.append(((rect.x0 + rect.x1) / 2, texto))
+            elif re.fullmatch(r"\d+", texto) and rect.x1 <= inicio_barras:
+                ys.append(centro_y)
+                valores.append(float(texto))
+
+        if len(set(ys)) < 2:
+            return pd.DataFrame()
+
+        # Escala del eje Y por mínimos cuadrados (las etiquetas vienen redondeadas)
+        pendiente, ordenada = np.polyfit(ys, valores, 1)
+        residuos = np.abs(np.polyval([pendiente, ordenada], ys) - np.array(valores))
+        if pendiente >= 0 or residuos.max() > 1 + 0.01 * max(valores):
+            return pd.DataFrame()
+
+        datos = []
+        for barra in barras:
+            centro = (barra.x0 + barra.x1) / 2
+            candidatas = [f for f in fechas if abs(f[0] - centro) <= barra.width]
+            if not candidatas:
+                return pd.DataFrame()
+            fecha = min(candidatas, key=lambda f: abs(f[0] - centro))[1]
+            # Valor del eje en el borde superior de la barra (no asume que el eje arranca en 0 en la base)
+            consumo = np.polyval([pendiente, ordenada], barra.y0)
+            datos.append({"fecha": fecha, "consumo_wh": int(round(consumo))})
+        return pd.DataFrame(datos)
     except Exception as e:
-        print(f"[!] Error con Gemini: {e}")
+        print(f"[!] Error leyendo el gráfico vectorial: {e}")
         return pd.DataFrame()
 
+def analizar_con_gemini(imagen):
+    """
+    Analizar el gráfico con Gemini (con límite de tasa y reintentos)
+
+    Args:
+        imagen: Ruta del PNG o sus bytes
+
+    Raises:
+        ErrorAnalisisGemini: si el análisis falla después de los reintentos
+    """
+    if isinstance(imagen, bytes):
+        image_bytes = imagen
+    else:
+        with open(imagen, "rb") as f:
+            image_bytes = f.read()
+    return cliente_gemini.analizar_sync(image_bytes)
+
 def parse_gemini_output(texto):
     lineas = texto.strip().splitlines()
     datos = []
@@ -67,3 +248,7 @@ def parse_gemini_output(texto):
                 except ValueError:
                     continue
     return pd.DataFrame(datos)
+
+
+# Cliente compartido: todas las sincronizaciones comparten límites y métricas
+cliente_gemini = ClienteGemini(modelo, PROMPT_GRAFICO, parse_gemini_output)
@@ -1,22 +1,57 @@
+import hashlib
 import pandas as pd
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
 from sklearn.ensemble import IsolationForest
+from sqlalchemy import and_
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from app.models.historico_model import HistoricoConsumo
 from app.models.factura_model import Factura
+from app.models.anomalia_model import AnomaliaResultado, AnomaliaVersion
+from app.config.notifications_config import ANOMALY_CONFIG
+from app.services.cache_modelos import cache_modelos
 import numpy as np
 
-def detectar_anomalias_por_nic(db: Session, nic: str, user_id: int):
+# Isolation Forest con semilla fija: mismo entrenamiento -> mismo modelo
+N_ESTIMADORES = 200
+SEMILLA = 42
+
+def cargar_historico(db: Session, nic: str, user_id: int) -> pd.DataFrame:
     # Buscar históricos a través de la relación con facturas filtrado por usuario
     query = db.query(HistoricoConsumo)\
               .join(Factura, HistoricoConsumo.factura_id == Factura.id)\
-              .filter(Factura.nic == nic, Factura.user_id == user_id)
-    
-    df = pd.read_sql(query.statement, db.bind)
+              .filter(Factura.nic == nic, Factura.user_id == user_id)\
+              .order_by(HistoricoConsumo.id)
+
+    return pd.read_sql(query.statement, db.bind)
+
+def cargar_historicos(db: Session, pares: Iterable[Tuple[int, str]]) -> Dict[Tuple[int, str], pd.DataFrame]:
+    """
+    Histórico de varios (user_id, nic) con una sola consulta
+
+    Returns:
+        DataFrame de cada par con las mismas columnas y orden que
+        cargar_historico (los pares sin histórico no aparecen)
+    """
+    pares = set(pares)
+    if not pares:
+        return {}
+    query = db.query(HistoricoConsumo, Factura.user_id.label("_user_id"), Factura.nic.label("_nic"))\
+              .join(Factura, HistoricoConsumo.factura_id == Factura.id)\
+              .filter(Factura.user_id.in_({user_id for user_id, _ in pares}),
+                      Factura.nic.in_({nic for _, nic in pares}))\
+              .order_by(HistoricoConsumo.id)
 
-    if df.empty:
-        return []
+    df = pd.read_sql(query.statement, db.bind)
+    historicos = {}
+    for (user_id, nic), grupo in df.groupby(["_user_id", "_nic"], sort=False):
+        par = (int(user_id), nic)
+        if par in pares:
+            historicos[par] = grupo.drop(columns=["_user_id", "_nic"]).reset_index(drop=True)
+    return historicos
 
-    # Convertir fechas a datetime
+def preparar_historico(df: pd.DataFrame) -> pd.DataFrame:
+    """Convertir fechas y agregar trimestre y año"""
     try:
         df["fecha"] = pd.to_datetime(df["fecha"], format="%m/%y")
     except:
@@ -24,91 +59,322 @@ def detectar_anomalias_por_nic(db: Session, nic: str, user_id: int):
     df = df.dropna(subset=["fecha"])
     df["trimestre"] = df["fecha"].dt.to_period("Q")
     df["año"] = df["fecha"].dt.year
+    return df
 
-    resultados = []
-
-    for trimestre, grupo in df.groupby("trimestre"):
-        if len(grupo) < 1:
-            continue
+def estadisticas_trimestrales(df: pd.DataFrame, trimestres: Optional[Set[pd.Period]] = None) -> pd.DataFrame:
+    """
+    Estadísticas del histórico de comparación de cada trimestre: el mismo
+    trimestre de años anteriores o, si no hay, todos los años anteriores.
+    Los trimestres sin ningún año anterior no aparecen; con `trimestres`
+    solo se calculan esos.
 
-        num_trim = trimestre.quarter
-        año_actual = grupo["año"].iloc[0]
-        historico = df[(df["fecha"].dt.quarter == num_trim) & (df["año"] < año_actual)]
+    Returns:
+        DataFrame indexado por trimestre con promedio, std, q25, q75 y los
+        valores de entrenamiento (en el orden del histórico)
+    """
+    consumo = df["consumo_kwh"]
+    num_trim = df["fecha"].dt.quarter.to_numpy()
+    años = df["año"].to_numpy()
 
-        if len(historico) < 1:
+    filas = {}
+    for trimestre in sorted(df["trimestre"].unique()):
+        if trimestres is not None and trimestre not in trimestres:
+            continue
+        anteriores = años < trimestre.year
+        mascara = anteriores & (num_trim == trimestre.quarter)
+        if not mascara.any():
             # Si no hay datos históricos, usar todo el historial disponible
-            historico = df[df["año"] < año_actual]
-            if len(historico) < 1:
+            mascara = anteriores
+            if not mascara.any():
                 continue
+        historico = consumo[mascara]
+        filas[trimestre] = {
+            "promedio": historico.mean(),
+            "std": historico.std(),
+            "q25": historico.quantile(0.25),
+            "q75": historico.quantile(0.75),
+            "entrenamiento": historico.to_numpy(),
+        }
+    return pd.DataFrame.from_dict(filas, orient="index")
+
+def _isolation_forest(entrenamiento: np.ndarray, contaminacion: float) -> IsolationForest:
+    """Forest entrenado, reutilizado de la caché si ya se entrenó con los mismos datos y parámetros"""
+    parametros = {"modelo": "IsolationForest", "contamination": contaminacion,
+                  "random_state": SEMILLA, "n_estimators": N_ESTIMADORES}
+
+    def entrenar() -> IsolationForest:
+        modelo = IsolationForest(contamination=contaminacion, random_state=SEMILLA, n_estimators=N_ESTIMADORES)
+        modelo.fit(np.asarray(entrenamiento).reshape(-1, 1))
+        return modelo
+
+    return cache_modelos.obtener(entrenamiento, parametros, entrenar)
 
-        X_train = historico[["consumo_kwh"]]
-        X_test = grupo[["consumo_kwh"]]
-
-        # 🔧 MEJORAS EN EL MODELO DE DETECCIÓN
-        
-        # 1. Calcular estadísticas del histórico
-        promedio_historico = X_train["consumo_kwh"].mean()
-        std_historico = X_train["consumo_kwh"].std()
-        q75 = X_train["consumo_kwh"].quantile(0.75)
-        q25 = X_train["consumo_kwh"].quantile(0.25)
-        iqr = q75 - q25
-        
-        # 2. Usar modelo de Isolation Forest con configuración mejorada
+def _scores_isolation_forest(resultado: pd.DataFrame, estadisticas: pd.DataFrame) -> np.ndarray:
+    """decision_function de cada fila con el forest de su trimestre"""
+    consumo = resultado["consumo_kwh"].to_numpy()
+    scores = np.empty(len(resultado))
+    for trimestre, posiciones in resultado.groupby("trimestre").indices.items():
+        entrenamiento = estadisticas.at[trimestre, "entrenamiento"]
         # Contamination más agresiva para detectar extremos
-        contamination_rate = min(0.3, max(0.05, 1.0 / len(X_train))) if len(X_train) > 3 else 0.5
-        modelo = IsolationForest(contamination=contamination_rate, random_state=42, n_estimators=200)
-        modelo.fit(X_train)
-
-        grupo = grupo.copy()
-        
-        # 3. Predicción del modelo
-        prediccion_modelo = modelo.predict(X_test)
-        scores_modelo = modelo.decision_function(X_test)
-        
-        # 4. REGLAS ADICIONALES PARA DETECCIÓN EXTREMA
-        # Detectar anomalías por desviación extrema (>300% o <-70%)
-        variaciones = ((grupo["consumo_kwh"] - promedio_historico) / promedio_historico * 100)
-        
-        anomalias_finales = []
-        for i, (score, variacion, consumo) in enumerate(zip(scores_modelo, variaciones, grupo["consumo_kwh"])):
-            # Regla 1: Modelo detecta anomalía
-            anomalia_modelo = prediccion_modelo[i] == -1
-            
-            # Regla 2: Variación extrema (>200% o <-60%)
-            anomalia_extrema = abs(variacion) > 200
-            
-            # Regla 3: Fuera del rango IQR extremo (>3*IQR del Q75)
-            anomalia_iqr = consumo > (q75 + 3 * iqr) or consumo < (q25 - 3 * iqr)
-            
-            # Regla 4: Más de 4 desviaciones estándar
-            anomalia_std = abs(consumo - promedio_historico) > (4 * std_historico)
-            
-            # DECISIÓN FINAL: Es anomalía si cumple cualquiera de las reglas
-            es_anomalia = anomalia_modelo or anomalia_extrema or anomalia_iqr or anomalia_std
-            
-            anomalias_finales.append(-1 if es_anomalia else 1)
-        
-        grupo["anomalia"] = anomalias_finales
-        grupo["score"] = scores_modelo
-        grupo["trimestre"] = grupo["trimestre"].astype(str)
-        
-        # 5. Calcular comparación con promedio histórico
-        grupo["comparado_trimestre"] = ((grupo["consumo_kwh"] - promedio_historico) / promedio_historico * 100).round(1)
-        
-        # 6. Agregar información de debugging
-        grupo["promedio_historico"] = promedio_historico
-        grupo["std_historico"] = std_historico
-        grupo["variacion_abs"] = abs(grupo["comparado_trimestre"])
-
-        resultados.append(grupo)
-
-       
-    if resultados:
-        return pd.concat(resultados).to_dict(orient="records")
-    return []
+        n = len(entrenamiento)
+        contaminacion = min(0.3, max(0.05, 1.0 / n)) if n > 3 else 0.5
+        modelo = _isolation_forest(entrenamiento, contaminacion)
+        scores[posiciones] = modelo.decision_function(consumo[posiciones].reshape(-1, 1))
+    return scores
 
-def alerta_anomalia_actual(db: Session, nic: str, user_id: int):
-    anomalias = detectar_anomalias_por_nic(db, nic, user_id)
+def calcular_anomalias(df: pd.DataFrame, usar_isolation_forest: bool = None,
+                       trimestres: Optional[Set[pd.Period]] = None) -> pd.DataFrame:
+    """
+    Evaluar las reglas de anomalía sobre todos los trimestres a la vez
+
+    Es anomalía (-1) si cumple cualquiera de:
+    1. El Isolation Forest del trimestre la marca (score < 0), si está habilitado
+    2. Variación mayor al 200% respecto del promedio histórico
+    3. Fuera del rango IQR extremo (3*IQR sobre Q75 o bajo Q25)
+    4. Más de 4 desviaciones estándar del promedio histórico
+
+    Args:
+        df: Histórico con fecha (texto "mm/yy") y consumo_kwh
+        usar_isolation_forest: None toma ANOMALY_CONFIG; sin forest el score es 0
+        trimestres: Evaluar solo las filas de estos trimestres (el histórico
+            de comparación sigue saliendo de todo `df`)
+    """
+    if usar_isolation_forest is None:
+        usar_isolation_forest = ANOMALY_CONFIG["usar_isolation_forest"]
+
+    df = preparar_historico(df)
+    estadisticas = estadisticas_trimestrales(df, trimestres)
+    if estadisticas.empty:
+        return df.iloc[0:0]
+
+    # Filas con histórico de comparación, agrupadas por trimestre como en groupby
+    resultado = df[df["trimestre"].isin(estadisticas.index)]
+    resultado = resultado.sort_values("trimestre", kind="stable")
+
+    por_fila = estadisticas.reindex(resultado["trimestre"])
+    promedio = pd.Series(por_fila["promedio"].to_numpy(dtype=float), index=resultado.index)
+    std = por_fila["std"].to_numpy(dtype=float)
+    q25 = por_fila["q25"].to_numpy(dtype=float)
+    q75 = por_fila["q75"].to_numpy(dtype=float)
+    iqr = q75 - q25
+    consumo = resultado["consumo_kwh"]
+
+    if usar_isolation_forest:
+        scores = _scores_isolation_forest(resultado, estadisticas)
+    else:
+        scores = np.zeros(len(resultado))
+
+    variaciones = (consumo - promedio) / promedio * 100
+    anomalia_modelo = scores < 0
+    anomalia_extrema = (variaciones.abs() > 200).to_numpy()
+    anomalia_iqr = ((consumo > (q75 + 3 * iqr)) | (consumo < (q25 - 3 * iqr))).to_numpy()
+    anomalia_std = ((consumo - promedio).abs() > (4 * std)).to_numpy()
+    es_anomalia = anomalia_modelo | anomalia_extrema | anomalia_iqr | anomalia_std
+
+    resultado = resultado.copy()
+    resultado["anomalia"] = np.where(es_anomalia, -1, 1).astype("int64")
+    resultado["score"] = scores
+    resultado["trimestre"] = resultado["trimestre"].astype(str)
+
+    # Comparación con el promedio histórico e información de debugging
+    resultado["comparado_trimestre"] = ((consumo - promedio) / promedio * 100).round(1)
+    resultado["promedio_historico"] = promedio
+    resultado["std_historico"] = std
+    resultado["variacion_abs"] = abs(resultado["comparado_trimestre"])
+    return resultado
+
+# === Resultados persistidos (tabla anomalia_resultado) ===
+# Columnas de cada registro, en el orden que devuelve calcular_anomalias
+COLUMNAS_RESULTADO = [
+    "id", "fecha", "consumo_kwh", "factura_id", "trimestre", "año", "anomalia", "score",
+    "comparado_trimestre", "promedio_historico", "std_historico", "variacion_abs"
+]
+COLUMNAS_FLOAT = ["consumo_kwh", "score", "comparado_trimestre", "promedio_historico", "std_historico", "variacion_abs"]
+
+def trimestres_afectados(df: pd.DataFrame, historico_ids: List[int]) -> Set[pd.Period]:
+    """
+    Trimestres cuyo resultado cambia al agregar los registros `historico_ids`
+    (df ya preparado): el trimestre de cada registro nuevo, el mismo
+    trimestre de años posteriores y los trimestres posteriores que se
+    comparan contra todos los años anteriores por no tener el suyo
+    """
+    nuevos = set(df.loc[df["id"].isin(historico_ids), "trimestre"].unique())
+    num_trim = df["fecha"].dt.quarter.to_numpy()
+    años = df["año"].to_numpy()
+
+    afectados = set(nuevos)
+    for trimestre in df["trimestre"].unique():
+        if trimestre in afectados:
+            continue
+        sin_mismo_trimestre = not ((años < trimestre.year) & (num_trim == trimestre.quarter)).any()
+        if any(trimestre.year > nuevo.year and (trimestre.quarter == nuevo.quarter or sin_mismo_trimestre)
+               for nuevo in nuevos):
+            afectados.add(trimestre)
+    return afectados
+
+def _guardar_resultados(db: Session, user_id: int, nic: str, resultado: Optional[pd.DataFrame],
+                        trimestres: Optional[Set[pd.Period]], version: int):
+    """Reemplazar los resultados del NIC (o solo los de `trimestres`)"""
+    anteriores = db.query(AnomaliaResultado).filter(
+        AnomaliaResultado.user_id == user_id,
+        AnomaliaResultado.nic == nic
+    )
+    if trimestres is not None:
+        anteriores = anteriores.filter(AnomaliaResultado.trimestre.in_([str(t) for t in trimestres]))
+    anteriores.delete(synchronize_session=False)
+
+    if resultado is None or resultado.empty:
+        return
+    db.bulk_insert_mappings(AnomaliaResultado, filas_resultado(user_id, nic, resultado, version))
+
+def filas_resultado(user_id: int, nic: str, resultado: pd.DataFrame, version: Optional[int]) -> List[Dict[str, Any]]:
+    """Filas de anomalia_resultado (para bulk_insert_mappings) a partir de calcular_anomalias"""
+    filas = []
+    if resultado.empty:
+        return filas
+    for registro in resultado[COLUMNAS_RESULTADO].to_dict(orient="records"):
+        fila = {
+            "user_id": user_id,
+            "nic": nic,
+            "historico_id": registro["id"],
+            "factura_id": registro["factura_id"],
+            "fecha": registro["fecha"].to_pydatetime(),
+            "trimestre": registro["trimestre"],
+            "anio": registro["año"],
+            "anomalia": registro["anomalia"],
+            "version": version,
+        }
+        for columna in COLUMNAS_FLOAT:
+            fila[columna] = None if pd.isna(registro[columna]) else registro[columna]
+        filas.append(fila)
+    return filas
+
+def huella_historico(df: pd.DataFrame) -> str:
+    """
+    Hash del contenido del histórico (id, fecha, consumo, factura): cambia si
+    se agrega, borra o edita cualquier registro, no solo si cambia la cantidad
+    """
+    normalizado = pd.DataFrame({
+        "id": df["id"].astype("int64"),
+        "fecha": df["fecha"].astype(str),
+        "consumo_kwh": pd.to_numeric(df["consumo_kwh"], errors="coerce").astype("float64"),
+        "factura_id": pd.to_numeric(df["factura_id"], errors="coerce").astype("float64"),
+    })
+    filas = pd.util.hash_pandas_object(normalizado, index=False).to_numpy()
+    return hashlib.sha256(filas.tobytes()).hexdigest()
+
+def actualizar_anomalias(db: Session, user_id: int, nic: str, historico_ids: Optional[List[int]] = None,
+                         df: Optional[pd.DataFrame] = None) -> int:
+    """
+    Recalcular y guardar los resultados de anomalías de un NIC
+
+    Con `historico_ids` (registros recién agregados) solo se recalculan los
+    trimestres afectados. Si la huella guardada no coincide con la del resto
+    del histórico (se editó o borró algún registro, o cambió por otro camino)
+    o el NIC nunca se calculó, se recalcula todo.
+    `df` es el histórico ya cargado (cargar_historicos); si no, se consulta.
+
+    Returns:
+        Cantidad de registros recalculados
+    """
+    if df is None:
+        df = cargar_historico(db, nic, user_id)
+    estado = db.query(AnomaliaVersion).filter(
+        AnomaliaVersion.user_id == user_id,
+        AnomaliaVersion.nic == nic
+    ).first()
+
+    huella = huella_historico(df)
+    trimestres = None
+    if historico_ids and estado is not None and estado.huella and not df.empty:
+        previos = df[~df["id"].isin(historico_ids)]
+        if huella_historico(previos) == estado.huella:
+            trimestres = trimestres_afectados(preparar_historico(df.copy()), historico_ids)
+
+    version = (estado.version or 0) + 1 if estado is not None else 1
+    resultado = calcular_anomalias(df, trimestres=trimestres) if not df.empty else None
+
+    try:
+        _guardar_resultados(db, user_id, nic, resultado, trimestres, version)
+        if estado is None:
+            estado = AnomaliaVersion(user_id=user_id, nic=nic)
+            db.add(estado)
+        estado.version = version
+        estado.registros = len(df)
+        estado.huella = huella
+        estado.ultimo_historico_id = int(df["id"].max()) if not df.empty else None
+        db.commit()
+    except IntegrityError:
+        # Otro proceso calculó el mismo NIC al mismo tiempo
+        db.rollback()
+        return 0
+    return 0 if resultado is None else len(resultado)
+
+def leer_anomalias_batch(db: Session, pares: Iterable[Tuple[int, str]]) -> Dict[Tuple[int, str], List[Dict[str, Any]]]:
+    """
+    Resultados guardados de varios (user_id, nic) con una sola consulta indexada
+
+    Returns:
+        Registros de cada par en el formato de calcular_anomalias; los pares
+        que todavía no se calcularon no aparecen
+    """
+    pares = set(pares)
+    if not pares:
+        return {}
+    filas = db.query(
+        AnomaliaVersion.user_id, AnomaliaVersion.nic,
+        AnomaliaResultado.historico_id, AnomaliaResultado.fecha, AnomaliaResultado.consumo_kwh,
+        AnomaliaResultado.factura_id, AnomaliaResultado.trimestre, AnomaliaResultado.anio,
+        AnomaliaResultado.anomalia, AnomaliaResultado.score, AnomaliaResultado.comparado_trimestre,
+        AnomaliaResultado.promedio_historico, AnomaliaResultado.std_historico, AnomaliaResultado.variacion_abs
+    ).outerjoin(AnomaliaResultado, and_(
+        AnomaliaResultado.user_id == AnomaliaVersion.user_id,
+        AnomaliaResultado.nic == AnomaliaVersion.nic
+    )).filter(
+        AnomaliaVersion.user_id.in_({user_id for user_id, _ in pares}),
+        AnomaliaVersion.nic.in_({nic for _, nic in pares})
+    ).order_by(
+        AnomaliaVersion.user_id, AnomaliaVersion.nic,
+        AnomaliaResultado.trimestre, AnomaliaResultado.historico_id
+    ).all()
+
+    resultados: Dict[Tuple[int, str], List[Dict[str, Any]]] = {}
+    claves, con_datos = [], []
+    for fila in filas:
+        par = (fila[0], fila[1])
+        if par not in pares:
+            continue
+        resultados.setdefault(par, [])
+        if fila[2] is not None:
+            claves.append(par)
+            con_datos.append(tuple(fila)[2:])
+    if con_datos:
+        df = pd.DataFrame(con_datos, columns=COLUMNAS_RESULTADO)
+        df["fecha"] = pd.to_datetime(df["fecha"])
+        df[COLUMNAS_FLOAT] = df[COLUMNAS_FLOAT].astype(float)
+        for par, registro in zip(claves, df.to_dict(orient="records")):
+            resultados[par].append(registro)
+    return resultados
+
+def leer_anomalias(db: Session, nic: str, user_id: int) -> Optional[List[Dict[str, Any]]]:
+    """
+    Resultados guardados del NIC
+
+    Returns:
+        Registros en el formato de calcular_anomalias, o None si el NIC
+        todavía no se calculó
+    """
+    return leer_anomalias_batch(db, [(user_id, nic)]).get((user_id, nic))
+
+def detectar_anomalias_por_nic(db: Session, nic: str, user_id: int):
+    registros = leer_anomalias(db, nic, user_id)
+    if registros is None:
+        # Primera consulta del NIC: calcular todo y guardar
+        actualizar_anomalias(db, user_id, nic)
+        registros = leer_anomalias(db, nic, user_id) or []
+    return registros
+
+def _alerta_mas_reciente(anomalias: List[Dict[str, Any]]) -> Dict[str, Any]:
     if not anomalias:
         return {"estado": "sin_datos"}
     anomalias.sort(key=lambda x: pd.to_datetime(x["fecha"]))
@@ -120,3 +386,31 @@ def alerta_anomalia_actual(db: Session, nic: str, user_id: int):
         "score": mas_reciente["score"],
         "comparado_trimestre": mas_reciente.get("comparado_trimestre")
     }
+
+def alerta_anomalia_actual(db: Session, nic: str, user_id: int):
+    return _alerta_mas_reciente(detectar_anomalias_por_nic(db, nic, user_id))
+
+def alertas_anomalias_batch(db: Session, pares: Iterable[Tuple[int, str]]) -> Dict[Tuple[int, str], Dict[str, Any]]:
+    """
+    Alerta del consumo más reciente de muchos (user_id, nic) a la vez
+
+    Los resultados guardados se leen con una sola consulta. Los pares que
+    nunca se calcularon cargan su histórico también con una sola consulta,
+    se calculan (compartiendo los forests de la caché de modelos) y se
+    guardan.
+
+    Returns:
+        {(user_id, nic): alerta} con el formato de alerta_anomalia_actual
+    """
+    pares = list(dict.fromkeys((int(user_id), nic) for user_id, nic in pares))
+    registros = leer_anomalias_batch(db, pares)
+
+    faltantes = [par for par in pares if par not in registros]
+    if faltantes:
+        historicos = cargar_historicos(db, faltantes)
+        vacio = pd.DataFrame(columns=["id", "fecha", "consumo_kwh", "factura_id"])
+        for user_id, nic in faltantes:
+            actualizar_anomalias(db, user_id, nic, df=historicos.get((user_id, nic), vacio))
+        registros.update(leer_anomalias_batch(db, faltantes))
+
+    return {par: _alerta_mas_reciente(registros.get(par) or []) for par in pares}
@@ -0,0 +1,190 @@
+"""
+Pool de navegadores headless compartido
+
+Mantiene unos pocos procesos de Chromium calientes para obtener las cookies
+de sesión de EDEMSA sin lanzar un navegador nuevo por cada factura.
+
+La API sync de Playwright solo puede usarse desde el hilo que la creó, así
+que cada navegador vive en su propio hilo trabajador y las tareas se le
+envían a través de una cola. Cada tarea recibe un contexto nuevo (cookies
+aisladas) que se cierra al terminar, y cada navegador se recicla después de
+un número configurable de usos.
+
+Si Playwright no arranca, el hilo falla las tareas que estaban esperando
+(en vez de dejarlas vencer su timeout) y termina; el pool lo vuelve a crear
+en el próximo pedido.
+"""
+import time
+import queue
+import logging
+import threading
+import concurrent.futures
+from typing import Any, Callable, Optional
+
+from playwright.sync_api import sync_playwright
+
+from app.config.notifications_config import NAVEGADOR_CONFIG
+
+logger = logging.getLogger(__name__)
+
+_FIN = object()
+
+
+class _TrabajadorNavegador(threading.Thread):
+    """Hilo dueño de un proceso de Chromium"""
+
+    def __init__(self, numero: int, tareas: "queue.Queue", headless: bool, usos_maximos: int):
+        super().__init__(name=f"navegador-{numero}", daemon=True)
+        self.numero = numero
+        self.tareas = tareas
+        self.headless = headless
+        self.usos_maximos = usos_maximos
+        self._playwright = None
+        self._browser = None
+        self._usos = 0
+
+    def _navegador(self):
+        if self._browser is None or not self._browser.is_connected():
+            self._cerrar_navegador()
+            self._browser = self._playwright.chromium.launch(headless=self.headless)
+            self._usos = 0
+            logger.info(f"🌐 {self.name}: Chromium iniciado (headless={self.headless})")
+        return self._browser
+
+    def _cerrar_navegador(self):
+        if self._browser is not None:
+            try:
+                self._browser.close()
+            except Exception as e:
+                logger.warning(f"{self.name}: error cerrando Chromium: {e}")
+            self._browser = None
+
+    def _fallar_pendientes(self, error: Exception):
+        """Fallar las tareas en cola (las de _FIN se devuelven para los demás hilos)"""
+        fines = 0
+        while True:
+            try:
+                tarea = self.tareas.get_nowait()
+            except queue.Empty:
+                break
+            if tarea is _FIN:
+                fines += 1
+                continue
+            _, future = tarea
+            if future.set_running_or_notify_cancel():
+                future.set_exception(error)
+        for _ in range(fines):
+            self.tareas.put(_FIN)
+
+    def run(self):
+        try:
+            self._playwright = sync_playwright().start()
+        except Exception as e:
+            logger.error(f"❌ {self.name}: no se pudo iniciar Playwright: {e}")
+            self._fallar_pendientes(e)
+            return
+        try:
+            while True:
+                tarea = self.tareas.get()
+                if tarea is _FIN:
+                    break
+                funcion, future = tarea
+                if not future.set_running_or_notify_cancel():
+                    continue
+
+                context = None
+                try:
+                    context = self._navegador().new_context()
+                    future.set_result(funcion(context))
+                except Exception as e:
+                    future.set_exception(e)
+                finally:
+                    if context is not None:
+                        try:
+                            context.close()
+                        except Exception:
+                            pass
+                    self._usos += 1
+                    if self._usos >= self.usos_maximos:
+                        logger.info(f"♻️ {self.name}: reciclando Chromium tras {self._usos} usos")
+                        self._cerrar_navegador()
+        finally:
+            self._cerrar_navegador()
+            try:
+                self._playwright.stop()
+            except Exception as e:
+                logger.warning(f"{self.name}: error deteniendo Playwright: {e}")
+
+
+class PoolNavegadores:
+    """Pool de navegadores que entrega contextos nuevos a cada tarea"""
+
+    def __init__(self, tamano: int = None, usos_maximos: int = None, headless: bool = None):
+        self.tamano = tamano or NAVEGADOR_CONFIG["tamano_pool"]
+        self.usos_maximos = usos_maximos or NAVEGADOR_CONFIG["usos_maximos"]
+        self.headless = NAVEGADOR_CONFIG["headless"] if headless is None else headless
+        self._tareas: "queue.Queue" = queue.Queue()
+        self._trabajadores = []
+        self._lock = threading.Lock()
+
+    def iniciar(self):
+        """Arrancar los hilos de navegador que falten (los que murieron se reemplazan)"""
+        with self._lock:
+            vivos = [trabajador for trabajador in self._trabajadores if trabajador.is_alive()]
+            if len(vivos) == self.tamano:
+                return
+            if self._trabajadores:
+                logger.warning(f"🌐 Reemplazando {self.tamano - len(vivos)} hilos de navegador caídos")
+            numeros = {trabajador.numero for trabajador in vivos}
+            for numero in range(1, self.tamano + 1):
+                if numero in numeros:
+                    continue
+                trabajador = _TrabajadorNavegador(numero, self._tareas, self.headless, self.usos_maximos)
+                trabajador.start()
+                vivos.append(trabajador)
+            if not self._trabajadores:
+                logger.info(f"🌐 Pool de navegadores iniciado con {self.tamano} procesos")
+            self._trabajadores = vivos
+
+    def ejecutar(self, funcion: Callable[[Any], Any], timeout: Optional[float] = None) -> Any:
+        """
+        Ejecutar funcion(context) en un contexto de navegador nuevo
+
+        Args:
+            funcion: Recibe un BrowserContext de Playwright y devuelve un resultado
+            timeout: Segundos máximos de espera del resultado
+
+        Returns:
+            Lo que devuelva `funcion`
+        """
+        future = concurrent.futures.Future()
+        # Encolar antes de arrancar: un hilo que no puede iniciar Playwright la falla enseguida
+        self._tareas.put((funcion, future))
+        self.iniciar()
+        timeout = timeout or NAVEGADOR_CONFIG["timeout_tarea_segundos"]
+        limite = time.monotonic() + timeout
+        while True:
+            concurrent.futures.wait([future], timeout=max(0, min(1, limite - time.monotonic())))
+            if future.done():
+                return future.result()
+            if time.monotonic() >= limite:
+                # Si todavía no empezó, ningún hilo la va a ejecutar (se saltea al sacarla de la cola)
+                future.cancel()
+                raise concurrent.futures.TimeoutError(f"El navegador no respondió en {timeout}s")
+            # Reemplazar los hilos que hayan caído mientras se espera
+            self.iniciar()
+
+    def cerrar(self, timeout: float = 30):
+        """Cerrar todos los navegadores del pool"""
+        with self._lock:
+            trabajadores, self._trabajadores = self._trabajadores, []
+        for _ in trabajadores:
+            self._tareas.put(_FIN)
+        for trabajador in trabajadores:
+            trabajador.join(timeout=timeout)
+        if trabajadores:
+            logger.info("🌐 Pool de navegadores cerrado")
+
+
+# Instancia global del pool
+pool_navegadores = PoolNavegadores()
@@ -1,11 +1,15 @@
+import time
 import smtplib
 import logging
+import threading
+import statistics
+import concurrent.futures
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from typing import List, Dict, Any
+from typing import Callable, List, Dict, Any, Optional, Tuple
 from datetime import datetime, timedelta
 from sqlalchemy.orm import Session
-from sqlalchemy import desc
+from sqlalchemy import desc, func
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
@@ -13,11 +17,21 @@ from googleapiclient.discovery import build
 from app.db.session import SessionLocal
 from app.models.user_model import User
 from app.models.factura_model import Factura
+from app.models.gmail_watch_model import GmailWatch
+from app.models.sync_job_model import SyncJob
 from app.crud.user_crud import get_user_by_email
-from app.services.extractor import get_service, get_edemsa_links, descargar_factura_pdf
-from app.services.modelo import detectar_anomalias_por_nic, alerta_anomalia_actual
+from app.crud.factura_crud import links_ya_descargados
+from app.services.extractor import (
+    get_service, get_edemsa_links, descargar_factura_pdf,
+    buscar_links_nuevos, guardar_cursor_sync, marca_procesada, analizar_historicos_pendientes
+)
+from app.services.descargas import descargar_en_paralelo, con_cancelacion, verificar_cancelacion, DescargaCancelada
+from app.services.modelo import detectar_anomalias_por_nic, alertas_anomalias_batch
 from app.services.auth import SCOPES
-from app.config.notifications_config import GOOGLE_OAUTH_CONFIG, GMAIL_CONFIG, ANOMALY_CONFIG
+from app.services.vuelo_unico import vuelo_por_usuario
+from app.services.grafico import cliente_gemini
+from app.services.tokens_gmail import gestor_tokens
+from app.config.notifications_config import GOOGLE_OAUTH_CONFIG, GMAIL_CONFIG, ANOMALY_CONFIG, MONITORING_CONFIG, GMAIL_PUSH_CONFIG
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
@@ -29,6 +43,9 @@ class NotificacionService:
     def __init__(self):
         self.smtp_server = GMAIL_CONFIG["smtp_server"]
         self.smtp_port = GMAIL_CONFIG["smtp_port"]
+        # user_id -> momento (time.time) del último procesamiento, para el orden justo del barrido
+        self._ultimo_procesamiento: Dict[int, float] = {}
+        self._lock = threading.Lock()
     
     def obtener_usuarios_con_refresh_token(self, db: Session) -> List[User]:
         """Obtener todos los usuarios que tienen refresh token configurado"""
@@ -96,24 +113,16 @@ class NotificacionService:
     
     def buscar_email_mas_reciente(self, user: User, db: Session) -> List[str]:
         """Buscar el email más reciente de EDEMSA Factura Digital (sin filtros de fecha)"""
+        links, _ = self._buscar_links_nuevos(user, db)
+        return links
+    
+    def _buscar_links_nuevos(self, user: User, db: Session) -> Tuple[List[str], List[Dict[str, Any]]]:
+        """Buscar links en emails posteriores al cursor del usuario, devolviendo también los mensajes con su marca"""
         try:
             logger.info(f"🔍 Buscando el email más reciente de EDEMSA para {user.email}")
             
-            # Renovar access token si es necesario
-            if not user.gmail_token:
-                logger.info(f"Renovando access token para {user.email}")
-                nuevo_token = self.renovar_access_token(user.gmail_refresh_token)
-                if not nuevo_token:
-                    logger.error(f"No se pudo renovar token para usuario {user.email}")
-                    return []
-                
-                # Actualizar token en la base de datos
-                user.gmail_token = nuevo_token
-                db.commit()
-                db.refresh(user)
-                logger.info(f"Token renovado y guardado para {user.email}")
-            
-            service = get_service(user.gmail_token, user.gmail_refresh_token)
+            # El gestor de tokens renueva el access token antes de que venza
+            service = get_service(user_id=user.id)
             
             # Query simplificado - solo el email más reciente
             search_query = GMAIL_CONFIG["email_query"]
@@ -124,106 +133,69 @@ class NotificacionService:
             
             logger.info(f"Query Gmail simplificado: {query} (máximo {max_emails} emails)")
             
-            # Buscar mensajes - solo el más reciente
-            results = service.users().messages().list(
-                userId='me', 
-                q=query, 
-                maxResults=max_emails  # Solo 1 email
-            ).execute()
-            messages = results.get('messages', [])
-            
-            logger.info(f"📧 Encontrado {len(messages)} email más reciente para {user.email}")
-            
-            # Extraer links de EDEMSA
-            links = []
-            for msg in messages:
-                try:
-                    msg_data = service.users().messages().get(userId='me', id=msg['id'], format='full').execute()
-                    # Reutilizar la lógica del extractor existente
-                    html_data = self._get_html_part(msg_data['payload'])
-                    if html_data:
-                        import base64
-                        import re
-                        html = base64.urlsafe_b64decode(html_data + '===').decode('utf-8', errors='ignore')
-                        encontrados = re.findall(r'https://oficinavirtual\.edemsa\.com/facturad\.php\?conf=[^"]+', html)
-                        links.extend(encontrados)
-                except Exception as e:
-                    logger.error(f"Error procesando email: {str(e)}")
-                    continue
-            
-            return list(set(links))
+            # Buscar solo mensajes posteriores al cursor del usuario
+            links, mensajes = buscar_links_nuevos(service, user.id, max_emails, query=query)
+            
+            logger.info(f"📧 Encontrados {len(links)} links nuevos para {user.email}")
+            
+            return links, mensajes
             
         except Exception as e:
             logger.error(f"Error buscando emails para {user.email}: {str(e)}")
-            return []
+            return [], []
     
-    def _get_html_part(self, payload):
-        """Extraer parte HTML del payload del email"""
-        if 'parts' in payload:
-            for part in payload['parts']:
-                if part.get('mimeType') == 'text/html':
-                    return part['body'].get('data')
-                elif part.get('parts'):
-                    return self._get_html_part(part)
-        elif payload.get('mimeType') == 'text/html':
-            return payload['body'].get('data')
-        return None
-    
-    def procesar_nuevas_facturas(self, user_id: int, links: List[str], db: Session) -> List[Factura]:
-        """Procesar y guardar nuevas facturas con validación de duplicados"""
-        import asyncio
-        import concurrent.futures
-        
-        nuevas_facturas = []
-        facturas_duplicadas = 0
-        
+    def procesar_nuevas_facturas(self, user_id: int, links: List[str], db: Session) -> Dict[str, Any]:
+        """
+        Procesar y guardar nuevas facturas con validación de duplicados
+
+        Los links ya descargados se descartan con una sola consulta antes de
+        descargar nada; el resto se descarga en paralelo (límite global y por
+        host, timeout con cancelación) y los gráficos que requieren Gemini se
+        analizan después en lote.
+
+        Returns:
+            {"nuevas": [facturas], "duplicadas": n, "fallidas": n, "links_fallidos": [links]}
+        """
         logger.info(f"📋 Procesando {len(links)} facturas para usuario {user_id}")
         
-        # Función wrapper para ejecutar de forma síncrona
-        def procesar_factura_sync(link, index):
-            try:
-                return descargar_factura_pdf(link, index, user_id)
-            except Exception as e:
-                logger.error(f"Error procesando factura {link}: {str(e)}")
-                return None
+        ya_descargados = links_ya_descargados(db, user_id, links)
+        links_pendientes = [link for link in links if link not in ya_descargados]
+        if ya_descargados:
+            logger.info(f"⚠️ {len(ya_descargados)} facturas ya descargadas, se omiten")
         
-        # Ejecutar en un thread pool para evitar conflictos con asyncio
-        try:
-            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-                for i, link in enumerate(links):
-                    try:
-                        logger.info(f"📄 Procesando factura {i+1}/{len(links)}")
-                        # Ejecutar en un thread separado
-                        future = executor.submit(procesar_factura_sync, link, i)
-                        factura = future.result(timeout=300)  # 5 minutos timeout
-                        
-                        if factura:
-                            # Verificar si ya existe esta factura
-                            factura_existente = db.query(Factura).filter(
-                                Factura.nic == factura.nic,
-                                Factura.user_id == user_id,
-                                Factura.fecha_lectura == factura.fecha_lectura
-                            ).first()
-                            
-                            if factura_existente:
-                                logger.info(f"⚠️ Factura duplicada omitida: NIC {factura.nic}, fecha {factura.fecha_lectura}")
-                                facturas_duplicadas += 1
-                            else:
-                                nuevas_facturas.append(factura)
-                                logger.info(f"✅ Procesada factura nueva: NIC {factura.nic} para usuario {user_id}")
-                        
-                    except concurrent.futures.TimeoutError:
-                        logger.error(f"❌ Timeout procesando factura {link}")
-                        continue
-                    except Exception as e:
-                        logger.error(f"❌ Error procesando factura {link}: {str(e)}")
-                        continue
+        facturas = descargar_en_paralelo(
+            links_pendientes,
+            lambda link, i: descargar_factura_pdf(link, i, user_id, analizar_gemini=False)
+        )
         
-        except Exception as e:
-            logger.error(f"❌ Error general procesando facturas: {str(e)}")
+        nuevas_facturas = []
+        facturas_duplicadas = len(ya_descargados)
+        links_fallidos = []
+        for link, factura in zip(links_pendientes, facturas):
+            if factura is None:
+                logger.error(f"❌ No se pudo procesar la factura {link}")
+                links_fallidos.append(link)
+            elif factura.duplicada:
+                # descargar_factura_pdf ya verifica link y lectura antes de procesar
+                logger.info(f"⚠️ Factura duplicada omitida: NIC {factura.nic}, fecha {factura.fecha_lectura}")
+                facturas_duplicadas += 1
+            else:
+                nuevas_facturas.append(factura)
+                logger.info(f"✅ Procesada factura nueva: NIC {factura.nic} para usuario {user_id}")
+        
+        # Los históricos se necesitan para detectar anomalías
+        if nuevas_facturas:
+            verificar_cancelacion()
+            analizar_historicos_pendientes(user_id)
         
-        logger.info(f"📊 Resultado procesamiento: {len(nuevas_facturas)} nuevas, {facturas_duplicadas} duplicadas")
-        return nuevas_facturas
+        logger.info(f"📊 Resultado procesamiento: {len(nuevas_facturas)} nuevas, "
+                    f"{facturas_duplicadas} duplicadas, {len(links_fallidos)} fallidas")
+        return {
+            "nuevas": nuevas_facturas,
+            "duplicadas": facturas_duplicadas,
+            "fallidas": len(links_fallidos),
+            "links_fallidos": links_fallidos
+        }
     
     def detectar_anomalias_nuevas(self, facturas: List[Factura], db: Session) -> List[Dict[str, Any]]:
         """Detectar anomalías en las nuevas facturas"""
@@ -231,12 +203,18 @@ class NotificacionService:
         
         logger.info(f"🔍 Analizando {len(facturas)} facturas para detectar anomalías")
         
+        # Todas las alertas de una vez: una consulta para todos los NICs en lugar de una por factura
+        try:
+            alertas = alertas_anomalias_batch(db, [(factura.user_id, factura.nic) for factura in facturas])
+        except Exception as e:
+            logger.error(f"❌ Error detectando anomalías de {len(facturas)} facturas: {str(e)}")
+            return anomalias_detectadas
+        
         for factura in facturas:
             try:
                 logger.info(f"Analizando factura NIC {factura.nic} - Consumo: {factura.consumo_kwh} kWh")
                 
-                # Usar el modelo existente para detectar anomalías
-                alerta = alerta_anomalia_actual(db, factura.nic, factura.user_id)
+                alerta = alertas[(factura.user_id, factura.nic)]
                 
                 logger.info(f"Resultado análisis NIC {factura.nic}: {alerta}")
                 
@@ -295,7 +273,7 @@ class NotificacionService:
     def _enviar_via_gmail_api(self, user: User, contenido_html: str) -> bool:
         """Enviar email usando Gmail API"""
         try:
-            service = get_service(user.gmail_token, user.gmail_refresh_token)
+            service = get_service(user_id=user.id)
             
             # Crear mensaje
             message = MIMEMultipart()
@@ -397,8 +375,35 @@ class NotificacionService:
         
         return html
     
-    def procesar_notificaciones_usuario(self, user: User, db: Session) -> Dict[str, Any]:
-        """Procesar notificaciones para un usuario específico"""
+    def procesar_notificaciones_usuario(self, user: User, db: Session, limite: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Procesar notificaciones para un usuario específico
+
+        Pasa por el single-flight por usuario: si ya se están procesando las
+        notificaciones del usuario se devuelve ese resultado, y si hay una
+        sincronización suya en curso se espera a que termine.
+
+        Args:
+            limite: Momento (time.monotonic) en que se agota el presupuesto de
+                    tiempo del usuario; se controla entre etapas
+        """
+        resultado, unido = vuelo_por_usuario.ejecutar(
+            user.id, "notificaciones",
+            lambda: self._procesar_notificaciones_usuario(user, db, limite)
+        )
+        if unido:
+            return {**resultado, "unido_a_ejecucion_en_curso": True}
+        return resultado
+
+    def _procesar_notificaciones_usuario(self, user: User, db: Session, limite: Optional[float] = None) -> Dict[str, Any]:
+        def presupuesto_agotado(etapa):
+            if limite is not None and time.monotonic() > limite:
+                logger.warning(f"⏱️ Presupuesto de tiempo agotado para {user.email} antes de {etapa}")
+                resultado["errores"].append(f"Presupuesto de tiempo agotado antes de {etapa}")
+                resultado["presupuesto_agotado"] = True
+                return True
+            return False
+
         resultado = {
             "user_id": user.id,
             "email": user.email,
@@ -416,24 +421,37 @@ class NotificacionService:
             logger.info(f"👤 Procesando usuario {user.email} - buscando email más reciente")
             
             # 2. Buscar el email más reciente
-            links = self.buscar_email_mas_reciente(user, db)
+            links, mensajes = self._buscar_links_nuevos(user, db)
             resultado["emails_nuevos"] = len(links)
             
             if not links:
+                guardar_cursor_sync(user.id, marca_procesada(mensajes))
                 logger.info(f"📭 No hay emails nuevos para {user.email}")
                 return resultado
             
+            if presupuesto_agotado("descargar facturas"):
+                # El cursor no avanza: los emails se procesan en el próximo barrido
+                return resultado
+            
             # 3. Procesar nuevas facturas
-            nuevas_facturas = self.procesar_nuevas_facturas(user.id, links, db)
+            procesamiento = self.procesar_nuevas_facturas(user.id, links, db)
+            nuevas_facturas = procesamiento["nuevas"]
             resultado["facturas_procesadas"] = len(nuevas_facturas)
+            resultado["facturas_duplicadas"] = procesamiento["duplicadas"]
+            resultado["facturas_fallidas"] = procesamiento["fallidas"]
             
-            # Calcular duplicadas (total links - facturas procesadas)
-            resultado["facturas_duplicadas"] = len(links) - len(nuevas_facturas)
+            # El cursor avanza hasta el último email con todas sus facturas guardadas (las fallidas se reintentan)
+            if procesamiento["fallidas"]:
+                resultado["errores"].append(f"{procesamiento['fallidas']} facturas no se pudieron descargar")
+            guardar_cursor_sync(user.id, marca_procesada(mensajes, procesamiento["links_fallidos"]))
             
             if not nuevas_facturas:
                 logger.info(f"📄 No se procesaron facturas nuevas para {user.email} (todas duplicadas)")
                 return resultado
             
+            if presupuesto_agotado("detectar anomalías"):
+                return resultado
+            
             # 4. Detectar anomalías
             anomalias = self.detectar_anomalias_nuevas(nuevas_facturas, db)
             resultado["anomalias_detectadas"] = len(anomalias)
@@ -451,6 +469,9 @@ class NotificacionService:
             else:
                 resultado["errores"].append("Error enviando email de alerta")
             
+        except DescargaCancelada:
+            logger.warning(f"⏹️ Procesamiento de {user.email} cancelado")
+            resultado["errores"].append("Procesamiento cancelado por superar el presupuesto de tiempo")
         except Exception as e:
             error_msg = f"Error procesando usuario {user.email}: {str(e)}"
             logger.error(error_msg)
@@ -458,9 +479,92 @@ class NotificacionService:
         
         return resultado
     
-    def ejecutar_servicio_notificaciones(self) -> Dict[str, Any]:
-        """Ejecutar el servicio completo de notificaciones para todos los usuarios"""
-        logger.info("🚀 Iniciando servicio de notificaciones automáticas")
+    def obtener_usuarios_para_barrido(self, db: Session) -> List[Tuple[int, str]]:
+        """
+        Usuarios con refresh token en orden justo: primero los que nunca se
+        procesaron y después los que hace más tiempo que no se procesan.
+        En modo push se omiten los que tienen un watch de Gmail vigente, salvo
+        que su último trabajo de notificaciones haya fallado (así las facturas
+        que no se pudieron descargar se reintentan aunque no llegue otro aviso).
+        """
+        usuarios = self.obtener_usuarios_con_refresh_token(db)
+        if GMAIL_PUSH_CONFIG["habilitado"]:
+            # Con el modo push, los usuarios con un watch vigente se procesan cuando llega su aviso
+            con_watch = {
+                user_id for (user_id,) in db.query(GmailWatch.user_id).filter(
+                    GmailWatch.expiracion > datetime.utcnow()
+                )
+            }
+            ultimos_trabajos = db.query(func.max(SyncJob.id)).filter(
+                SyncJob.tipo == "notificaciones"
+            ).group_by(SyncJob.user_id)
+            con_fallo = {
+                user_id for (user_id,) in db.query(SyncJob.user_id).filter(
+                    SyncJob.id.in_(ultimos_trabajos),
+                    SyncJob.estado == "error"
+                )
+            }
+            usuarios = [u for u in usuarios if u.id not in con_watch or u.id in con_fallo]
+        with self._lock:
+            ultimos = dict(self._ultimo_procesamiento)
+        usuarios.sort(key=lambda u: (ultimos.get(u.id, 0.0), u.id))
+        return [(u.id, u.email) for u in usuarios]
+
+    def procesar_usuario_aislado(self, user_id: int, presupuesto_segundos: float) -> Dict[str, Any]:
+        """Procesar un usuario con su propia sesión de base de datos y presupuesto de tiempo"""
+        inicio = time.monotonic()
+        db = SessionLocal()
+        try:
+            user = db.query(User).filter(User.id == user_id).first()
+            if user is None:
+                return self._resultado_vacio(user_id, None, f"Usuario {user_id} no encontrado")
+            user_resultado = self.procesar_notificaciones_usuario(user, db, inicio + presupuesto_segundos)
+        finally:
+            db.close()
+            with self._lock:
+                self._ultimo_procesamiento[user_id] = time.time()
+        user_resultado["duracion_segundos"] = round(time.monotonic() - inicio, 2)
+        return user_resultado
+
+    @staticmethod
+    def _resultado_vacio(user_id: int, email: Optional[str], error: str) -> Dict[str, Any]:
+        return {
+            "user_id": user_id,
+            "email": email,
+            "emails_nuevos": 0,
+            "facturas_procesadas": 0,
+            "facturas_duplicadas": 0,
+            "anomalias_detectadas": 0,
+            "email_enviado": False,
+            "errores": [error],
+            "ultima_fecha_procesamiento": None
+        }
+
+    def ejecutar_servicio_notificaciones(self, max_workers: Optional[int] = None,
+                                         presupuesto_segundos: Optional[float] = None,
+                                         ventana_segundos: Optional[float] = None,
+                                         continuar: Optional[Callable[[], bool]] = None) -> Dict[str, Any]:
+        """
+        Ejecutar el servicio completo de notificaciones para todos los usuarios
+
+        Los usuarios se procesan en paralelo con `max_workers` hilos que toman
+        el siguiente usuario de una cola común (uno lento no frena al resto),
+        cada uno con su propia sesión de base de datos y un presupuesto de
+        tiempo; un usuario que lo supera se abandona, se informa como timeout
+        y se le activa su cancelación: sus descargas se cortan y no empieza
+        etapas nuevas, así no sigue ocupando cupo en la ronda siguiente.
+
+        Args:
+            ventana_segundos: Si se indica, los usuarios no arrancan todos juntos
+                sino escalonados de forma pareja a lo largo de la ventana
+            continuar: Se consulta antes de arrancar cada usuario; si devuelve
+                False no se arrancan más (por ejemplo, si se perdió el lease)
+        """
+        max_workers = max_workers or MONITORING_CONFIG["max_concurrent_users"]
+        presupuesto_segundos = presupuesto_segundos or MONITORING_CONFIG["timeout_per_user_seconds"]
+        logger.info(f"🚀 Iniciando servicio de notificaciones automáticas "
+                    f"({max_workers} usuarios en paralelo, {presupuesto_segundos}s por usuario)")
+        inicio_barrido = time.monotonic()
         
         resultado = {
             "timestamp": datetime.now().isoformat(),
@@ -471,42 +575,93 @@ class NotificacionService:
             "total_anomalias_detectadas": 0,
             "alertas_enviadas": 0,
             "usuarios_con_errores": 0,
+            "usuarios_con_timeout": 0,
             "detalles": []
         }
         
-        db = SessionLocal()
         try:
-            # Obtener usuarios con refresh token
-            usuarios = self.obtener_usuarios_con_refresh_token(db)
+            # La sesión del listado se cierra antes de repartir el trabajo
+            db = SessionLocal()
+            try:
+                usuarios = self.obtener_usuarios_para_barrido(db)
+            finally:
+                db.close()
             logger.info(f"👥 Encontrados {len(usuarios)} usuarios con refresh token")
             
             if not usuarios:
                 logger.warning("⚠️ No hay usuarios con refresh token configurado")
                 return resultado
             
-            for user in usuarios:
-                logger.info(f"🔄 Procesando usuario {user.email}...")
-                user_resultado = self.procesar_notificaciones_usuario(user, db)
-                resultado["detalles"].append(user_resultado)
-                
-                # Agregar al resumen
-                resultado["usuarios_procesados"] += 1
-                resultado["total_emails_nuevos"] += user_resultado["emails_nuevos"]
-                resultado["total_facturas_procesadas"] += user_resultado["facturas_procesadas"]
-                resultado["total_facturas_duplicadas"] += user_resultado.get("facturas_duplicadas", 0)
-                resultado["total_anomalias_detectadas"] += user_resultado["anomalias_detectadas"]
-                
-                if user_resultado["email_enviado"]:
-                    resultado["alertas_enviadas"] += 1
-                
-                if user_resultado["errores"]:
-                    resultado["usuarios_con_errores"] += 1
-                
-                logger.info(f"✅ Usuario {user.email} procesado: "
-                          f"{user_resultado['emails_nuevos']} emails, "
-                          f"{user_resultado['facturas_procesadas']} facturas nuevas, "
-                          f"{user_resultado.get('facturas_duplicadas', 0)} duplicadas, "
-                          f"{user_resultado['anomalias_detectadas']} anomalías")
+            inicios = {}  # user_id -> momento en que empezó a procesarse
+            cancelaciones = {user_id: threading.Event() for user_id, _ in usuarios}
+            # Momento en que se libera cada usuario (todos juntos o escalonados en la ventana)
+            paso = (ventana_segundos or 0) / len(usuarios)
+            por_arrancar = [(inicio_barrido + i * paso, user_id, email) for i, (user_id, email) in enumerate(usuarios)]
+            if paso:
+                logger.info(f"🗓️ Usuarios escalonados cada {paso:.1f}s en una ventana de {ventana_segundos:.0f}s")
+
+            def tarea(user_id):
+                inicios[user_id] = time.monotonic()
+                with con_cancelacion(cancelaciones[user_id]):
+                    return self.procesar_usuario_aislado(user_id, presupuesto_segundos)
+
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, min(max_workers, len(usuarios))),
+                thread_name_prefix="notificaciones"
+            )
+            try:
+                pendientes = {}
+                while pendientes or por_arrancar:
+                    ahora = time.monotonic()
+                    while por_arrancar and por_arrancar[0][0] <= ahora:
+                        if continuar is not None and not continuar():
+                            logger.warning(f"⏹️ Barrido detenido: {len(por_arrancar)} usuarios quedan para la próxima ronda")
+                            resultado["usuarios_no_iniciados"] = len(por_arrancar)
+                            por_arrancar = []
+                            break
+                        _, user_id, email = por_arrancar.pop(0)
+                        pendientes[executor.submit(tarea, user_id)] = (user_id, email)
+                    if not pendientes:
+                        if por_arrancar:
+                            time.sleep(min(1, max(0, por_arrancar[0][0] - time.monotonic())))
+                        continue
+                    
+                    terminados, _ = concurrent.futures.wait(
+                        pendientes, timeout=1, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    for future in terminados:
+                        user_id, email = pendientes.pop(future)
+                        try:
+                            user_resultado = future.result()
+                        except Exception as e:
+                            logger.error(f"❌ Error procesando usuario {email}: {e}")
+                            user_resultado = self._resultado_vacio(user_id, email, str(e))
+                        self._acumular_resultado(resultado, user_resultado)
+                    
+                    # Abandonar a los usuarios que superaron su presupuesto
+                    ahora = time.monotonic()
+                    for future, (user_id, email) in list(pendientes.items()):
+                        inicio = inicios.get(user_id)
+                        if inicio is not None and ahora - inicio > presupuesto_segundos:
+                            logger.error(f"⏱️ Usuario {email} superó su presupuesto de {presupuesto_segundos}s")
+                            cancelaciones[user_id].set()
+                            future.cancel()
+                            pendientes.pop(future)
+                            user_resultado = self._resultado_vacio(
+                                user_id, email, f"Timeout: superó {presupuesto_segundos} segundos"
+                            )
+                            user_resultado["timeout"] = True
+                            user_resultado["duracion_segundos"] = round(ahora - inicio, 2)
+                            self._acumular_resultado(resultado, user_resultado)
+            finally:
+                # Lo que siga corriendo (abandonado o cortado por un error) se frena en su próximo control
+                for cancelacion in cancelaciones.values():
+                    cancelacion.set()
+                executor.shutdown(wait=False, cancel_futures=True)
+                # Los tokens renovados durante el barrido se guardan juntos
+                gestor_tokens.guardar_pendientes()
+            
+            resultado["metricas"] = self._metricas_barrido(resultado["detalles"], inicio_barrido, max_workers)
             
             # Resumen final
             logger.info("📊 RESUMEN FINAL:")
@@ -517,16 +672,67 @@ class NotificacionService:
             logger.info(f"  • Total anomalías detectadas: {resultado['total_anomalias_detectadas']}")
             logger.info(f"  • Alertas enviadas: {resultado['alertas_enviadas']}")
             logger.info(f"  • Usuarios con errores: {resultado['usuarios_con_errores']}")
+            logger.info(f"  • Usuarios con timeout: {resultado['usuarios_con_timeout']}")
+            logger.info(f"  • Duración: {resultado['metricas']['duracion_segundos']}s "
+                        f"({resultado['metricas']['usuarios_por_minuto']} usuarios/min)")
             
             logger.info(f"✅ Servicio completado: {resultado['alertas_enviadas']} alertas enviadas de {resultado['usuarios_procesados']} usuarios")
             
         except Exception as e:
             logger.error(f"❌ Error ejecutando servicio de notificaciones: {str(e)}")
             resultado["error_general"] = str(e)
-        finally:
-            db.close()
         
         return resultado
 
+    @staticmethod
+    def _acumular_resultado(resultado: Dict[str, Any], user_resultado: Dict[str, Any]):
+        """Sumar el resultado de un usuario al resumen del barrido"""
+        resultado["detalles"].append(user_resultado)
+        resultado["usuarios_procesados"] += 1
+        resultado["total_emails_nuevos"] += user_resultado["emails_nuevos"]
+        resultado["total_facturas_procesadas"] += user_resultado["facturas_procesadas"]
+        resultado["total_facturas_duplicadas"] += user_resultado.get("facturas_duplicadas", 0)
+        resultado["total_anomalias_detectadas"] += user_resultado["anomalias_detectadas"]
+        
+        if user_resultado["email_enviado"]:
+            resultado["alertas_enviadas"] += 1
+        
+        if user_resultado["errores"]:
+            resultado["usuarios_con_errores"] += 1
+        
+        if user_resultado.get("timeout"):
+            resultado["usuarios_con_timeout"] += 1
+        
+        logger.info(f"✅ Usuario {user_resultado['email']} procesado: "
+                  f"{user_resultado['emails_nuevos']} emails, "
+                  f"{user_resultado['facturas_procesadas']} facturas nuevas, "
+                  f"{user_resultado.get('facturas_duplicadas', 0)} duplicadas, "
+                  f"{user_resultado['anomalias_detectadas']} anomalías")
+
+    @staticmethod
+    def _metricas_barrido(detalles: List[Dict[str, Any]], inicio: float, max_workers: int) -> Dict[str, Any]:
+        """Duración, throughput y distribución del tiempo por usuario"""
+        duracion = time.monotonic() - inicio
+        duraciones = sorted(d["duracion_segundos"] for d in detalles if "duracion_segundos" in d)
+
+        def percentil(p):
+            if not duraciones:
+                return None
+            if len(duraciones) == 1:
+                return duraciones[0]
+            return round(statistics.quantiles(duraciones, n=100, method="inclusive")[p - 1], 2)
+
+        return {
+            "workers": max_workers,
+            "duracion_segundos": round(duracion, 1),
+            "usuarios_por_minuto": round(len(detalles) / duracion * 60, 1) if duracion > 0 else None,
+            "segundos_por_usuario_p50": percentil(50),
+            "segundos_por_usuario_p90": percentil(90),
+            "segundos_por_usuario_max": duraciones[-1] if duraciones else None,
+            "presupuestos_agotados": sum(1 for d in detalles if d.get("presupuesto_agotado")),
+            "gemini": cliente_gemini.metricas(),
+            "tokens_gmail": gestor_tokens.metricas()
+        }
+
 # Instancia global del servicio
 notificacion_service = NotificacionService()
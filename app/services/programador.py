@@ -0,0 +1,274 @@
+"""
+Programador periódico del servicio de notificaciones
+
+Ejecuta el barrido de notificaciones en rondas alineadas al reloj (cada
+`intervalo_minutos`, como un cron */N) con una demora aleatoria (jitter)
+para que varias instancias no arranquen en el mismo segundo.
+
+- Lease en la base (tabla programador_estado): solo la instancia que lo
+  tiene barre; se renueva mientras la ronda corre y vence solo si la
+  instancia muere, así otra puede tomar la posta.
+- Estado persistido: inicio/fin/resumen de la última ronda y la próxima
+  programada, para que un reinicio no repita ni saltee rondas.
+- Los usuarios se escalonan a lo largo del intervalo, repartiendo la carga
+  sobre Gmail, EDEMSA y Gemini en vez de pegarles a todos juntos.
+- Con el modo push de Gmail, cada ronda renueva los watch por vencer.
+
+Puede correr dentro de la API (PROGRAMADOR_HABILITADO=true) o aparte con
+programador_notificaciones.py; el lease evita barridos duplicados.
+"""
+import os
+import json
+import uuid
+import random
+import socket
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+
+from app.config.notifications_config import PROGRAMADOR_CONFIG, GMAIL_PUSH_CONFIG
+from app.db.session import SessionLocal
+from app.models.programador_model import EstadoProgramador
+from app.services.notificaciones import notificacion_service
+from app.services.gmail_push import renovar_watches
+
+logger = logging.getLogger(__name__)
+
+
+class ProgramadorNotificaciones:
+    """Rondas periódicas del barrido de notificaciones con lease en la base"""
+
+    NOMBRE = "notificaciones"
+
+    def __init__(self, intervalo_minutos: float = None, jitter_segundos: float = None,
+                 lease_segundos: float = None):
+        self.intervalo_segundos = (intervalo_minutos or PROGRAMADOR_CONFIG["intervalo_minutos"]) * 60
+        self.jitter_segundos = PROGRAMADOR_CONFIG["jitter_segundos"] if jitter_segundos is None else jitter_segundos
+        self.lease_segundos = lease_segundos or PROGRAMADOR_CONFIG["lease_segundos"]
+        self.instancia = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._detener = threading.Event()
+        self._lease_vigente = False
+        self._hilo: Optional[threading.Thread] = None
+
+    # === Estado persistido ===
+    def _fila(self, db) -> EstadoProgramador:
+        fila = db.query(EstadoProgramador).filter(EstadoProgramador.nombre == self.NOMBRE).first()
+        if fila is None:
+            db.add(EstadoProgramador(nombre=self.NOMBRE, ejecuciones=0))
+            try:
+                db.commit()
+            except IntegrityError:
+                db.rollback()  # Otra instancia la creó al mismo tiempo
+            fila = db.query(EstadoProgramador).filter(EstadoProgramador.nombre == self.NOMBRE).first()
+        return fila
+
+    def estado(self) -> Dict[str, Any]:
+        db = SessionLocal()
+        try:
+            fila = self._fila(db)
+            return {
+                "duenio_lease": fila.duenio,
+                "lease_hasta": fila.lease_hasta.isoformat() if fila.lease_hasta else None,
+                "ultima_ejecucion_inicio": fila.ultima_ejecucion_inicio.isoformat() if fila.ultima_ejecucion_inicio else None,
+                "ultima_ejecucion_fin": fila.ultima_ejecucion_fin.isoformat() if fila.ultima_ejecucion_fin else None,
+                "proxima_ejecucion": fila.proxima_ejecucion.isoformat() if fila.proxima_ejecucion else None,
+                "ejecuciones": fila.ejecuciones or 0,
+                "ultimo_resultado": json.loads(fila.ultimo_resultado) if fila.ultimo_resultado else None,
+                "esta_instancia": self.instancia,
+            }
+        finally:
+            db.close()
+
+    def _guardar(self, **valores):
+        db = SessionLocal()
+        try:
+            self._fila(db)
+            db.query(EstadoProgramador).filter(EstadoProgramador.nombre == self.NOMBRE).update(
+                {getattr(EstadoProgramador, k): v for k, v in valores.items()}, synchronize_session=False
+            )
+            db.commit()
+        finally:
+            db.close()
+
+    # === Lease ===
+    def adquirir_lease(self) -> bool:
+        """Tomar o renovar el lease; False si lo tiene otra instancia vigente"""
+        db = SessionLocal()
+        try:
+            self._fila(db)
+            ahora = datetime.utcnow()
+            tomado = db.query(EstadoProgramador).filter(
+                EstadoProgramador.nombre == self.NOMBRE,
+                or_(
+                    EstadoProgramador.duenio.is_(None),
+                    EstadoProgramador.duenio == self.instancia,
+                    EstadoProgramador.lease_hasta < ahora
+                )
+            ).update({
+                EstadoProgramador.duenio: self.instancia,
+                EstadoProgramador.lease_hasta: ahora + timedelta(seconds=self.lease_segundos)
+            }, synchronize_session=False)
+            db.commit()
+            return tomado == 1
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Error tomando el lease del programador: {e}")
+            return False
+        finally:
+            db.close()
+
+    def liberar_lease(self):
+        db = SessionLocal()
+        try:
+            db.query(EstadoProgramador).filter(
+                EstadoProgramador.nombre == self.NOMBRE,
+                EstadoProgramador.duenio == self.instancia
+            ).update({EstadoProgramador.duenio: None, EstadoProgramador.lease_hasta: None},
+                     synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    def _latido(self, fin: threading.Event):
+        """Renovar el lease mientras la ronda corre"""
+        while not fin.wait(self.lease_segundos / 3):
+            self._lease_vigente = self.adquirir_lease()
+            if not self._lease_vigente:
+                logger.warning("⚠️ Se perdió el lease del programador, no se arrancan más usuarios")
+
+    # === Rondas ===
+    def proxima_ronda(self, desde: datetime) -> datetime:
+        """Siguiente múltiplo del intervalo posterior a `desde`, más jitter"""
+        epoca = datetime(1970, 1, 1)
+        segundos = (desde - epoca).total_seconds()
+        siguiente = (segundos // self.intervalo_segundos + 1) * self.intervalo_segundos
+        # Jitter fijo por instancia y ronda, así no cambia entre consultas
+        jitter = random.Random(f"{self.instancia}:{siguiente}").uniform(0, self.jitter_segundos)
+        return epoca + timedelta(seconds=siguiente + jitter)
+
+    def ejecutar_ronda(self) -> Optional[Dict[str, Any]]:
+        """Ejecutar una ronda si se consigue el lease; None si otra instancia la tiene"""
+        if not self.adquirir_lease():
+            logger.info("⏭️ Otra instancia tiene el lease del programador, se omite la ronda")
+            return None
+
+        self._lease_vigente = True
+        fin_latido = threading.Event()
+        latido = threading.Thread(target=self._latido, args=(fin_latido,), name="programador-lease", daemon=True)
+        latido.start()
+
+        inicio = datetime.utcnow()
+        resultado = None
+        error = None
+        try:
+            self._guardar(ultima_ejecucion_inicio=inicio)
+            logger.info(f"⏰ Ronda de notificaciones iniciada por {self.instancia}")
+            if GMAIL_PUSH_CONFIG["habilitado"]:
+                # Renovar los watch por vencer antes de que el barrido omita a sus usuarios
+                try:
+                    renovar_watches()
+                except Exception as e:
+                    logger.error(f"Error renovando los watch de Gmail: {e}")
+            resultado = notificacion_service.ejecutar_servicio_notificaciones(
+                ventana_segundos=self.intervalo_segundos * PROGRAMADOR_CONFIG["fraccion_escalonado"],
+                continuar=lambda: self._lease_vigente and not self._detener.is_set()
+            )
+            return resultado
+        except Exception as e:
+            error = str(e)
+            logger.error(f"❌ Error en la ronda de notificaciones: {e}")
+            raise
+        finally:
+            fin_latido.set()
+            latido.join()
+            # Aunque la ronda falle: dejar registrado el fin y soltar el lease
+            if resultado is not None:
+                resumen = {k: v for k, v in resultado.items() if k != "detalles"}
+            else:
+                resumen = {"error": error or "Ronda interrumpida"}
+            try:
+                self._registrar_fin(inicio, resumen)
+            except Exception as e:
+                logger.error(f"Error guardando el estado del programador: {e}")
+            try:
+                self.liberar_lease()
+            except Exception as e:
+                logger.error(f"Error liberando el lease del programador: {e}")
+
+    def _registrar_fin(self, inicio: datetime, resumen: Dict[str, Any]):
+        db = SessionLocal()
+        try:
+            fila = self._fila(db)
+            fila.ultima_ejecucion_fin = datetime.utcnow()
+            fila.ultimo_resultado = json.dumps(resumen, default=str)
+            fila.proxima_ejecucion = self.proxima_ronda(inicio)
+            fila.ejecuciones = (fila.ejecuciones or 0) + 1
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _momento_siguiente(self) -> datetime:
+        """Próxima ronda según el estado persistido (ronda perdida -> ahora)"""
+        db = SessionLocal()
+        try:
+            fila = self._fila(db)
+            ultima = fila.ultima_ejecucion_inicio
+        finally:
+            db.close()
+        if ultima is None:
+            return datetime.utcnow()
+        return self.proxima_ronda(ultima)
+
+    def _bucle(self):
+        logger.info(f"🗓️ Programador de notificaciones activo cada {self.intervalo_segundos / 60:.0f} min "
+                    f"(instancia {self.instancia})")
+        while not self._detener.is_set():
+            try:
+                objetivo = self._momento_siguiente()
+                self._guardar(proxima_ejecucion=objetivo)
+                espera = (objetivo - datetime.utcnow()).total_seconds()
+                if espera > 0:
+                    # Esperar en tramos cortos para ver si otra instancia ya ejecutó la ronda
+                    self._detener.wait(min(espera, 60))
+                    continue
+                self.ejecutar_ronda()
+                # Si otra instancia tenía el lease, su ronda actualiza el estado en unos segundos
+                self._detener.wait(5)
+            except Exception as e:
+                logger.error(f"❌ Error en el programador de notificaciones: {e}")
+                self._detener.wait(60)
+
+    def iniciar(self):
+        """Arrancar el programador en un hilo (idempotente)"""
+        if self._hilo and self._hilo.is_alive():
+            return
+        self._detener.clear()
+        self._hilo = threading.Thread(target=self._bucle, name="programador-notificaciones", daemon=True)
+        self._hilo.start()
+
+    def ejecutar_por_siempre(self):
+        """Modo independiente: correr el bucle en el hilo actual hasta Ctrl+C"""
+        try:
+            self._bucle()
+        except KeyboardInterrupt:
+            self.detener()
+
+    def detener(self, timeout: float = 10):
+        self._detener.set()
+        if self._hilo:
+            self._hilo.join(timeout=timeout)
+        try:
+            self.liberar_lease()
+        except Exception:
+            pass
+
+
+# Instancia global del programador
+programador_notificaciones = ProgramadorNotificaciones()
@@ -0,0 +1,142 @@
+"""
+Sesión HTTP con EDEMSA y caché de cookies por host
+
+Las cookies obtenidas con el navegador se guardan por host con un TTL y se
+reutilizan en las descargas siguientes a través de una sesión HTTP con pool
+de conexiones. El navegador solo vuelve a abrirse cuando la descarga con las
+cookies cacheadas no devuelve un PDF.
+"""
+import time
+import logging
+import threading
+from http.cookiejar import DefaultCookiePolicy
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from app.config.notifications_config import EDEMSA_CONFIG
+from app.services.navegador import pool_navegadores
+from app.services.descargas import verificar_cancelacion
+
+logger = logging.getLogger(__name__)
+
+
+class CacheCookies:
+    """Caché en memoria de cookies de sesión por host con TTL"""
+
+    def __init__(self, ttl_segundos: int = None):
+        self.ttl_segundos = ttl_segundos or EDEMSA_CONFIG["ttl_cookies_segundos"]
+        self._entradas: Dict[str, tuple] = {}  # host -> (cookies, expira_en)
+        self._lock = threading.Lock()
+
+    def obtener(self, host: str) -> Optional[List[dict]]:
+        """Devolver las cookies vigentes de un host o None"""
+        with self._lock:
+            entrada = self._entradas.get(host)
+            if not entrada:
+                return None
+            cookies, expira_en = entrada
+            if time.time() >= expira_en:
+                del self._entradas[host]
+                return None
+            return cookies
+
+    def guardar(self, host: str, cookies: List[dict]):
+        """Guardar cookies respetando la expiración más cercana entre TTL y cookies"""
+        expira_en = time.time() + self.ttl_segundos
+        for cookie in cookies:
+            expires = cookie.get("expires", -1)
+            if expires and expires > 0:
+                expira_en = min(expira_en, expires)
+        with self._lock:
+            self._entradas[host] = (cookies, expira_en)
+
+    def invalidar(self, host: str = None):
+        """Invalidar las cookies de un host, o de todos si no se indica"""
+        with self._lock:
+            if host is None:
+                self._entradas.clear()
+            else:
+                self._entradas.pop(host, None)
+
+
+def _crear_sesion_http() -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=EDEMSA_CONFIG["pool_conexiones"],
+        pool_maxsize=EDEMSA_CONFIG["pool_conexiones"]
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    # Las cookies se manejan en la caché por host, no en el cookie jar compartido
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+
+# Instancias globales
+cache_cookies = CacheCookies()
+sesion_http = _crear_sesion_http()
+
+
+def obtener_cookies_edemsa(url: str) -> List[dict]:
+    """
+    Abrir el link en un contexto del pool de navegadores y devolver sus cookies
+    """
+    def abrir_sesion(context):
+        page = context.new_page()
+        page.goto(url, timeout=90000, wait_until="load")
+        page.wait_for_timeout(5000)
+        return context.cookies()
+
+    return pool_navegadores.ejecutar(abrir_sesion)
+
+
+def _es_pdf(response: requests.Response) -> bool:
+    return (
+        response.status_code == 200
+        and response.headers.get("Content-Type", "").startswith("application/pdf")
+    )
+
+
+def _pedir_pdf(url: str, cookies: List[dict]) -> requests.Response:
+    headers = {
+        "User-Agent": "Mozilla/5.0",
+        "Referer": url,
+        "Cookie": "; ".join([f"{c['name']}={c['value']}" for c in cookies]),
+    }
+    pdf_url = url.replace("facturad.php", "facturad_mail.php")
+    return sesion_http.get(pdf_url, headers=headers, timeout=EDEMSA_CONFIG["timeout_http_segundos"])
+
+
+def descargar_pdf_edemsa(url: str) -> Optional[bytes]:
+    """
+    Descargar el PDF de una factura reutilizando cookies cacheadas
+
+    Args:
+        url: Link facturad.php recibido por email
+
+    Returns:
+        Bytes del PDF o None si EDEMSA no devolvió un PDF
+    """
+    host = urlparse(url).netloc
+
+    cookies = cache_cookies.obtener(host)
+    if cookies:
+        response = _pedir_pdf(url, cookies)
+        if _es_pdf(response):
+            logger.info(f"🍪 PDF descargado con cookies cacheadas de {host}")
+            return response.content
+        logger.info(f"🍪 Cookies de {host} no válidas, renovando sesión con el navegador")
+        cache_cookies.invalidar(host)
+
+    verificar_cancelacion()
+    print(f"Abriendo sesión para descarga directa...")
+    cookies = obtener_cookies_edemsa(url)
+    response = _pedir_pdf(url, cookies)
+    if not _es_pdf(response):
+        return None
+
+    cache_cookies.guardar(host, cookies)
+    return response.content
@@ -0,0 +1,226 @@
+"""
+Gestor de access tokens y clientes de Gmail por usuario
+
+Antes cada llamada armaba unas Credentials nuevas y un cliente con
+build('gmail', 'v1'), y el token solo se renovaba cuando faltaba o cuando
+Gmail respondía 401. Ahora:
+
+- Las credenciales de cada usuario se cachean junto con su vencimiento y se
+  renuevan `margen_renovacion_segundos` antes de vencer. La renovación es
+  single-flight por usuario: si varios hilos la necesitan a la vez, uno
+  llama a Google y los demás usan el token nuevo.
+- Los tokens renovados no se escriben uno por uno: se acumulan y se guardan
+  en la tabla users con un solo UPDATE en lote unos segundos después.
+- El cliente de Gmail ya construido se reutiliza. Se cachea por usuario y
+  por hilo porque el transporte httplib2 no es seguro entre hilos.
+
+Un token leído de la base no trae vencimiento; si el usuario tiene refresh
+token se renueva en el primer uso para conocerlo.
+"""
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional, Tuple
+
+from google.oauth2.credentials import Credentials
+from google.auth.transport.requests import Request
+from googleapiclient.discovery import build
+
+from app.config.notifications_config import GOOGLE_OAUTH_CONFIG, TOKENS_GMAIL_CONFIG
+from app.db.session import SessionLocal
+from app.models.user_model import User
+from app.services.auth import SCOPES
+
+logger = logging.getLogger(__name__)
+
+
+class ErrorTokenGmail(Exception):
+    """El usuario no tiene un token de Gmail utilizable"""
+
+
+class _EntradaTokens:
+    def __init__(self, creds: Credentials):
+        self.creds = creds
+        self.token_guardado = creds.token  # Último token que se sabe escrito en la base
+
+
+class GestorTokensGmail:
+    """Cache de credenciales y clientes de Gmail con renovación anticipada"""
+
+    def __init__(self, margen_segundos: float = None, max_servicios: int = None,
+                 guardado_segundos: float = None):
+        self.margen = timedelta(seconds=margen_segundos or TOKENS_GMAIL_CONFIG["margen_renovacion_segundos"])
+        self.max_servicios = max_servicios or TOKENS_GMAIL_CONFIG["max_servicios_cacheados"]
+        self.guardado_segundos = TOKENS_GMAIL_CONFIG["guardado_segundos"] if guardado_segundos is None else guardado_segundos
+        self._entradas: Dict[int, _EntradaTokens] = {}
+        self._locks_usuario: Dict[int, threading.Lock] = {}
+        self._servicios: "OrderedDict[Tuple[int, int], Tuple[Credentials, Any]]" = OrderedDict()
+        self._pendientes: Dict[int, str] = {}
+        self._temporizador: Optional[threading.Timer] = None
+        self._lock = threading.Lock()
+        self._metricas = {"renovaciones": 0, "renovaciones_fallidas": 0, "aciertos": 0,
+                          "servicios_construidos": 0, "tokens_guardados": 0}
+
+    def _contar(self, clave: str, cantidad: int = 1):
+        with self._lock:
+            self._metricas[clave] += cantidad
+
+    def metricas(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self._metricas, "usuarios_cacheados": len(self._entradas),
+                    "servicios_cacheados": len(self._servicios), "tokens_pendientes": len(self._pendientes)}
+
+    # === Credenciales ===
+    def _lock_de(self, user_id: int) -> threading.Lock:
+        with self._lock:
+            return self._locks_usuario.setdefault(user_id, threading.Lock())
+
+    def _cargar(self, user_id: int) -> _EntradaTokens:
+        db = SessionLocal()
+        try:
+            user = db.query(User).filter(User.id == user_id).first()
+            if user is None:
+                raise ErrorTokenGmail(f"Usuario con ID {user_id} no encontrado")
+            if not user.gmail_token and not user.gmail_refresh_token:
+                raise ErrorTokenGmail(f"El usuario {user.email} no tiene tokens de Gmail")
+            creds = Credentials(
+                token=user.gmail_token,
+                refresh_token=user.gmail_refresh_token,
+                token_uri=GOOGLE_OAUTH_CONFIG["token_uri"],
+                client_id=GOOGLE_OAUTH_CONFIG["client_id"],
+                client_secret=GOOGLE_OAUTH_CONFIG["client_secret"],
+                scopes=SCOPES
+            )
+            return _EntradaTokens(creds)
+        finally:
+            db.close()
+
+    def _vigente(self, creds: Credentials) -> bool:
+        if not creds.token:
+            return False
+        if creds.expiry is None:
+            # Vencimiento desconocido: solo se confía en él si no hay forma de renovarlo
+            return not creds.refresh_token
+        return creds.expiry - self.margen > datetime.utcnow()
+
+    def credenciales(self, user_id: int) -> Credentials:
+        """Credenciales del usuario con un access token que no vence dentro del margen"""
+        entrada = self._entradas.get(user_id)
+        if entrada is not None and self._vigente(entrada.creds):
+            self._contar("aciertos")
+            self._registrar_cambio(user_id, entrada)
+            return entrada.creds
+
+        with self._lock_de(user_id):
+            # Otro hilo pudo haberlo renovado mientras se esperaba el lock
+            entrada = self._entradas.get(user_id)
+            if entrada is not None and self._vigente(entrada.creds):
+                self._contar("aciertos")
+                return entrada.creds
+            if entrada is None:
+                entrada = self._cargar(user_id)
+                if self._vigente(entrada.creds):
+                    self._entradas[user_id] = entrada
+                    return entrada.creds
+            if not entrada.creds.refresh_token:
+                raise ErrorTokenGmail(f"El token de Gmail del usuario {user_id} venció y no hay refresh token")
+            try:
+                entrada.creds.refresh(Request())
+            except Exception as e:
+                self._contar("renovaciones_fallidas")
+                # Puede que el usuario haya vuelto a autorizar: la próxima vez se relee la base
+                self._entradas.pop(user_id, None)
+                if entrada.creds.token and entrada.creds.expiry is None:
+                    logger.warning(f"⚠️ No se pudo renovar el token del usuario {user_id}, se usa el guardado: {e}")
+                    return entrada.creds
+                raise ErrorTokenGmail(f"No se pudo renovar el token de Gmail del usuario {user_id}: {e}")
+            self._contar("renovaciones")
+            self._entradas[user_id] = entrada
+            logger.info(f"🔑 Token de Gmail renovado para el usuario {user_id} (vence {entrada.creds.expiry})")
+            self._registrar_cambio(user_id, entrada)
+            return entrada.creds
+
+    def access_token(self, user_id: int) -> str:
+        return self.credenciales(user_id).token
+
+    def invalidar(self, user_id: int):
+        """Olvidar las credenciales y clientes del usuario (p. ej. tras un nuevo login)"""
+        with self._lock:
+            self._entradas.pop(user_id, None)
+            self._pendientes.pop(user_id, None)
+            for clave in [c for c in self._servicios if c[0] == user_id]:
+                del self._servicios[clave]
+
+    # === Clientes de Gmail ===
+    def servicio(self, user_id: int):
+        """Cliente de Gmail del usuario, reutilizado mientras sus credenciales sigan en cache"""
+        creds = self.credenciales(user_id)
+        clave = (user_id, threading.get_ident())
+        with self._lock:
+            cacheado = self._servicios.get(clave)
+            # Si las credenciales se recargaron, el cliente viejo quedó con las anteriores
+            if cacheado is not None and cacheado[0] is creds:
+                self._servicios.move_to_end(clave)
+                return cacheado[1]
+        servicio = build('gmail', 'v1', credentials=creds)
+        self._contar("servicios_construidos")
+        with self._lock:
+            self._servicios[clave] = (creds, servicio)
+            while len(self._servicios) > self.max_servicios:
+                self._servicios.popitem(last=False)
+        return servicio
+
+    # === Guardado en lote ===
+    def _registrar_cambio(self, user_id: int, entrada: _EntradaTokens):
+        """
+        Anotar el token para guardarlo si cambió (por una renovación propia o
+        porque el cliente de Google lo renovó solo ante un 401)
+        """
+        if entrada.creds.token == entrada.token_guardado:
+            return
+        with self._lock:
+            self._pendientes[user_id] = entrada.creds.token
+            entrada.token_guardado = entrada.creds.token
+            if self._temporizador is None:
+                self._temporizador = threading.Timer(self.guardado_segundos, self.guardar_pendientes)
+                self._temporizador.daemon = True
+                self._temporizador.start()
+
+    def guardar_pendientes(self) -> int:
+        """Escribir en users todos los tokens renovados con un solo UPDATE en lote"""
+        with self._lock:
+            pendientes, self._pendientes = self._pendientes, {}
+            self._temporizador = None
+        if not pendientes:
+            return 0
+        db = SessionLocal()
+        try:
+            db.bulk_update_mappings(User, [
+                {"id": user_id, "gmail_token": token} for user_id, token in pendientes.items()
+            ])
+            db.commit()
+            self._contar("tokens_guardados", len(pendientes))
+            return len(pendientes)
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Error guardando {len(pendientes)} tokens de Gmail renovados: {e}")
+            with self._lock:
+                # Reintentar en el próximo guardado sin pisar tokens más nuevos
+                for user_id, token in pendientes.items():
+                    self._pendientes.setdefault(user_id, token)
+            return 0
+        finally:
+            db.close()
+
+    def cerrar(self):
+        """Cancelar el guardado programado y escribir lo pendiente"""
+        with self._lock:
+            temporizador = self._temporizador
+        if temporizador is not None:
+            temporizador.cancel()
+        self.guardar_pendientes()
+
+
+# Instancia global compartida por la sincronización, las notificaciones y el modo push
+gestor_tokens = GestorTokensGmail()
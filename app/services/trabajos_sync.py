@@ -0,0 +1,498 @@
+"""
+Cola de trabajos de sincronización en segundo plano
+
+Los endpoints /facturas/sync* encolan un trabajo en la tabla sync_jobs y
+devuelven su id de inmediato. Unos pocos hilos trabajadores toman los
+trabajos pendientes (con un UPDATE condicional, así dos procesos nunca
+toman el mismo), ejecutan la sincronización y van guardando el progreso
+en la misma fila para que GET /facturas/jobs/{id} lo consulte.
+
+Como los trabajos viven en la base, sobreviven a un reinicio. Cada trabajo
+en curso guarda qué proceso lo ejecuta (worker_id) y ese proceso renueva su
+heartbeat_at mientras lo ejecuta; un trabajo vuelve a la cola solo si su
+latido venció (el proceso murió o no pudo guardar el resultado), así varias instancias de la API y el programador
+pueden compartir la cola sin quitarse trabajos vivos. La sincronización es
+idempotente (cursor + deduplicación), así que repetirla es seguro.
+
+Un usuario tiene a lo sumo un trabajo activo por clave (tipo + parámetros
+que cambian el resultado, índice único parcial): un pedido igual a otro que
+está en curso se une a ese trabajo y recibe su id; uno distinto se encola
+aparte. La ejecución pasa además por el single-flight por usuario, que
+serializa los trabajos distintos del mismo usuario entre sí y con el
+procesamiento de notificaciones.
+
+Los avisos push de Gmail (ver gmail_push) usan la misma cola con el tipo
+"notificaciones"; su historyId no forma parte de la clave, así varios
+avisos seguidos de un usuario se unen en un solo procesamiento.
+"""
+import os
+import json
+import time
+import uuid
+import socket
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from sqlalchemy import exists, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+
+from app.config.notifications_config import TRABAJOS_CONFIG, MONITORING_CONFIG
+from app.db.session import SessionLocal
+from app.models.factura_model import Factura
+from app.models.sync_job_model import SyncJob, clave_trabajo
+from app.models.user_model import User
+from app.services.extractor import sincronizar_facturas_con_limite
+from app.services.notificaciones import notificacion_service
+from app.services.vuelo_unico import vuelo_por_usuario
+from app.services.eventos_sync import bus_eventos
+
+logger = logging.getLogger(__name__)
+
+# Intentos para guardar el resultado de un trabajo (p. ej. si SQLite está bloqueada)
+INTENTOS_FINALIZAR = 3
+
+
+# === Progreso ===
+class ProgresoTrabajo:
+    """
+    Callback de progreso: acumula los contadores en la fila del trabajo y
+    publica cada evento en el bus para los clientes de streaming
+    """
+
+    # evento -> etapa que empieza con él
+    ETAPAS = {
+        "emails_listados": "emails",
+        "descargas_iniciadas": "descargas",
+        "analisis_iniciado": "graficos",
+    }
+
+    def __init__(self, job_id: int):
+        self.job_id = job_id
+
+    def _actualizar(self, valores: Dict[Any, Any]):
+        db = SessionLocal()
+        try:
+            db.query(SyncJob).filter(SyncJob.id == self.job_id).update(valores, synchronize_session=False)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.warning(f"No se pudo guardar el progreso del trabajo {self.job_id}: {e}")
+        finally:
+            db.close()
+
+    def __call__(self, evento: str, **datos):
+        bus_eventos.publicar(self.job_id, evento, **datos)
+        valores = {}
+        if evento in self.ETAPAS:
+            valores[SyncJob.etapa] = self.ETAPAS[evento]
+        if evento == "emails_listados":
+            valores[SyncJob.emails_listados] = datos.get("cantidad", 0)
+        elif evento == "descargas_iniciadas":
+            valores[SyncJob.facturas_encontradas] = datos.get("cantidad", 0)
+        elif evento == "pdf_descargado":
+            valores[SyncJob.pdfs_descargados] = SyncJob.pdfs_descargados + 1
+        elif evento == "historico_guardado":
+            valores[SyncJob.graficos_analizados] = SyncJob.graficos_analizados + 1
+        if valores:
+            self._actualizar(valores)
+
+
+# === Ejecutores por tipo de trabajo ===
+def _obtener_usuario(db, user_id: int) -> User:
+    user = db.query(User).filter(User.id == user_id).first()
+    if not user:
+        raise ValueError(f"Usuario con ID {user_id} no encontrado")
+    if not user.gmail_token:
+        raise ValueError("El usuario no tiene token de Gmail guardado")
+    return user
+
+def _ejecutar_sync(user_id: int, parametros: Dict[str, Any], progreso: Callable) -> Dict[str, Any]:
+    """Sincronización con límite de emails (/sync y /sync_con_jwt)"""
+    db = SessionLocal()
+    try:
+        user = _obtener_usuario(db, user_id)
+        gmail_token, email = user.gmail_token, user.email
+    finally:
+        db.close()
+
+    resultado = sincronizar_facturas_con_limite(
+        user_id=user_id,
+        gmail_token=gmail_token,
+        max_emails=parametros["max_emails"],
+        progreso=progreso
+    )
+    return {**resultado, "user_email": email}
+
+def _ejecutar_sync_inteligente(user_id: int, parametros: Dict[str, Any], progreso: Callable) -> Dict[str, Any]:
+    """Sincronización que detecta si es primera vez o incremental (/sync_inteligente_con_jwt)"""
+    max_emails = parametros["max_emails"]
+    forzar_sync = parametros.get("forzar_sync", False)
+
+    db = SessionLocal()
+    try:
+        user = _obtener_usuario(db, user_id)
+        gmail_token, email = user.gmail_token, user.email
+        facturas_existentes = db.query(Factura).filter(Factura.user_id == user_id).count()
+    finally:
+        db.close()
+
+    es_primera_vez = facturas_existentes == 0
+    if es_primera_vez:
+        modo_sync = "primera_vez"
+        limite_recomendado = min(max_emails, 10)  # Límite más conservador para primera vez
+    elif forzar_sync:
+        modo_sync = "forzada_completa"
+        limite_recomendado = max_emails
+    else:
+        modo_sync = "incremental"
+        limite_recomendado = min(max_emails, 5)  # Pocas facturas para incremental
+
+    resultado_sync = sincronizar_facturas_con_limite(
+        user_id=user_id,
+        gmail_token=gmail_token,
+        max_emails=limite_recomendado,
+        incremental=not forzar_sync,
+        progreso=progreso
+    )
+
+    db = SessionLocal()
+    try:
+        facturas_despues = db.query(Factura).filter(Factura.user_id == user_id).count()
+    finally:
+        db.close()
+    facturas_nuevas = facturas_despues - facturas_existentes
+
+    return {
+        "sync_completado": "error" not in resultado_sync,
+        "modo_sincronizacion": modo_sync,
+        "es_primera_vez": es_primera_vez,
+        "usuario": email,
+        "emails_procesados": limite_recomendado,
+        "facturas_antes": facturas_existentes,
+        "facturas_despues": facturas_despues,
+        "facturas_nuevas": facturas_nuevas,
+        "resultado_extractor": resultado_sync,
+        "recomendacion": "Sincronización completa" if facturas_nuevas > 0 else "No se encontraron facturas nuevas"
+    }
+
+def _ejecutar_notificaciones(user_id: int, parametros: Dict[str, Any], progreso: Callable) -> Dict[str, Any]:
+    """Procesamiento de notificaciones de un usuario (avisos push de Gmail)"""
+    resultado = notificacion_service.procesar_usuario_aislado(user_id, MONITORING_CONFIG["timeout_per_user_seconds"])
+    if parametros.get("history_id") and _error_del_resultado(resultado) is None:
+        # Import diferido: gmail_push encola en esta cola
+        from app.services.gmail_push import confirmar_historial
+        confirmar_historial(user_id, int(parametros["history_id"]))
+    return resultado
+
+EJECUTORES: Dict[str, Callable[[int, Dict[str, Any], Callable], Dict[str, Any]]] = {
+    "sync": _ejecutar_sync,
+    "sync_con_jwt": _ejecutar_sync,
+    "sync_inteligente": _ejecutar_sync_inteligente,
+    "notificaciones": _ejecutar_notificaciones,
+}
+
+# Ejecutores que ya pasan por el single-flight por usuario con su propio tipo
+EJECUTORES_CON_VUELO_PROPIO = {"notificaciones"}
+
+
+def _error_del_resultado(resultado: Dict[str, Any]) -> Optional[str]:
+    """Las funciones de sincronización informan errores en el dict en vez de lanzar"""
+    if "error" in resultado:
+        return resultado["error"]
+    if resultado.get("errores"):
+        return "; ".join(resultado["errores"])
+    if isinstance(resultado.get("resultado_extractor"), dict):
+        return resultado["resultado_extractor"].get("error")
+    return None
+
+def job_a_dict(job: SyncJob) -> Dict[str, Any]:
+    """Representación del trabajo para la API"""
+    return {
+        "job_id": job.id,
+        "user_id": job.user_id,
+        "tipo": job.tipo,
+        "estado": job.estado,
+        "etapa": job.etapa,
+        "intentos": job.intentos,
+        "progreso": {
+            "emails_listados": job.emails_listados or 0,
+            "facturas_encontradas": job.facturas_encontradas or 0,
+            "pdfs_descargados": job.pdfs_descargados or 0,
+            "graficos_analizados": job.graficos_analizados or 0,
+        },
+        "parametros": json.loads(job.parametros) if job.parametros else {},
+        "resultado": json.loads(job.resultado) if job.resultado else None,
+        "error": job.error,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+# === Cola ===
+class ColaTrabajos:
+    """Hilos trabajadores que consumen la tabla sync_jobs"""
+
+    def __init__(self, workers: int = None):
+        self.workers = workers or TRABAJOS_CONFIG["workers"]
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._hilos = []
+        self._en_curso = set()  # Trabajos que ejecuta este proceso: solo estos siguen latiendo
+        self._lock_en_curso = threading.Lock()
+        self._aviso = threading.Event()
+        self._detener = threading.Event()
+        self._lock = threading.Lock()
+
+    def iniciar(self):
+        """Recuperar los trabajos interrumpidos y arrancar los trabajadores (idempotente)"""
+        with self._lock:
+            if self._hilos:
+                return
+            self._detener.clear()
+            self.recuperar_interrumpidos()
+            for i in range(self.workers):
+                hilo = threading.Thread(target=self._bucle, name=f"sync-job-{i + 1}", daemon=True)
+                hilo.start()
+                self._hilos.append(hilo)
+            latido = threading.Thread(target=self._bucle_latido, name="sync-job-latido", daemon=True)
+            latido.start()
+            self._hilos.append(latido)
+            logger.info(f"🧵 Cola de sincronización iniciada con {self.workers} trabajadores")
+
+    def cerrar(self, timeout: float = 5):
+        """Detener los trabajadores; los trabajos en curso se retoman cuando vence su latido"""
+        with self._lock:
+            hilos, self._hilos = self._hilos, []
+        self._detener.set()
+        self._aviso.set()
+        for hilo in hilos:
+            hilo.join(timeout=timeout)
+
+    def encolar(self, user_id: int, tipo: str, parametros: Dict[str, Any]) -> Tuple[SyncJob, bool]:
+        """
+        Crear un trabajo pendiente y despertar a los trabajadores
+
+        Returns:
+            (job, unido) donde unido es True si el usuario ya tenía un trabajo
+            activo con la misma clave y se devuelve ese en lugar de crear uno nuevo
+        """
+        if tipo not in EJECUTORES:
+            raise ValueError(f"Tipo de trabajo desconocido: {tipo}")
+        clave = clave_trabajo(tipo, parametros)
+        db = SessionLocal()
+        try:
+            activo = obtener_trabajo_activo(db, user_id, clave)
+            if activo is None:
+                job = SyncJob(user_id=user_id, tipo=tipo, clave=clave, parametros=json.dumps(parametros),
+                              estado="pendiente")
+                db.add(job)
+                try:
+                    db.commit()
+                    db.refresh(job)
+                    db.expunge(job)
+                    self._aviso.set()
+                    return job, False
+                except IntegrityError:
+                    # Otro pedido del mismo usuario encoló al mismo tiempo
+                    db.rollback()
+                    activo = obtener_trabajo_activo(db, user_id, clave)
+            if activo is None:
+                raise RuntimeError(f"No se pudo encolar la sincronización del usuario {user_id}")
+            logger.info(f"🔗 Usuario {user_id} ya tiene el trabajo {activo.id} ({tipo}) activo, se une a él")
+            db.expunge(activo)
+            return activo, True
+        finally:
+            db.close()
+
+    def recuperar_interrumpidos(self) -> int:
+        """
+        Devolver a la cola los trabajos en curso cuyo proceso dejó de latir
+        (murió o se reinició); los de procesos vivos no se tocan
+        """
+        limite = datetime.utcnow() - timedelta(seconds=TRABAJOS_CONFIG["latido_vencido_segundos"])
+        vencido = or_(
+            SyncJob.heartbeat_at < limite,
+            # Trabajos tomados antes de que existiera el latido
+            (SyncJob.heartbeat_at.is_(None)) & (or_(SyncJob.started_at.is_(None), SyncJob.started_at < limite))
+        )
+        db = SessionLocal()
+        try:
+            interrumpidos = db.query(SyncJob).filter(SyncJob.estado == "en_curso", vencido).all()
+            recuperados = 0
+            for job in interrumpidos:
+                if (job.intentos or 0) >= TRABAJOS_CONFIG["intentos_maximos"]:
+                    valores = {
+                        SyncJob.estado: "error",
+                        SyncJob.error: "Trabajo interrumpido demasiadas veces",
+                        SyncJob.finished_at: datetime.utcnow(),
+                    }
+                else:
+                    valores = {SyncJob.estado: "pendiente", SyncJob.worker_id: None}
+                # Condicional: otro proceso pudo recuperarlo, o su dueño volver a latir
+                recuperados += db.query(SyncJob).filter(
+                    SyncJob.id == job.id,
+                    SyncJob.estado == "en_curso",
+                    vencido
+                ).update(valores, synchronize_session=False)
+            db.commit()
+            if recuperados:
+                logger.info(f"♻️ {recuperados} trabajos de sincronización interrumpidos recuperados")
+                self._aviso.set()
+            return recuperados
+        finally:
+            db.close()
+
+    def latir(self) -> int:
+        """Renovar heartbeat_at de los trabajos que este proceso está ejecutando"""
+        with self._lock_en_curso:
+            en_curso = list(self._en_curso)
+        if not en_curso:
+            return 0
+        db = SessionLocal()
+        try:
+            renovados = db.query(SyncJob).filter(
+                SyncJob.id.in_(en_curso),
+                SyncJob.estado == "en_curso",
+                SyncJob.worker_id == self.worker_id
+            ).update({SyncJob.heartbeat_at: datetime.utcnow()}, synchronize_session=False)
+            db.commit()
+            return renovados
+        finally:
+            db.close()
+
+    def _bucle_latido(self):
+        while not self._detener.wait(TRABAJOS_CONFIG["latido_segundos"]):
+            try:
+                self.latir()
+                self.recuperar_interrumpidos()
+            except Exception as e:
+                logger.error(f"Error renovando el latido de la cola de sincronización: {e}")
+
+    def _tomar_siguiente(self) -> Optional[int]:
+        """
+        Reservar el trabajo pendiente más antiguo de un usuario que no tenga
+        otro en curso (en cualquier proceso); None si no hay
+        """
+        otro = aliased(SyncJob)
+        usuario_ocupado = exists().where(otro.user_id == SyncJob.user_id, otro.estado == "en_curso")
+        db = SessionLocal()
+        try:
+            candidatos = db.query(SyncJob.id).filter(SyncJob.estado == "pendiente", ~usuario_ocupado)\
+                           .order_by(SyncJob.id).limit(5).all()
+            for (job_id,) in candidatos:
+                tomado = db.query(SyncJob).filter(
+                    SyncJob.id == job_id,
+                    SyncJob.estado == "pendiente",
+                    ~usuario_ocupado
+                ).update({
+                    SyncJob.estado: "en_curso",
+                    SyncJob.started_at: datetime.utcnow(),
+                    SyncJob.worker_id: self.worker_id,
+                    SyncJob.heartbeat_at: datetime.utcnow(),
+                    SyncJob.intentos: SyncJob.intentos + 1,
+                }, synchronize_session=False)
+                db.commit()
+                if tomado:
+                    with self._lock_en_curso:
+                        self._en_curso.add(job_id)
+                    return job_id
+            return None
+        finally:
+            db.close()
+
+    def _finalizar(self, job_id: int, resultado: Optional[Dict[str, Any]], error: Optional[str]):
+        """Guardar el resultado del trabajo, reintentando si la base está ocupada"""
+        estado = "error" if error else "completado"
+        for intento in range(INTENTOS_FINALIZAR):
+            db = SessionLocal()
+            try:
+                job = db.query(SyncJob).filter(SyncJob.id == job_id).first()
+                if job is None:
+                    logger.warning(f"El trabajo {job_id} ya no existe, no se guarda su resultado")
+                    return
+                job.estado = estado
+                job.etapa = "finalizado"
+                job.resultado = json.dumps(resultado, default=str) if resultado is not None else None
+                job.error = error
+                job.finished_at = datetime.utcnow()
+                db.commit()
+                break
+            except Exception as e:
+                db.rollback()
+                if intento + 1 == INTENTOS_FINALIZAR:
+                    raise
+                logger.warning(f"No se pudo guardar el resultado del trabajo {job_id} (intento {intento + 1}): {e}")
+                time.sleep(intento + 1)
+            finally:
+                db.close()
+        bus_eventos.publicar(job_id, "fin", estado=estado, error=error, resultado=resultado)
+
+    def ejecutar(self, job_id: int):
+        """Ejecutar un trabajo ya reservado y guardar su resultado"""
+        db = SessionLocal()
+        try:
+            job = db.query(SyncJob).filter(SyncJob.id == job_id).first()
+            if job is None:
+                logger.warning(f"El trabajo {job_id} ya no existe, se omite")
+                return
+            user_id, tipo = job.user_id, job.tipo
+            parametros = json.loads(job.parametros) if job.parametros else {}
+        finally:
+            db.close()
+
+        logger.info(f"🔄 Ejecutando trabajo {job_id} ({tipo}) del usuario {user_id}")
+        try:
+            if tipo in EJECUTORES_CON_VUELO_PROPIO:
+                resultado = EJECUTORES[tipo](user_id, parametros, ProgresoTrabajo(job_id))
+            else:
+                # Con la clave del trabajo: uno distinto del mismo usuario espera en vez de unirse
+                resultado, _ = vuelo_por_usuario.ejecutar(
+                    user_id, clave_trabajo(tipo, parametros),
+                    lambda: EJECUTORES[tipo](user_id, parametros, ProgresoTrabajo(job_id))
+                )
+            error = _error_del_resultado(resultado)
+        except Exception as e:
+            logger.error(f"❌ Error en trabajo {job_id}: {e}")
+            resultado, error = None, str(e)
+        self._finalizar(job_id, resultado, error)
+
+    def _bucle(self):
+        while not self._detener.is_set():
+            try:
+                job_id = self._tomar_siguiente()
+            except Exception as e:
+                logger.error(f"Error consultando la cola de sincronización: {e}")
+                job_id = None
+            if job_id is None:
+                self._aviso.wait(TRABAJOS_CONFIG["poll_segundos"])
+                self._aviso.clear()
+                continue
+            try:
+                self.ejecutar(job_id)
+            except Exception as e:
+                # El trabajador sigue vivo; el trabajo deja de latir y se retoma cuando vence su latido
+                logger.error(f"❌ No se pudo completar el trabajo {job_id}, se retoma más tarde: {e}")
+            finally:
+                with self._lock_en_curso:
+                    self._en_curso.discard(job_id)
+
+
+def obtener_trabajo(db, job_id: int) -> Optional[SyncJob]:
+    return db.query(SyncJob).filter(SyncJob.id == job_id).first()
+
+def obtener_trabajo_activo(db, user_id: int, clave: Optional[str] = None) -> Optional[SyncJob]:
+    """Trabajo pendiente o en curso del usuario (con esa clave, si se indica)"""
+    query = db.query(SyncJob).filter(
+        SyncJob.user_id == user_id,
+        SyncJob.estado.in_(["pendiente", "en_curso"])
+    )
+    if clave is not None:
+        query = query.filter(SyncJob.clave == clave)
+    return query.order_by(SyncJob.id).first()
+
+
+# Instancia global de la cola
+cola_trabajos = ColaTrabajos()
@@ -0,0 +1,83 @@
+"""
+Single-flight por usuario
+
+Evita que dos procesos de facturas del mismo usuario (sincronización desde
+la app, notificaciones automáticas) corran a la vez y compitan por los
+mismos links y archivos:
+
+- Si ya hay una operación del mismo tipo en curso para el usuario, la
+  llamada nueva se une a ella y recibe su resultado.
+- Si hay una operación de otro tipo en curso, la llamada nueva espera a que
+  termine y recién entonces se ejecuta.
+
+Dentro de la API los trabajos de sincronización además se deduplican en la
+base (un solo trabajo activo por usuario y clave, ver trabajos_sync).
+"""
+import logging
+import threading
+import concurrent.futures
+from typing import Any, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class _Vuelo:
+    def __init__(self, tipo: str):
+        self.tipo = tipo
+        self.future = concurrent.futures.Future()
+        self.unidos = 0
+
+
+class VueloUnicoPorUsuario:
+    """Registro de operaciones en curso por user_id"""
+
+    def __init__(self):
+        self._vuelos: Dict[int, _Vuelo] = {}
+        self._lock = threading.Lock()
+
+    def en_curso(self, user_id: int) -> Optional[str]:
+        """Tipo de la operación en curso para el usuario, o None"""
+        with self._lock:
+            vuelo = self._vuelos.get(user_id)
+            return vuelo.tipo if vuelo else None
+
+    def ejecutar(self, user_id: int, tipo: str, funcion: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        Ejecutar funcion() salvo que ya haya una operación igual en curso
+
+        Returns:
+            (resultado, unido) donde unido es True si el resultado viene de
+            una operación que ya estaba en curso
+        """
+        while True:
+            with self._lock:
+                vuelo = self._vuelos.get(user_id)
+                if vuelo is None:
+                    vuelo = _Vuelo(tipo)
+                    self._vuelos[user_id] = vuelo
+                    break
+                if vuelo.tipo == tipo:
+                    vuelo.unidos += 1
+
+            if vuelo.tipo == tipo:
+                logger.info(f"🔗 Usuario {user_id}: uniéndose a la operación '{tipo}' en curso")
+                return vuelo.future.result(), True
+
+            # Otra operación del usuario en curso: esperar a que termine
+            logger.info(f"⏳ Usuario {user_id}: esperando que termine '{vuelo.tipo}' antes de '{tipo}'")
+            concurrent.futures.wait([vuelo.future])
+
+        try:
+            resultado = funcion()
+            vuelo.future.set_result(resultado)
+            return resultado, False
+        except BaseException as e:
+            vuelo.future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._vuelos.pop(user_id, None)
+
+
+# Instancia global compartida por la API y el servicio de notificaciones
+vuelo_por_usuario = VueloUnicoPorUsuario()
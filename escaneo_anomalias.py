@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Escaneo nocturno de anomalías de todos los NICs de la base
+
+Puntúa cada (usuario, NIC) fuera de la API, en un pool de procesos, y
+guarda los resultados en anomalia_resultado / anomalia_version en lote.
+Las consultas de anomalías de la API después solo leen la tabla.
+
+Uso:
+    python escaneo_anomalias.py                      # todos los usuarios
+    python escaneo_anomalias.py --usuario 2          # un solo usuario
+    python escaneo_anomalias.py --workers 4 --sin-guardar  # medir sin escribir
+"""
+
+import sys
+import json
+import argparse
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from app.services.database import init_db_if_not_exists
+from app.services.escaneo_anomalias import (
+    escanear_anomalias, FILAS_POR_BLOQUE, NICS_POR_ESCRITURA
+)
+
+
+def mostrar_progreso(metricas: dict):
+    print(f"  • {metricas['nics']} NICs, {metricas['registros']} registros, "
+          f"{metricas['nics_con_alerta']} con alerta - {metricas['nics_por_segundo']} NICs/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Escaneo offline de anomalías de todos los NICs")
+    parser.add_argument("--workers", type=int, default=None, help="Procesos del pool (por defecto, uno por CPU)")
+    parser.add_argument("--filas-por-bloque", type=int, default=FILAS_POR_BLOQUE, help="Filas de histórico por lectura")
+    parser.add_argument("--nics-por-escritura", type=int, default=NICS_POR_ESCRITURA, help="NICs por escritura en lote")
+    parser.add_argument("--usuario", type=int, default=None, help="Escanear solo este user_id")
+    parser.add_argument("--sin-guardar", action="store_true", help="Puntuar sin escribir resultados")
+    parser.add_argument("--json", action="store_true", help="Imprimir las métricas finales en JSON")
+    args = parser.parse_args()
+
+    if not init_db_if_not_exists():
+        sys.exit(1)
+
+    print("🔎 Escaneo de anomalías iniciado")
+    metricas = escanear_anomalias(
+        workers=args.workers,
+        filas_por_bloque=args.filas_por_bloque,
+        nics_por_escritura=args.nics_por_escritura,
+        user_id=args.usuario,
+        guardar=not args.sin_guardar,
+        al_progresar=None if args.json else mostrar_progreso
+    )
+
+    if args.json:
+        print(json.dumps(metricas, indent=2, ensure_ascii=False))
+    else:
+        print(f"✅ {metricas['nics']} NICs ({metricas['registros']} registros) en {metricas['segundos']}s: "
+              f"{metricas['nics_por_segundo']} NICs/s, {metricas['nics_con_alerta']} con alerta, "
+              f"{metricas['errores']} errores")
+    if metricas["errores"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Cliente falso de Pub/Sub para probar el modo push de Gmail sin Google
+
+Envía a POST /gmail/push avisos con el mismo sobre que usa una suscripción
+push real ({"message": {"data": base64({"emailAddress", "historyId"})}}).
+Puede repetir cada aviso para ver que los duplicados se descartan.
+
+Uso (con la API levantada con GMAIL_PUSH_HABILITADO=true, GMAIL_PUSH_TOKEN
+y, para no consultar Gmail, GMAIL_PUSH_VERIFICAR_HISTORIAL=false):
+    python gmail_push_falso.py --email usuario@gmail.com --token secreto --history-id 1000 --cantidad 3 --repetir 2
+"""
+
+import json
+import time
+import base64
+import argparse
+import urllib.error
+import urllib.parse
+import urllib.request
+
+
+def armar_aviso(email: str, history_id: int, numero: int) -> dict:
+    datos = json.dumps({"emailAddress": email, "historyId": history_id}).encode("utf-8")
+    return {
+        "message": {
+            "data": base64.b64encode(datos).decode("ascii"),
+            "messageId": f"falso-{history_id}-{numero}",
+            "publishTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        },
+        "subscription": "projects/falso/subscriptions/gmail-push"
+    }
+
+
+def enviar(url: str, aviso: dict):
+    solicitud = urllib.request.Request(
+        url, data=json.dumps(aviso).encode("utf-8"),
+        headers={"Content-Type": "application/json"}, method="POST"
+    )
+    try:
+        with urllib.request.urlopen(solicitud, timeout=30) as respuesta:
+            return respuesta.status, json.loads(respuesta.read() or b"null")
+    except urllib.error.HTTPError as e:
+        return e.code, e.read().decode("utf-8", errors="ignore")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cliente falso de avisos push de Gmail")
+    parser.add_argument("--url", default="http://localhost:8000/gmail/push")
+    parser.add_argument("--email", required=True, help="emailAddress del aviso (email del usuario)")
+    parser.add_argument("--history-id", type=int, default=int(time.time()), help="historyId del primer aviso")
+    parser.add_argument("--cantidad", type=int, default=1, help="Avisos con historyId creciente")
+    parser.add_argument("--repetir", type=int, default=1, help="Veces que se envía cada aviso")
+    parser.add_argument("--token", required=True, help="Valor de GMAIL_PUSH_TOKEN")
+    parser.add_argument("--pausa", type=float, default=0.5, help="Segundos entre avisos")
+    args = parser.parse_args()
+
+    url = f"{args.url}?{urllib.parse.urlencode({'token': args.token})}"
+
+    print(f"📨 Enviando {args.cantidad} avisos ({args.repetir} veces cada uno) a {args.url}")
+    for i in range(args.cantidad):
+        aviso = armar_aviso(args.email, args.history_id + i, i)
+        for _ in range(args.repetir):
+            estado, cuerpo = enviar(url, aviso)
+            print(f"  • historyId {args.history_id + i}: HTTP {estado} {cuerpo}")
+            time.sleep(args.pausa)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,8 @@ Script de migración para asociar facturas existentes con usuarios
 import sqlite3
 from datetime import datetime
 
+from app.db.migraciones import migrar_esquema
+
 def migrate_database():
     conn = sqlite3.connect('consumo.db')
     cursor = conn.cursor()
@@ -41,6 +43,9 @@ def migrate_database():
         else:
             print("✅ La tabla facturas ya tiene la columna user_id")
         
+        # Columnas e índices nuevos (la API también los aplica al iniciar)
+        migrar_esquema(cursor)
+        
         # Verificar que el modelo User tenga un campo 'name' para compatibilidad
         cursor.execute("PRAGMA table_info(users)")
         user_columns = [column[1] for column in cursor.fetchall()]
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Programador independiente del servicio de notificaciones
+
+Corre el barrido de notificaciones cada MONITORING_FREQUENCY_MINUTES minutos
+fuera de la API. Puede convivir con otras instancias (u otra API con
+PROGRAMADOR_HABILITADO=true): solo barre la que tiene el lease en la base.
+
+Uso:
+    python programador_notificaciones.py            # bucle periódico
+    python programador_notificaciones.py --una-vez  # una sola ronda
+    python programador_notificaciones.py --estado   # estado persistido
+"""
+
+import sys
+import json
+import argparse
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from app.services.database import init_db_if_not_exists
+from app.services.programador import programador_notificaciones
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Programador del servicio de notificaciones")
+    parser.add_argument("--una-vez", action="store_true", help="Ejecutar una ronda y salir")
+    parser.add_argument("--estado", action="store_true", help="Mostrar el estado persistido y salir")
+    args = parser.parse_args()
+
+    if not init_db_if_not_exists():
+        sys.exit(1)
+
+    if args.estado:
+        print(json.dumps(programador_notificaciones.estado(), indent=2, ensure_ascii=False))
+        return
+
+    if args.una_vez:
+        resultado = programador_notificaciones.ejecutar_ronda()
+        if resultado is None:
+            print("⏭️ Otra instancia tiene el lease, no se ejecutó la ronda")
+        else:
+            print(f"✅ Ronda completada: {resultado['usuarios_procesados']} usuarios, "
+                  f"{resultado['alertas_enviadas']} alertas")
+        return
+
+    print("🗓️ Programador de notificaciones iniciado (Ctrl+C para detener)")
+    programador_notificaciones.ejecutar_por_siempre()
+
+
+if __name__ == "__main__":
+    main()
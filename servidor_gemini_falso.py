@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Servidor falso de Gemini para probar el análisis de gráficos sin la API real
+
+Responde a POST /v1beta/models/<modelo>:generateContent con una tabla fija
+en el formato que espera parse_gemini_output. Permite simular latencia y
+errores transitorios (429/503) para ver los reintentos y el límite de tasa.
+
+Uso:
+    python servidor_gemini_falso.py --puerto 8089 --latencia 0.5 --tasa-errores 0.3
+
+Y en otra terminal:
+    GEMINI_API_KEY=falsa GEMINI_API_ENDPOINT=http://localhost:8089 uvicorn app.main:app
+"""
+
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TABLA = (
+    "Fecha | Consumo (KWh)\n"
+    "01/24 | 310\n"
+    "03/24 | 295\n"
+    "05/24 | 240\n"
+    "07/24 | 330\n"
+    "09/24 | 280\n"
+    "11/24 | 305\n"
+)
+
+estadisticas = {"solicitudes": 0, "errores": 0, "simultaneas": 0, "max_simultaneas": 0}
+lock = threading.Lock()
+
+
+class ManejadorGemini(BaseHTTPRequestHandler):
+    latencia = 0.0
+    tasa_errores = 0.0
+
+    def _responder(self, codigo, cuerpo):
+        data = json.dumps(cuerpo).encode()
+        self.send_response(codigo)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not self.path.split("?")[0].endswith(":generateContent"):
+            self._responder(404, {"error": {"code": 404, "message": "No encontrado", "status": "NOT_FOUND"}})
+            return
+
+        with lock:
+            estadisticas["solicitudes"] += 1
+            estadisticas["simultaneas"] += 1
+            estadisticas["max_simultaneas"] = max(estadisticas["max_simultaneas"], estadisticas["simultaneas"])
+        try:
+            time.sleep(self.latencia * random.uniform(0.5, 1.5))
+            if random.random() < self.tasa_errores:
+                with lock:
+                    estadisticas["errores"] += 1
+                codigo, estado = random.choice([(429, "RESOURCE_EXHAUSTED"), (503, "UNAVAILABLE")])
+                self._responder(codigo, {"error": {"code": codigo, "message": "Error simulado", "status": estado}})
+                return
+
+            self._responder(200, {
+                "candidates": [{
+                    "content": {"role": "model", "parts": [{"text": TABLA}]},
+                    "finishReason": "STOP",
+                    "index": 0
+                }]
+            })
+        finally:
+            with lock:
+                estadisticas["simultaneas"] -= 1
+
+    def log_message(self, format, *args):
+        print(f"🤖 {self.address_string()} {format % args} | {estadisticas}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor falso de Gemini")
+    parser.add_argument("--puerto", type=int, default=8089)
+    parser.add_argument("--latencia", type=float, default=0.5, help="Segundos promedio por respuesta")
+    parser.add_argument("--tasa-errores", type=float, default=0.0, help="Fracción de respuestas 429/503")
+    args = parser.parse_args()
+
+    ManejadorGemini.latencia = args.latencia
+    ManejadorGemini.tasa_errores = args.tasa_errores
+
+    servidor = ThreadingHTTPServer(("127.0.0.1", args.puerto), ManejadorGemini)
+    print(f"🚀 Servidor falso de Gemini en http://localhost:{args.puerto}")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        print(f"\n📊 Estadísticas finales: {estadisticas}")
+
+
+if __name__ == "__main__":
+    main()
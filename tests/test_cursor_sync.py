@@ -0,0 +1,140 @@
+"""
+Cursor de sincronización incremental de Gmail (extractor.buscar_links_nuevos)
+
+Se usa un servicio de Gmail falso y una base SQLite temporal.
+"""
+import os
+import re
+import base64
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+os.environ.setdefault("GEMINI_API_KEY", "test")
+
+from app.db.base import Base
+import app.services.database  # noqa: F401  (registra todos los modelos)
+from app.services import extractor
+
+
+def _link(n):
+    return f"https://oficinavirtual.edemsa.com/facturad.php?conf={n}"
+
+
+class _Pedido:
+    def __init__(self, resultado):
+        self._resultado = resultado
+
+    def execute(self):
+        return self._resultado
+
+
+class _Batch:
+    def __init__(self, callback):
+        self._callback = callback
+        self._pedidos = []
+
+    def add(self, pedido, request_id):
+        self._pedidos.append((request_id, pedido))
+
+    def execute(self):
+        for request_id, pedido in self._pedidos:
+            self._callback(request_id, pedido.execute(), None)
+
+
+class GmailFalso:
+    """Lo justo de la API de Gmail que usa el extractor"""
+
+    def __init__(self, mensajes):
+        # mensajes: lista de (id, internalDate en ms, links)
+        self.mensajes = {
+            msg_id: {"id": msg_id, "internalDate": str(fecha), "historyId": str(fecha), "links": links}
+            for msg_id, fecha, links in mensajes
+        }
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def list(self, userId, q, pageToken=None, maxResults=100, fields=None):
+        despues = re.search(r"after:(\d+)", q)
+        desde = int(despues.group(1)) if despues else -1
+        # Del más reciente al más antiguo, como Gmail
+        ids = [m["id"] for m in sorted(self.mensajes.values(), key=lambda m: -int(m["internalDate"]))
+               if int(m["internalDate"]) // 1000 > desde]
+        inicio = int(pageToken or 0)
+        pagina = ids[inicio:inicio + maxResults]
+        resultado = {"messages": [{"id": msg_id} for msg_id in pagina]}
+        if inicio + maxResults < len(ids):
+            resultado["nextPageToken"] = str(inicio + maxResults)
+        return _Pedido(resultado)
+
+    def get(self, userId, id, format=None, fields=None):
+        mensaje = self.mensajes[id]
+        html = "".join(f'<a href="{link}">factura</a>' for link in mensaje["links"])
+        data = base64.urlsafe_b64encode(html.encode()).decode()
+        return _Pedido({
+            "id": id,
+            "internalDate": mensaje["internalDate"],
+            "historyId": mensaje["historyId"],
+            "payload": {"mimeType": "text/html", "body": {"data": data}},
+        })
+
+    def new_batch_http_request(self, callback):
+        return _Batch(callback)
+
+
+@pytest.fixture
+def sesiones(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'consumo.db'}")
+    Base.metadata.create_all(bind=engine)
+    monkeypatch.setattr(extractor, "SessionLocal", sessionmaker(bind=engine))
+    yield
+    engine.dispose()
+
+
+def _sincronizar(service, max_emails, fallan=()):
+    """Una ronda: buscar, 'guardar' las facturas y avanzar el cursor"""
+    links, mensajes = extractor.buscar_links_nuevos(service, 1, max_emails)
+    mensajes = extractor.recortar_mensajes(mensajes, max_emails)
+    links = extractor._links_unicos(mensajes)
+    fallidos = [link for link in links if link in fallan]
+    extractor.guardar_cursor_sync(1, extractor.marca_procesada(mensajes, fallidos))
+    return [link for link in links if link not in fallidos]
+
+
+def test_mas_mensajes_nuevos_que_max_emails_no_se_saltean(sesiones):
+    # Dos mensajes en el mismo segundo para cubrir el filtro fino por internalDate
+    service = GmailFalso([(f"m{n}", 1_700_000_000_000 + n * (400 if n < 2 else 60_000), [_link(n)])
+                          for n in range(7)])
+
+    guardadas = []
+    for _ in range(5):
+        guardadas.extend(_sincronizar(service, max_emails=2))
+
+    assert guardadas == [_link(n) for n in range(7)]
+    assert _sincronizar(service, max_emails=2) == []
+
+
+def test_link_fallido_frena_el_cursor(sesiones):
+    service = GmailFalso([(f"m{n}", 1_700_000_000_000 + n * 60_000, [_link(n)]) for n in range(4)])
+
+    assert _sincronizar(service, max_emails=3, fallan={_link(1)}) == [_link(0), _link(2)]
+    # El cursor quedó en m0: m1 y los siguientes se vuelven a leer
+    assert _sincronizar(service, max_emails=3) == [_link(1), _link(2), _link(3)]
+    assert _sincronizar(service, max_emails=3) == []
+
+
+def test_mensaje_con_varios_links_no_se_corta(sesiones):
+    service = GmailFalso([
+        ("m0", 1_700_000_000_000, [_link(0)]),
+        ("m1", 1_700_000_060_000, [_link(1), _link(2)]),
+        ("m2", 1_700_000_120_000, [_link(3)]),
+    ])
+
+    assert _sincronizar(service, max_emails=2) == [_link(0)]
+    assert _sincronizar(service, max_emails=2) == [_link(1), _link(2)]
+    assert _sincronizar(service, max_emails=2) == [_link(3)]